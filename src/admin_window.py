@@ -4,6 +4,11 @@ from PIL import Image, ImageTk
 import cv2
 import os
 import datetime
+import queue
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 import database
 import image_tools
@@ -11,21 +16,84 @@ import numpy as np
 
 from yunet import YuNet
 from sface import SFace
+from gallery import Gallery
+from change_feed import GalleryFeed
+import snapshot
 
 from dotenv import load_dotenv, dotenv_values
 
 
+DISPLAY_SIZE = (1280, 720)
+
+
+# reads the camera on its own thread and converts at most display_fps frames/sec for the preview,
+# resizing and colour-converting into two preallocated RGB buffers that it alternates between, so
+# the Tk thread only ever pastes a finished buffer. frames in between are read (the camera's
+# buffer must drain) but never converted
+class PreviewFeed(threading.Thread):
+    def __init__(self, video_feed, size=DISPLAY_SIZE, display_fps=15.0) -> None:
+        super().__init__(name="admin-preview", daemon=True)
+
+        self.video_feed = video_feed
+        self.size = size
+        self.interval = 1.0 / display_fps
+
+        self.frame = None  # latest full-resolution BGR frame, for add/verify
+        self.seq = 0  # bumped for every converted frame
+
+        self._resized = np.empty((size[1], size[0], 3), dtype=np.uint8)
+        self._rgb = [np.empty((size[1], size[0], 3), dtype=np.uint8) for _ in range(2)]
+        self._ready = 0  # index of the buffer holding the latest converted frame
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def run(self) -> None:
+        last = 0.0
+
+        while not self._stopped.is_set():
+            hasFrame, frame = self.video_feed.read()
+            if not hasFrame:
+                self._stopped.wait(0.1)
+                continue
+
+            self.frame = frame
+
+            now = time.perf_counter()
+            if now - last < self.interval:
+                continue
+            last = now
+
+            # the buffer the Tk thread is not reading
+            target = 1 - self._ready
+            cv2.resize(frame, self.size, dst=self._resized)
+            cv2.cvtColor(self._resized, cv2.COLOR_BGR2RGB, dst=self._rgb[target])
+
+            with self._lock:
+                self._ready = target
+                self.seq += 1
+
+    # (seq, RGB buffer) of the latest converted frame; the buffer is only rewritten two frames later
+    def latest(self) -> tuple:
+        with self._lock:
+            return self.seq, self._rgb[self._ready]
+
+
 class AdminWindow:
 
-    def __init__(self, fd_model_path: str, fr_model_path: str) -> None:
+    def __init__(self, fd_model_path: str, fr_model_path: str, fd_target=(0, 0), fr_target=(0, 0)) -> None:
         self.root = tki.Tk()
         self.root.title("PanOpticon Administrator")
 
         self.output_path = os.getcwd() + "/images"
 
         # load in detection and recognition models
-        self.fdetect_model = YuNet(modelPath=fd_model_path, confThreshold=0.8)
-        self.frecogi_model = SFace(modelPath=fr_model_path, disType=1)
+        # fd_target/fr_target are (backendId, targetId) pairs; see runtime_config.py
+        self.fdetect_model = YuNet(modelPath=fd_model_path, confThreshold=0.8, backendId=fd_target[0], targetId=fd_target[1])
+        self.frecogi_model = SFace(modelPath=fr_model_path, disType=1, backendId=fr_target[0], targetId=fr_target[1])
+        self.gallery = Gallery(disType=1)
 
         self.root.bind("<Escape>", self.on_close)
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
@@ -38,22 +106,60 @@ class AdminWindow:
             os.getenv("DATABASE_NAME"), os.getenv("PORT_NUMBER")
         )
         # self.myDB.create_tables() # to reset database; comment this out if you don't want to reset it
+        self.myDB.attach_index(self.gallery)
+
+        # loaded once; enrolments from other processes arrive through the feed
+        watermark = snapshot.load_gallery(self.gallery, self.myDB)
+        self.feed = GalleryFeed(self.gallery, self.myDB, watermark)
+        self.feed.start()
 
         self.video_feed = cv2.VideoCapture(0)
         self.width = int(self.video_feed.get(cv2.CAP_PROP_FRAME_WIDTH))
         self.height = int(self.video_feed.get(cv2.CAP_PROP_FRAME_HEIGHT))
         self.fdetect_model.setInputSize([self.width, self.height])
 
+        # inference and database work run here, one job at a time, never on the Tk thread;
+        # their results come back through ui_queue, which the Tk thread drains in camera_loop
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="admin-work")
+        self.ui_queue = queue.Queue()
+
+        self.preview = PreviewFeed(self.video_feed)
+        self.preview_seq = 0
+
         self.setup_UI()
 
         if not os.path.exists("images"):
             os.mkdir("images")
 
+        if not self.video_feed.isOpened():
+            print("Error: could not open video feed.")
+
+        self.preview.start()
         self.camera_loop()
         self.root.mainloop()
 
+    # runs work() on the worker thread, then done(result) on the Tk thread; buttons are disabled meanwhile
+    def run_in_background(self, work, done) -> None:
+        self.set_buttons("disabled")
+
+        def finished(future):
+            def on_ui():
+                self.set_buttons("normal")
+                if future.exception() is not None:
+                    print("Error: {}".format(future.exception()))
+                    return
+                done(future.result())
+
+            self.ui_queue.put(on_ui)
+
+        self.executor.submit(work).add_done_callback(finished)
+
+    def set_buttons(self, state: str) -> None:
+        for btn in (self.btn_add, self.btn_verify, self.btn_log):
+            btn.configure(state=state)
+
     # adjust the brightness of the image if needed
-    def brightness_check(frame: np) -> np:
+    def brightness_check(self, frame: np) -> np:
         brightness = image_tools.brightness_check(frame)
 
         if brightness > 200:
@@ -77,103 +183,107 @@ class AdminWindow:
         thumbnailWindow = tki.Toplevel()
         thumbnailWindow.title("Preview Image")
 
-        img = img.resize((160, 160))
-        thumbnail = ImageTk.PhotoImage(img)
-        panel = tki.Label(thumbnailWindow, image=thumbnail)
-        panel.image = thumbnail
-        panel.pack()
+        # img is None when no face was found
+        if img is not None:
+            img = img.resize((160, 160))
+            thumbnail = ImageTk.PhotoImage(img)
+            panel = tki.Label(thumbnailWindow, image=thumbnail)
+            panel.image = thumbnail
+            panel.pack()
 
         text_label = tki.Label(thumbnailWindow, text=display_text)
         text_label.pack()
 
-    # captures the frame and saves the image to outputPath
-    def on_add(self):
+    # crops the face from frame and saves it to outputPath; returns (thumbnail as a PIL image, face, file name),
+    # or (None, None, None) when there is no face in the frame
+    def save_thumbnail(self, frame: np) -> tuple:
         path, file_name = self.get_file_name()
 
-        # takes a photo and crop it to save it as a thumbnail
-        _, frame = self.video_feed.read()
-        if frame is not None:
+        thumbnail, face = image_tools.extract_face(frame, self.fdetect_model)
+        if face is None:
+            return None, None, None
 
-            frame = self.brightness_check(frame)
+        cv2.imwrite(path, thumbnail)
 
-            frame, _ = image_tools.extract_face(frame, self.fdetect_model)
+        return Image.fromarray(cv2.cvtColor(thumbnail, cv2.COLOR_BGR2RGB)), face, file_name
 
-            cv2.imwrite(path, frame)
+    # captures the frame and saves the image to outputPath
+    def on_add(self):
+        # the frame is taken when the button is pressed, before the dialogs
+        frame = self.preview.frame
+        if frame is None:
+            return
 
         first_name = simpledialog.askstring("Input", "First name: ")
         last_name = simpledialog.askstring("Input", "Last name: ")
 
-        # convert img to numpy for manipulation
-        img = Image.open(path)
-        numpy_img = np.asarray(img)
-
-        encoding = self.frecogi_model.infer(numpy_img)
-        new_face, faceID = self.myDB.add_faces(first_name, last_name, encoding)
+        def work():
+            # detected and embedded from the same adjusted frame, so the landmarks match the pixels
+            adjusted = self.brightness_check(frame)
 
-        if new_face:
-            self.myDB.add_thumbnail(faceID, file_name)  # adding thumbnail to database
-            display_text = "Hi, {}".format(first_name)
+            img, face, file_name = self.save_thumbnail(adjusted)
+            if face is None:
+                return None, "No face found, nothing was added. Please try again."
 
-        self.display_thumbnail(numpy_img, display_text)
+            # embedded from the full frame, aligned by the face's landmarks like on the cameras
+            encoding = self.frecogi_model.infer(adjusted, face)
+            new_face, faceID = self.myDB.add_faces(first_name, last_name, encoding)
 
-    # verifies the face against the database
-    def verification(self, img: np) -> bool:
-        self.known_encodings = (
-            self.myDB.fetch_encodings()
-        )  # fetch all the encodings stored in database
-
-        this_emb = self.frecogi_model.infer(img)
+            if new_face:
+                self.myDB.add_thumbnail(faceID, file_name)  # adding thumbnail to database
+                return img, "Hi, {}".format(first_name)
 
-        is_recognised = False
+            return img, "Welcome back, {}".format(first_name)
 
-        for faceID in self.known_encodings:
+        self.run_in_background(work, lambda result: self.display_thumbnail(*result))
 
-            trg_emb = self.known_encodings[faceID]
+    # verifies the face against the database
+    def verification(self, img: np, face=None) -> bool:
+        this_emb = self.frecogi_model.infer(img, face)
 
-            dist, is_recognised = self.frecogi_model.dist(trg_emb, this_emb)
+        faceID, dist, is_recognised = self.gallery.match(this_emb)[0]
 
-            if is_recognised:
-                identity = self.myDB.verification(faceID)
-                display_text = "Hi, {}".format(identity)
+        if is_recognised:
+            identity = self.myDB.verification(faceID)
+            display_text = "Hi, {}".format(identity)
 
-                # if dist < 0.7 then add to mean encoding
-                if dist < 0.7:
-                    self.myDB.update_mean_encoding(faceID, this_emb, identity)
+            # if dist < 0.7 then add to mean encoding
+            if dist < 0.7:
+                self.myDB.update_mean_encoding(faceID, this_emb, identity)
 
-                return is_recognised, display_text
+            return is_recognised, display_text
 
-            else:
-                return False, ""
+        return False, ""
 
     def on_verify(self):
-        path, file_name = self.get_file_name()
-
         # takes a photo and crops the face
-        _, frame = self.video_feed.read()
-        if frame is not None:
-            frame, _ = image_tools.extract_face(frame, self.fdetect_model)
+        frame = self.preview.frame
+        if frame is None:
+            return
 
-            cv2.imwrite(path, frame)
+        def work():
+            img, face, _ = self.save_thumbnail(frame)
+            if face is None:
+                return None, "No face found. Please try again."
 
-        # convert img to numpy
-        img = Image.open(file_name)
-        numpy_img = np.asarray(img)
+            is_recognised, display_text = self.verification(frame, face)
 
-        is_recognised, display_text = self.verification(numpy_img)
+            if not is_recognised:  # face does not exist on database
+                self.myDB.verification("stranger")
+                display_text = "Hi, stranger"
 
-        if not is_recognised:  # face does not exist on database
-            self.myDB.verification("stranger")
-            display_text = "Hi, stranger"
+            return img, display_text
 
-        self.display_thumbnail(img, display_text)
+        self.run_in_background(work, lambda result: self.display_thumbnail(*result))
 
     def on_logs(self):
+        self.run_in_background(self.myDB.fetch_event_logs, self.show_logs)
+
+    def show_logs(self, eventLogs):
         event_window = tki.Toplevel()
         event_window.title("Event logs")
         event_window.config(width=300, height=600)
 
-        eventLogs = self.myDB.fetch_event_logs()
-
         # Create a frame to hold the Text and Scrollbar widgets
         frame = tki.Frame(event_window)
         frame.pack(fill="both", expand=True)
@@ -191,15 +301,22 @@ class AdminWindow:
         event_text.config(yscrollcommand=scrollbar.set)
 
     # closes admin window
-    def on_close(self):
+    def on_close(self, event=None):
+        self.preview.stop()
+        self.preview.join()
+        self.executor.shutdown(wait=True)
+        self.feed.stop()
+        self.feed.join()
         self.myDB.close_conn()
         self.video_feed.release()
         self.root.quit()
 
     # placing UI elements
     def setup_UI(self):
+        # the preview's tk bitmap, allocated once and pasted into for every frame
+        self.camera_frame = ImageTk.PhotoImage("RGB", DISPLAY_SIZE)
         self.camera_feed = tki.Label(
-            self.root, width=1280, height=720, padx=10, pady=10
+            self.root, image=self.camera_frame, width=DISPLAY_SIZE[0], height=DISPLAY_SIZE[1], padx=10, pady=10
         )
         self.camera_feed.pack()
 
@@ -236,19 +353,21 @@ class AdminWindow:
 
         self.btns_frame.pack(side="bottom")
 
+    # runs on the Tk thread: hands finished background work to its callback and shows the latest
+    # preview frame. the capture and conversion happen on PreviewFeed's thread, so all that is left
+    # here is one paste into the PhotoImage the label was given once.
+    # keeps rescheduling without a video feed too, or the buttons would wait forever for their callbacks
     def camera_loop(self):
-        _, frame = self.video_feed.read()
-        if not self.video_feed.isOpened():
-            print("Error: could not open video feed.")
-
-            return
-
-        img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)  # cnverts BGR to RGB
-        img = cv2.resize(img, (1280, 720))
-        img = Image.fromarray(img)  # converts array to image
-        imgTk = ImageTk.PhotoImage(img)  # converts image to tk bitmap
-
-        self.camera_frame = imgTk
-        self.camera_feed.configure(image=imgTk, height=720, width=1280)
-
-        self.camera_feed.after(10, self.camera_loop)
+        while True:
+            try:
+                self.ui_queue.get_nowait()()
+            except queue.Empty:
+                break
+
+        if self.video_feed.isOpened():
+            seq, rgb = self.preview.latest()
+            if seq != self.preview_seq:
+                self.preview_seq = seq
+                self.camera_frame.paste(Image.fromarray(rgb))
+
+        self.camera_feed.after(int(self.preview.interval * 1000), self.camera_loop)
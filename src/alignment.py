@@ -0,0 +1,78 @@
+# landmark alignment of YuNet detections onto SFace's input template
+#
+# the same transform FaceRecognizerSF.alignCrop applies (a least-squares similarity from the five
+# YuNet landmarks to a fixed 112x112 template), but for every face of a frame at once and warped
+# straight from the original frame into one reusable (N, 112, 112, 3) buffer: no slicing, no
+# intermediate resize, no per-face allocation
+
+import cv2
+import numpy as np
+
+
+CROP_SIZE = 112
+
+# where SFace expects right eye, left eye, nose tip, right and left mouth corner (same order as YuNet)
+TEMPLATE = np.array([
+    [38.2946, 51.6963],
+    [73.5318, 51.5014],
+    [56.0252, 71.7366],
+    [41.5493, 92.3655],
+    [70.7299, 92.2041],
+], dtype=np.float64)
+
+LANDMARK_COLS = slice(4, 14)
+
+
+# (N, 2, 3) affine matrices mapping each set of 5 landmarks onto TEMPLATE (Umeyama's method)
+def similarity_transforms(landmarks: np.ndarray, template=TEMPLATE) -> np.ndarray:
+    src = landmarks.reshape(-1, 5, 2).astype(np.float64)
+
+    src_mean = src.mean(axis=1, keepdims=True)
+    dst_mean = template.mean(axis=0)
+    src_c = src - src_mean
+    dst_c = template - dst_mean
+
+    src_var = (src_c ** 2).sum(axis=(1, 2)) / 5
+    cov = np.einsum("ki,nkj->nij", dst_c, src_c) / 5
+
+    U, S, Vt = np.linalg.svd(cov)
+
+    # no reflections
+    d = np.sign(np.linalg.det(U) * np.linalg.det(Vt))
+    D = np.ones((len(src), 2))
+    D[:, 1] = d
+
+    R = np.einsum("nij,nj,njk->nik", U, D, Vt)
+    scale = (S * D).sum(axis=1) / np.maximum(src_var, 1e-12)
+
+    M = np.empty((len(src), 2, 3))
+    M[:, :, :2] = scale[:, None, None] * R
+    M[:, :, 2] = dst_mean - np.einsum("nij,nj->ni", M[:, :, :2], src_mean[:, 0])
+
+    return M
+
+
+class FaceAligner:
+    def __init__(self, capacity=16) -> None:
+        self._buf = np.empty((capacity, CROP_SIZE, CROP_SIZE, 3), dtype=np.uint8)
+
+    # the first n rows of the buffer, grown (keeping the rows written so far) when needed
+    def buffer(self, n: int) -> np.ndarray:
+        if n > len(self._buf):
+            grown = np.empty((max(n, 2 * len(self._buf)), CROP_SIZE, CROP_SIZE, 3), dtype=np.uint8)
+            grown[:len(self._buf)] = self._buf
+            self._buf = grown
+
+        return self._buf[:n]
+
+    # aligned BGR crops of the YuNet rows `dets` from `frame`, as a view of the internal buffer from
+    # row offset on: valid until the next call that writes there, so embed them before aligning the
+    # next frame (or align several frames at increasing offsets and embed buffer(total) at once)
+    def align(self, frame: np.ndarray, dets, offset=0) -> np.ndarray:
+        dets = np.asarray(dets).reshape(-1, 15)
+        crops = self.buffer(offset + len(dets))[offset:]
+
+        for i, M in enumerate(similarity_transforms(dets[:, LANDMARK_COLS])):
+            cv2.warpAffine(frame, M, (CROP_SIZE, CROP_SIZE), dst=crops[i], flags=cv2.INTER_LINEAR)
+
+        return crops
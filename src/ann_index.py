@@ -0,0 +1,203 @@
+# approximate nearest-neighbour index (IVF) over SFace embeddings, pure numpy
+#
+# embeddings are split into nlist inverted lists by their nearest k-means centroid;
+# a query only scans the nprobe lists whose centroids are closest to it
+
+import threading
+
+import numpy as np
+
+from gallery import Gallery, Matcher, NORM_L2, locked, normalize, to_distance, top_k
+from quantized import PRECISIONS, QuantizedGallery
+from shards import ShardedGallery
+
+
+# spherical k-means on unit vectors; returns (nlist, dim) unit centroids
+def train_centroids(embs: np.ndarray, nlist: int, iters=10, seed=0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+
+    centroids = embs[rng.choice(len(embs), nlist, replace=False)].copy()
+
+    for _ in range(iters):
+        assign = np.argmax(embs @ centroids.T, axis=1)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, embs)
+        counts = np.bincount(assign, minlength=nlist)
+
+        # re-seed empty clusters from random points so no list stays unused
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = embs[rng.choice(len(embs), int(empty.sum()), replace=False)]
+
+        centroids = normalize(sums)
+
+    return centroids
+
+
+class IVFIndex(Matcher):
+    def __init__(self, disType=NORM_L2, threshold=None, nlist=None, nprobe=16, dim=128) -> None:
+        self._exact = Gallery(disType, threshold, dim)  # holds the thresholds; holds the rows only while untrained
+
+        self.disType = self._exact.disType
+        self.threshold = self._exact.threshold
+        self.dim = dim
+        self.lock = threading.RLock()
+
+        self.nlist = nlist  # None picks ~sqrt(N) at training time
+        self.nprobe = nprobe
+
+        self.centroids = None
+        self._lists = [self._exact]
+        self._assign = {}  # id -> list number
+        self._trained_size = 0
+
+    def __len__(self) -> int:
+        return len(self._assign)
+
+    def __contains__(self, faceID) -> bool:
+        return faceID in self._assign
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    # replaces the index with the encodings returned by Database.fetch_encodings() {id:encoding}
+    def load(self, encodings: dict) -> "IVFIndex":
+        ids = list(encodings.keys()) if encodings else []
+        embs = np.vstack([np.ravel(encodings[i]) for i in ids]) if ids else np.empty((0, self.dim), np.float32)
+
+        return self.load_matrix(ids, embs)
+
+    # replaces the index with Database.fetch_encoding_matrix() output: ids and one (N, dim) matrix
+    @locked
+    def load_matrix(self, ids: list, embs: np.ndarray) -> "IVFIndex":
+        self._exact = Gallery(self.disType, self.threshold, self.dim).load_matrix(ids, embs)
+        self._lists = [self._exact]
+        self._assign = {faceID: 0 for faceID in self._exact.ids}
+        self.centroids = None
+
+        self.rebuild()
+
+        return self
+
+    # snapshots are clustered into per-list copies, so unlike Gallery this copies the rows
+    def load_base(self, ids: list, embs: np.ndarray) -> "IVFIndex":
+        return self.load_matrix(ids, np.asarray(embs))
+
+    # (re)clusters every stored embedding; too few rows for clustering keeps a single exact list
+    @locked
+    def rebuild(self) -> None:
+        ids = [faceID for lst in self._lists for faceID in lst.ids]
+        embs = np.vstack([lst.embs for lst in self._lists]) if ids else np.empty((0, self.dim), dtype=np.float32)
+
+        nlist = self.nlist or int(np.sqrt(len(ids)))
+        # k-means needs a few dozen points per centroid to be meaningful
+        if nlist < 2 or len(ids) < 39 * nlist:
+            self.centroids = None
+            self._exact = Gallery(self.disType, self.threshold, self.dim).load_matrix(ids, embs)
+            self._lists = [self._exact]
+            self._assign = {faceID: 0 for faceID in ids}
+            self._trained_size = len(ids)
+            return
+
+        self.centroids = train_centroids(embs, nlist)
+        assign = np.argmax(embs @ self.centroids.T, axis=1)
+
+        # the rows now live in the lists; an untrained copy here would double the memory of the gallery
+        self._exact = Gallery(self.disType, self.threshold, self.dim)
+
+        self._lists = []
+        for lst in range(nlist):
+            rows = np.flatnonzero(assign == lst)
+            self._lists.append(
+                Gallery(self.disType, self.threshold, self.dim).load_matrix([ids[r] for r in rows], embs[rows])
+            )
+
+        self._assign = {faceID: int(lst) for faceID, lst in zip(ids, assign)}
+        self._trained_size = len(ids)
+
+    # adds or replaces one identity; moves it to another list if its nearest centroid changed
+    @locked
+    def upsert(self, faceID, encoding: np.ndarray) -> None:
+        emb = normalize(encoding)
+
+        lst = 0 if self.centroids is None else int(np.argmax(emb @ self.centroids.T))
+
+        old = self._assign.get(faceID)
+        if old is not None and old != lst:
+            self._lists[old].remove(faceID)
+
+        self._lists[lst].upsert(faceID, emb)
+        self._assign[faceID] = lst
+
+        # centroids drift as the gallery grows; recluster once it has doubled since the last training
+        if len(self._assign) >= 2 * max(self._trained_size, 39 * 2):
+            self.rebuild()
+
+    @locked
+    def remove(self, faceID) -> bool:
+        lst = self._assign.pop(faceID, None)
+        if lst is None:
+            return False
+
+        return self._lists[lst].remove(faceID)
+
+    @locked
+    def search(self, probes: np.ndarray, k=1) -> tuple:
+        probes = normalize(probes)
+
+        if self.centroids is None:
+            ids, scores = self._exact.search_scores(probes, k)
+            return ids, to_distance(scores, self.disType)
+
+        nprobe = min(self.nprobe, len(self._lists))
+        coarse = np.argpartition(-(probes @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+
+        # every probe gets k candidate slots per probed list; lists are scanned once for all probes that chose them
+        cand_scores = np.full((len(probes), nprobe * k), -np.inf, dtype=np.float32)
+        cand_lists = np.zeros((len(probes), nprobe * k), dtype=np.int64)
+        cand_rows = np.zeros((len(probes), nprobe * k), dtype=np.int64)
+
+        for lst in np.unique(coarse):
+            gallery = self._lists[lst]
+            if len(gallery) == 0:
+                continue
+
+            pi, pj = np.nonzero(coarse == lst)
+            scores = probes[pi] @ gallery.embs.T
+            idx = top_k(scores, k)
+
+            slots = pj[:, None] * k + np.arange(idx.shape[1])
+            cand_scores[pi[:, None], slots] = np.take_along_axis(scores, idx, axis=1)
+            cand_lists[pi[:, None], slots] = lst
+            cand_rows[pi[:, None], slots] = idx
+
+        best = top_k(cand_scores, min(k, len(self._assign)))
+        best_scores = np.take_along_axis(cand_scores, best, axis=1)
+        best_lists = np.take_along_axis(cand_lists, best, axis=1)
+        best_rows = np.take_along_axis(cand_rows, best, axis=1)
+
+        ids = np.empty(best.shape, dtype=object)
+        ids[:] = [
+            [self._lists[l].id_at(r) if s > -np.inf else None for l, r, s in zip(*row)]
+            for row in zip(best_lists, best_rows, best_scores)
+        ]
+
+        return ids, to_distance(best_scores, self.disType)
+
+
+# builds the matcher used for recognition; "exact" scans the whole gallery, "ivf" is approximate,
+# "float16"/"int8" scan compressed codes and re-rank exactly (quantized.py), "sharded" searches the
+# shard processes of a running gallery service (shards.py)
+def make_index(kind="exact", disType=NORM_L2, **kwargs) -> Matcher:
+    if kind == "exact":
+        return Gallery(disType, **kwargs)
+    elif kind == "ivf":
+        return IVFIndex(disType, **kwargs)
+    elif kind in PRECISIONS:
+        return QuantizedGallery(disType, precision=kind, **kwargs)
+    elif kind == "sharded":
+        return ShardedGallery(disType=disType, **kwargs)
+
+    raise ValueError("unknown index kind: {}".format(kind))
@@ -0,0 +1,266 @@
+# offline recognition over recorded video files
+#
+# every file is cut into chunks of --chunk-seconds; a pool of worker processes takes one chunk at a
+# time, seeks to its first frame once and reads on from there, only processing every --stride-th frame.
+# the frames in between are grab()bed: still decoded, but never converted to BGR or inferred. a stride
+# of --seek-stride or more seeks to each processed frame instead, which decodes only from the keyframe
+# before it, so large strides also save the decoding. within a chunk faces are tracked, so a face is embedded once per track rather than per frame.
+# the timeline goes to a JSON-lines file, one line per frame or one per track.
+# run e.g. `python src/batch_video.py lobby.mp4 gate.mp4 --workers 8 --timeline tracks -o timeline.jsonl`
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import time
+
+from collections import Counter
+
+import cv2
+import numpy as np
+
+import runtime_config
+import snapshot
+from alignment import FaceAligner
+from camera import crop_face_box
+from database import Database
+from detection import AdaptiveDetector
+from gallery import Gallery
+from sface import SFace
+from tracker import FaceTracker
+from yunet import YuNet
+
+from dotenv import load_dotenv
+
+
+# per-process state of a pool worker, set by _init_worker
+_worker = {}
+
+# strides from which the frames in between are skipped by seeking rather than decoded with grab(): a seek
+# decodes from the keyframe before its target, and encoders commonly put keyframes up to 250 frames apart
+SEEK_STRIDE = 250
+
+
+def _init_worker(fd_model_path: str, fr_model_path: str, snapshot_path, ids: list, encodings,
+                 detect_scale: float, full_frame_every: int, fd_target=(0, 0), fr_target=(0, 0)) -> None:
+    _worker["models"] = (fd_model_path, fd_target, detect_scale, full_frame_every)
+    _worker["frecogi_model"] = SFace(modelPath=fr_model_path, disType=1, backendId=fr_target[0], targetId=fr_target[1])
+    _worker["aligner"] = FaceAligner()
+    _worker["gallery"] = snapshot.load_worker_gallery(Gallery(disType=1), snapshot_path, ids, encodings)
+
+
+# frames [start, end) of one file; returns (job, per-frame records, frames processed, seconds spent)
+def _process_chunk(job: tuple) -> tuple:
+    path, chunk, start, end, stride, seek_stride = job
+    began = time.perf_counter()
+
+    fd_model_path, fd_target, detect_scale, full_frame_every = _worker["models"]
+    # a fresh detector and tracker per chunk: nothing carries over from the previous chunk's frames
+    detector = AdaptiveDetector(
+        YuNet(modelPath=fd_model_path, confThreshold=0.8, backendId=fd_target[0], targetId=fd_target[1]),
+        scale=detect_scale, full_frame_every=full_frame_every,
+    )
+    tracker = FaceTracker(max_missed=max(5 // stride, 1), reverify_every=max(15 // stride, 1))
+
+    vid_stream = cv2.VideoCapture(path)
+    fps = vid_stream.get(cv2.CAP_PROP_FPS) or 25.0
+    vid_stream.set(cv2.CAP_PROP_POS_FRAMES, start)
+
+    records = []
+    decoded = 0
+
+    for frame_no in range(start, end, stride):
+        if frame_no > start:
+            if stride >= seek_stride:
+                vid_stream.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
+            elif not all(vid_stream.grab() for _ in range(stride - 1)):
+                break
+
+        hasFrame, frame = vid_stream.read()
+        if not hasFrame:
+            break
+        decoded += 1
+
+        tracks = tracker.update(detector.detect(frame))
+        _, stale = tracker.split(tracks)
+
+        if stale:
+            crops = _worker["aligner"].align(frame, [track.det for track in stale])
+            embs = _worker["frecogi_model"].infer_aligned(crops)
+
+            for track, (faceID, dist, is_recognised) in zip(stale, _worker["gallery"].match(embs)):
+                track.set_identity(faceID if is_recognised else None, dist, is_recognised)
+
+        records.append({
+            "frame": frame_no,
+            "time": frame_no / fps,
+            "faces": [
+                {
+                    "track": "{}-{}".format(chunk, track.track_id),
+                    "box": [int(v) for v in crop_face_box(track.det)],
+                    "id": track.name,
+                    "dist": None if np.isnan(track.dist) else round(float(track.dist), 4),
+                }
+                for track in tracks
+            ],
+        })
+
+    vid_stream.release()
+
+    return job, records, decoded, time.perf_counter() - began
+
+
+# (path, chunk number, first frame, end frame, stride, seek stride) for every chunk of every file
+def make_jobs(paths: list, chunk_seconds: float, stride: int, seek_stride=SEEK_STRIDE) -> list:
+    jobs = []
+
+    for path in paths:
+        vid_stream = cv2.VideoCapture(path)
+        if not vid_stream.isOpened():
+            print("cannot open {}".format(path))
+            continue
+
+        frames = int(vid_stream.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = vid_stream.get(cv2.CAP_PROP_FPS) or 25.0
+        vid_stream.release()
+
+        step = max(int(chunk_seconds * fps), stride)
+        for chunk, start in enumerate(range(0, frames, step)):
+            jobs.append((path, chunk, start, min(start + step, frames), stride, seek_stride))
+
+    return jobs
+
+
+# one line per track of a chunk: who it was (most frequent identity) and from when to when
+def track_segments(path: str, records: list) -> list:
+    segments = {}
+
+    for record in records:
+        for face in record["faces"]:
+            segment = segments.setdefault(face["track"], {
+                "video": path, "track": face["track"], "start": record["time"], "frames": 0, "ids": Counter(),
+            })
+            segment["end"] = record["time"]
+            segment["frames"] += 1
+            if face["id"] is not None:
+                segment["ids"][face["id"]] += 1
+
+    result = []
+    for segment in segments.values():
+        ids = segment.pop("ids")
+        segment["id"] = ids.most_common(1)[0][0] if ids else None
+        result.append(segment)
+
+    return sorted(result, key=lambda s: s["start"])
+
+
+# runtime is a runtime_config.RuntimeConfig (model files and backends); chosen from .env when None
+def run(paths: list, myDB, output: str, workers=None, chunk_seconds=60.0, stride=1, timeline="tracks",
+        detect_scale=0.5, full_frame_every=10, snapshot_path=snapshot.SNAPSHOT_PATH, runtime=None,
+        seek_stride=SEEK_STRIDE) -> dict:
+    workers = workers or os.cpu_count() or 1
+    runtime = runtime or runtime_config.select()
+
+    jobs = make_jobs(paths, chunk_seconds, stride, seek_stride)
+    print("{} file(s) in {} chunk(s) of {}s on {} worker(s)".format(len(paths), len(jobs), chunk_seconds, workers))
+
+    snapshot_path, ids, encodings, _ = snapshot.worker_rows(myDB, snapshot_path)
+    names = {}
+
+    pool = mp.get_context("spawn").Pool(
+        workers, initializer=_init_worker,
+        initargs=(runtime.fd_model_path, runtime.fr_model_path, snapshot_path, ids, encodings, detect_scale, full_frame_every,
+                  runtime.fd_target, runtime.fr_target),
+    )
+
+    covered = decoded = 0
+    busy = 0.0
+    start = time.perf_counter()
+
+    try:
+        with open(output, "w") as f:
+            # imap keeps chunks in order, so the timeline comes out sorted by file and time
+            for (path, chunk, first, end, _, _), records, chunk_decoded, seconds in pool.imap(_process_chunk, jobs):
+                covered += end - first
+                decoded += chunk_decoded
+                busy += seconds
+
+                lines = [dict(record, video=path) for record in records] if timeline == "frames" else track_segments(path, records)
+
+                # names for the timeline; looked up once per identity
+                new_ids = {face_id for face_id in iter_ids(lines) if face_id not in names}
+                if new_ids:
+                    names.update({
+                        faceID: "{} {}".format(first_name, last_name)
+                        for faceID, (first_name, last_name, _) in myDB.fetch_identities(new_ids).items()
+                    })
+                add_names(lines, names)
+
+                for line in lines:
+                    f.write(json.dumps(line) + "\n")
+
+    finally:
+        pool.terminate()
+        pool.join()
+
+    elapsed = time.perf_counter() - start
+
+    report = {
+        "frames_covered": covered,
+        "frames_decoded": decoded,
+        "seconds": elapsed,
+        "fps": decoded / elapsed if elapsed else 0.0,
+        "fps_per_core": decoded / busy if busy else 0.0,
+    }
+    print("{frames_decoded} of {frames_covered} frame(s) processed in {seconds:.1f}s: "
+          "{fps:.1f} frames/sec, {fps_per_core:.1f} frames/sec per core".format(**report))
+    print("Timeline written to {}".format(output))
+
+    return report
+
+
+def iter_ids(lines: list):
+    for line in lines:
+        if "faces" in line:
+            for face in line["faces"]:
+                if face["id"] is not None:
+                    yield face["id"]
+        elif line["id"] is not None:
+            yield line["id"]
+
+
+def add_names(lines: list, names: dict) -> None:
+    for line in lines:
+        for item in line.get("faces", [line]):
+            item["name"] = names.get(item["id"]) if item["id"] is not None else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Face recognition over recorded video files")
+    parser.add_argument("videos", nargs="+")
+    parser.add_argument("-o", "--output", default="timeline.jsonl")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--chunk-seconds", type=float, default=60.0, help="length of the range one worker takes at a time")
+    parser.add_argument("--stride", type=int, default=1, help="process every n-th frame")
+    parser.add_argument("--seek-stride", type=int, default=SEEK_STRIDE,
+                        help="strides from which skipped frames are sought past instead of decoded")
+    parser.add_argument("--timeline", choices=("tracks", "frames"), default="tracks")
+    parser.add_argument("--detect-scale", type=float, default=0.5)
+    parser.add_argument("--full-frame-every", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    myDB = Database(
+        os.getenv("USER_NAME"), os.getenv("PASSWORD"),
+        os.getenv("DATABASE_NAME"), os.getenv("PORT_NUMBER")
+    )
+
+    try:
+        run(args.videos, myDB, args.output, args.workers, args.chunk_seconds, args.stride, args.timeline,
+            args.detect_scale, args.full_frame_every, seek_stride=args.seek_stride)
+    finally:
+        myDB.close_conn()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,521 @@
+# offline benchmarks for the recognition hot paths; run e.g. `python src/benchmark.py ann --size 100000`
+#
+# every subcommand prints a table and, with --output FILE, writes its rows as JSON together with the
+# git commit, OpenCV/NumPy versions and CPU, so runs on different commits can be diffed
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from gallery import Gallery, normalize
+from ann_index import IVFIndex
+from quantized import PRECISIONS, QuantizedGallery
+from shards import ShardedGallery, start_local_shards
+from sface import SFace, aligned_blob
+from yunet import YuNet
+from detection import AdaptiveDetector
+from tracker import FaceTracker, iou_matrix
+from camera import crop_face
+from alignment import FaceAligner, TEMPLATE
+
+
+FD_MODEL_PATH = "model/face_detection_yunet_2023mar.onnx"
+FR_MODEL_PATH = "model/face_recognition_sface_2021dec.onnx"
+
+
+# random unit embeddings standing in for enrolled SFace encodings {id:encoding}
+def synthetic_encodings(n: int, dim=128, seed=0) -> dict:
+    rng = np.random.default_rng(seed)
+    embs = normalize(rng.standard_normal((n, dim), dtype=np.float32))
+
+    return {"ID{:07d}".format(i): embs[i] for i in range(n)}
+
+
+# probes are noisy copies of enrolled rows, like a fresh capture of a registered face
+def synthetic_probes(encodings: dict, n: int, noise=0.05, seed=1) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    embs = np.vstack(list(encodings.values()))
+
+    rows = rng.choice(len(embs), n, replace=len(embs) < n)
+    probes = embs[rows] + noise * rng.standard_normal((n, embs.shape[1]), dtype=np.float32)
+
+    return normalize(probes)
+
+
+# random (N, dim) unit matrix; cheaper than synthetic_encodings for million-row galleries
+def synthetic_matrix(n: int, dim=128, seed=0) -> np.ndarray:
+    return normalize(np.random.default_rng(seed).standard_normal((n, dim), dtype=np.float32))
+
+
+# mean seconds per call of fn over repeats, after one warm-up call
+def time_it(fn, repeats=5) -> float:
+    fn()
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+
+    return (time.perf_counter() - start) / repeats
+
+
+# recall@k and per-probe latency of IVFIndex against the exact Gallery
+def bench_ann(size: int, probes=256, k=1, nprobes=(1, 4, 8, 16, 32)) -> list:
+    encodings = synthetic_encodings(size)
+    queries = synthetic_probes(encodings, probes)
+
+    exact = Gallery().load(encodings)
+    truth, _ = exact.search(queries, k)
+    exact_latency = time_it(lambda: exact.search(queries, k)) / probes
+
+    start = time.perf_counter()
+    ivf = IVFIndex().load(encodings)
+    build_time = time.perf_counter() - start
+
+    print("gallery size: {}, lists: {}, build: {:.2f}s".format(size, len(ivf._lists), build_time))
+    print("exact: {:.3f} ms/probe".format(exact_latency * 1e3))
+
+    rows = []
+    for nprobe in nprobes:
+        ivf.nprobe = nprobe
+
+        found, _ = ivf.search(queries, k)
+        recall = np.mean([len(set(found[i]) & set(truth[i])) / k for i in range(probes)])
+        latency = time_it(lambda: ivf.search(queries, k)) / probes
+
+        rows.append({"nprobe": nprobe, "recall": float(recall), "ms_per_probe": latency * 1e3})
+        print("ivf nprobe={:3d}: recall@{} {:.3f}, {:.3f} ms/probe".format(nprobe, k, recall, latency * 1e3))
+
+    return rows
+
+
+# memory per identity, accuracy against the float32 gallery and latency of the float16/int8 galleries;
+# probes are noisier than bench_ann's (cosine ~0.65 to their row, about a real same-person SFace pair)
+# every gallery is loaded from a memory-mapped snapshot, as cameras load it (snapshot.py); bytes/identity is the
+# memory private to the process (Gallery.resident_bytes), the mapped float32 rows being shared page cache.
+# loaded from the database instead, the float32 rows are private as well (bytes_per_identity_db)
+def bench_quant(size: int, probes=256, reranks=(0, 4, 16), noise=0.1) -> list:
+    encodings = synthetic_encodings(size)
+    queries = synthetic_probes(encodings, probes, noise=noise)
+
+    ids = list(encodings.keys())
+    matrix = np.vstack([encodings[i] for i in ids])
+
+    with tempfile.TemporaryDirectory() as path:
+        np.save(os.path.join(path, "embeddings.npy"), matrix)
+        mapped = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+
+        exact = Gallery(disType=1).load_base(ids, mapped)
+        truth, truth_dists = exact.search(queries, 1)
+        truth_match = exact.is_match(truth_dists[:, 0])
+        exact_latency = time_it(lambda: exact.search(queries, 1)) / probes
+
+        print("gallery size: {}, float32 from snapshot: {:.0f} bytes/identity ({} shared), {:.3f} ms/probe".format(
+            size, exact.resident_bytes / size, 4 * exact.dim, exact_latency * 1e3))
+
+        rows = []
+        for precision in PRECISIONS:
+            from_db = QuantizedGallery(disType=1, precision=precision).load_matrix(ids, matrix).resident_bytes / size
+            gallery = QuantizedGallery(disType=1, precision=precision).load_base(ids, mapped)
+
+            for rerank in reranks:
+                gallery.rerank = rerank
+
+                found, dists = gallery.search(queries, 1)
+                latency = time_it(lambda: gallery.search(queries, 1)) / probes
+
+                row = {
+                    "precision": precision,
+                    "rerank": rerank,
+                    "bytes_per_identity": gallery.resident_bytes / size,
+                    "bytes_per_identity_db": from_db,
+                    "recall": float(np.mean(found[:, 0] == truth[:, 0])),
+                    "max_dist_error": float(np.abs(dists[:, 0] - truth_dists[:, 0]).max()),
+                    "decision_agreement": float(np.mean(gallery.is_match(dists[:, 0]) == truth_match)),
+                    "ms_per_probe": latency * 1e3,
+                }
+                rows.append(row)
+                print("{precision:>7} rerank={rerank:2d}: {bytes_per_identity:.0f} bytes/identity "
+                      "({bytes_per_identity_db:.0f} from the database), recall@1 {recall:.4f}, "
+                      "max distance error {max_dist_error:.5f}, same decision {decision_agreement:.4f}, "
+                      "{ms_per_probe:.3f} ms/probe".format(**row))
+
+        # the mapped file can only be removed once nothing references it
+        del exact, gallery, mapped
+
+    return rows
+
+
+# scatter-gather search over local shard processes against one in-process gallery, then the cost of
+# adding a shard (how many identities move); everything runs on localhost
+def bench_shards(size: int, shards=4, probes=64, port=7400) -> dict:
+    encodings = synthetic_encodings(size)
+    queries = synthetic_probes(encodings, probes)
+
+    exact = Gallery(disType=1).load(encodings)
+    truth, _ = exact.search(queries, 5)
+    exact_latency = time_it(lambda: exact.search(queries, 1)) / probes
+
+    addresses = ["127.0.0.1:{}".format(port + i) for i in range(shards + 1)]
+    processes = start_local_shards(addresses, authkey=b"benchmark")
+
+    try:
+        gallery = ShardedGallery(addresses[:shards], disType=1, authkey=b"benchmark", owner=True)
+
+        start = time.perf_counter()
+        gallery.load(encodings)
+        load_time = time.perf_counter() - start
+
+        found, _ = gallery.search(queries, 5)
+        latency = time_it(lambda: gallery.search(queries, 1)) / probes
+
+        start = time.perf_counter()
+        moved = gallery.add_shard(addresses[shards])
+        rebalance_time = time.perf_counter() - start
+
+        found_after, _ = gallery.search(queries, 5)
+
+        row = {
+            "size": size,
+            "shards": shards,
+            "load_seconds": load_time,
+            "same_top5": bool((found == truth).all()),
+            "ms_per_probe": latency * 1e3,
+            "single_process_ms_per_probe": exact_latency * 1e3,
+            "moved_on_add": moved,
+            "rebalance_seconds": rebalance_time,
+            "same_top5_after_add": bool((found_after == truth).all()),
+            "shard_sizes": gallery.sizes(),
+        }
+        gallery.close()
+
+    finally:
+        for process in processes:
+            process.terminate()
+
+    print("{size} faces on {shards} shard(s): loaded in {load_seconds:.1f}s, {ms_per_probe:.3f} ms/probe "
+          "(one process: {single_process_ms_per_probe:.3f}), top-5 identical: {same_top5}".format(**row))
+    print("adding a shard moved {moved_on_add} faces in {rebalance_seconds:.2f}s, sizes now {shard_sizes}, "
+          "top-5 identical: {same_top5_after_add}".format(**row))
+
+    return row
+
+
+# faces/sec of one SFace.infer call per face against one SFace.infer_batch call per frame
+def bench_faces(model_path: str, faces_per_frame=(1, 8, 32), repeats=5) -> list:
+    model = SFace(modelPath=model_path, disType=1)
+    rng = np.random.default_rng(0)
+
+    rows = []
+    for n in faces_per_frame:
+        crops = [rng.integers(0, 256, (112, 112, 3), dtype=np.uint8) for _ in range(n)]
+
+        per_face = time_it(lambda: [model.infer(crop) for crop in crops], repeats)
+        batched = time_it(lambda: model.infer_batch([(crop, None) for crop in crops]), repeats)
+
+        rows.append({"faces": n, "per_face_fps": n / per_face, "batched_fps": n / batched})
+        print("{:3d} faces/frame: per-face {:8.1f} faces/sec, batched {:8.1f} faces/sec".format(
+            n, n / per_face, n / batched))
+
+    return rows
+
+
+# synthetic YuNet rows: faces of 80-200 pixels with template-shaped landmarks, somewhere inside a w x h frame
+def synthetic_detections(n: int, w: int, h: int, seed=0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    size = rng.uniform(80, 200, n)
+    x = rng.uniform(0, w - size)
+    y = rng.uniform(0, h - size)
+
+    dets = np.zeros((n, 15), dtype=np.float32)
+    dets[:, 0], dets[:, 1], dets[:, 2], dets[:, 3] = x, y, size, size
+    dets[:, 4:14] = (TEMPLATE.ravel()[None] / 112 * size[:, None] + np.tile(np.c_[x, y], 5)).astype(np.float32)
+    dets[:, 14] = 0.9
+
+    return dets
+
+
+# faces/sec from YuNet rows to SFace's input blob: slicing + resizing every box (the old path) against
+# warping aligned crops straight into FaceAligner's buffer; the forward pass itself is the same for both
+def bench_align(source=None, faces_per_frame=(1, 8, 32), repeats=50) -> list:
+    frame = read_frames(source, 1)[0] if source is not None else None
+    if frame is None:
+        frame = np.random.default_rng(0).integers(0, 256, (720, 1280, 3), dtype=np.uint8)
+
+    h, w = frame.shape[:2]
+    aligner = FaceAligner()
+
+    def crop_blob(dets):
+        crops = [crop_face(frame, det)[1] for det in dets]
+        return cv2.dnn.blobFromImages(crops, 1.0, (112, 112), (0, 0, 0), swapRB=True, crop=False)
+
+    rows = []
+    for n in faces_per_frame:
+        dets = synthetic_detections(n, w, h)
+        blob = np.empty((n, 3, 112, 112), dtype=np.float32)
+
+        cropped = time_it(lambda: crop_blob(dets), repeats)
+        aligned = time_it(lambda: aligned_blob(aligner.align(frame, dets), blob), repeats)
+
+        rows.append({"faces": n, "crop_fps": n / cropped, "align_fps": n / aligned})
+        print("{:3d} faces/frame: crop+resize {:9.1f} faces/sec, aligned {:9.1f} faces/sec".format(
+            n, n / cropped, n / aligned))
+
+    return rows
+
+
+# first `frames` frames of a video file or camera index, held in memory so decoding isn't timed
+def read_frames(source, frames: int) -> list:
+    vid_stream = cv2.VideoCapture(int(source) if str(source).isnumeric() else source)
+
+    result = []
+    while len(result) < frames:
+        hasFrame, frame = vid_stream.read()
+        if not hasFrame:
+            break
+        result.append(frame)
+
+    vid_stream.release()
+
+    return result
+
+
+# fps and accuracy of AdaptiveDetector settings against YuNet on every full-resolution frame;
+# recall is the share of reference faces found with IoU >= 0.5, precision the share of found faces that match one
+def bench_detect(source, model_path: str, frames=300, scales=(1.0, 0.75, 0.5, 0.25), intervals=(1, 5, 10)) -> list:
+    clip = read_frames(source, frames)
+    if not clip:
+        print("no frames from {}".format(source))
+        return []
+
+    print("{} frame(s) of {}x{}".format(len(clip), clip[0].shape[1], clip[0].shape[0]))
+
+    def run(scale, interval):
+        detector = AdaptiveDetector(YuNet(modelPath=model_path, confThreshold=0.8), scale=scale, full_frame_every=interval)
+        detector.detect(clip[0])  # warm-up
+        detector.last = detector.last[:0]
+
+        start = time.perf_counter()
+        results = [detector.detect(frame) for frame in clip]
+
+        return results, len(clip) / (time.perf_counter() - start), detector.counters
+
+    reference, _, _ = run(1.0, 1)
+
+    rows = []
+    for scale in scales:
+        for interval in intervals:
+            results, fps, counters = run(scale, interval)
+
+            matched = found = total = 0
+            for ref, dets in zip(reference, results):
+                total += len(ref)
+                found += len(dets)
+                if len(ref) and len(dets):
+                    matched += int((iou_matrix(ref[:, 0:4], dets[:, 0:4]).max(axis=1) >= 0.5).sum())
+
+            recall = matched / total if total else 1.0
+            precision = matched / found if found else 1.0
+
+            rows.append({
+                "scale": scale, "full_frame_every": interval, "fps": fps, "recall": recall,
+                "precision": precision, "megapixels_per_frame": counters["pixels"] / len(clip) / 1e6,
+            })
+            print("scale {:.2f}, full frame every {:2d}: {:7.1f} fps, recall {:.3f}, precision {:.3f}, {:.2f} MP/frame".format(
+                scale, interval, fps, recall, precision, counters["pixels"] / len(clip) / 1e6))
+
+    return rows
+
+
+# detection latency of YuNet at each input size, on frames of source (resized) or on noise
+def bench_yunet(model_path: str, source=None, sizes=((320, 240), (640, 480), (1280, 720), (1920, 1080)), repeats=20) -> list:
+    clip = read_frames(source, repeats) if source is not None else []
+    rng = np.random.default_rng(0)
+
+    model = YuNet(modelPath=model_path, confThreshold=0.8)
+
+    rows = []
+    for w, h in sizes:
+        if clip:
+            frames = [cv2.resize(frame, (w, h)) for frame in clip]
+        else:
+            frames = [rng.integers(0, 256, (h, w, 3), dtype=np.uint8)]
+
+        model.setInputSize([w, h])
+        frame_cycle = itertools.cycle(frames)
+        latency = time_it(lambda: model.infer(next(frame_cycle)), repeats)
+
+        rows.append({"width": w, "height": h, "ms": latency * 1e3, "fps": 1 / latency})
+        print("yunet {:4d}x{:<4d}: {:7.2f} ms, {:7.1f} fps".format(w, h, latency * 1e3, 1 / latency))
+
+    return rows
+
+
+# Gallery.match cost from a handful to a million enrolled faces, for one face and a crowded frame
+def bench_match(sizes=(10, 100, 1000, 10000, 100000, 1000000), batches=(1, 8), repeats=20) -> list:
+    rows = []
+
+    for size in sizes:
+        embs = synthetic_matrix(size)
+        gallery = Gallery(disType=1)
+        gallery.load_matrix(["ID{:07d}".format(i) for i in range(size)], embs)
+
+        for batch in batches:
+            probes = synthetic_matrix(batch, seed=1)
+            latency = time_it(lambda: gallery.match(probes), repeats)
+
+            rows.append({"gallery": size, "faces": batch, "ms": latency * 1e3})
+            print("match {:8d} faces x {:2d} probes: {:8.3f} ms".format(size, batch, latency * 1e3))
+
+    return rows
+
+
+# frames/sec of detection + tracking + batched embedding + matching, without the database or a window
+def bench_e2e(source, fd_model_path: str, fr_model_path: str, frames=300, gallery_size=1000) -> dict:
+    clip = read_frames(source, frames) if source is not None else []
+    if not clip:
+        rng = np.random.default_rng(0)
+        clip = [rng.integers(0, 256, (720, 1280, 3), dtype=np.uint8) for _ in range(min(frames, 30))]
+
+    detector = AdaptiveDetector(YuNet(modelPath=fd_model_path, confThreshold=0.8))
+    recognizer = SFace(modelPath=fr_model_path, disType=1)
+    tracker = FaceTracker()
+    aligner = FaceAligner()
+    gallery = Gallery(disType=1)
+    gallery.load_matrix(["ID{:07d}".format(i) for i in range(gallery_size)], synthetic_matrix(gallery_size))
+
+    faces = 0
+    start = time.perf_counter()
+
+    for frame in clip:
+        _, stale = tracker.split(tracker.update(detector.detect(frame)))
+        if stale:
+            crops = aligner.align(frame, [track.det for track in stale])
+            gallery.match(recognizer.infer_aligned(crops))
+            faces += len(stale)
+
+    elapsed = time.perf_counter() - start
+
+    row = {"frames": len(clip), "fps": len(clip) / elapsed, "embedded_faces": faces, "track_hit_rate": tracker.hit_rate()}
+    print("end to end: {} frames at {:.1f} fps, {} face(s) embedded".format(len(clip), row["fps"], faces))
+
+    return row
+
+
+# where and on what a run happened
+def run_info() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "time": datetime.now().isoformat(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+    }
+
+
+def write_results(path: str, results: dict) -> None:
+    with open(path, "w") as f:
+        json.dump({"run": run_info(), "results": results}, f, indent=2)
+
+    print("Results written to {}".format(path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PanOpticon benchmarks")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    ann = sub.add_parser("ann", help="IVF index recall/latency against the exact matcher")
+    ann.add_argument("--size", type=int, default=100000)
+    ann.add_argument("--probes", type=int, default=256)
+    ann.add_argument("-k", type=int, default=1)
+
+    quant = sub.add_parser("quant", help="float16/int8 gallery memory, accuracy and latency against float32")
+    quant.add_argument("--size", type=int, default=100000)
+    quant.add_argument("--probes", type=int, default=256)
+
+    shard = sub.add_parser("shards", help="scatter-gather search over local shard processes, and rebalancing")
+    shard.add_argument("--size", type=int, default=100000)
+    shard.add_argument("--shards", type=int, default=4)
+    shard.add_argument("--port", type=int, default=7400, help="first shard's port on 127.0.0.1")
+
+    faces = sub.add_parser("faces", help="SFace faces/sec, per-face against batched embedding")
+    faces.add_argument("--model", default=FR_MODEL_PATH)
+
+    align = sub.add_parser("align", help="preprocessing faces/sec, box crop against landmark alignment")
+    align.add_argument("--source", help="video file or camera index for the frame; random image without it")
+
+    detect = sub.add_parser("detect", help="YuNet fps/accuracy at reduced resolution and with ROI-only frames")
+    detect.add_argument("source", help="video file or camera index")
+    detect.add_argument("--model", default=FD_MODEL_PATH)
+    detect.add_argument("--frames", type=int, default=300)
+
+    yunet = sub.add_parser("yunet", help="YuNet latency at several input sizes")
+    yunet.add_argument("--source", help="video file or camera index; random images without it")
+    yunet.add_argument("--model", default=FD_MODEL_PATH)
+
+    match = sub.add_parser("match", help="gallery matching cost from 10 to 1M enrolled faces")
+    match.add_argument("--max-size", type=int, default=1000000)
+
+    e2e = sub.add_parser("e2e", help="end-to-end frames/sec without database or window")
+    e2e.add_argument("--source", help="video file or camera index; random images without it")
+    e2e.add_argument("--frames", type=int, default=300)
+
+    suite = sub.add_parser("all", help="yunet, faces, align, match and e2e in one run")
+    suite.add_argument("--source", help="video file or camera index; random images without it")
+
+    args = parser.parse_args()
+
+    results = {}
+
+    if args.bench == "ann":
+        results["ann"] = bench_ann(args.size, args.probes, args.k)
+    elif args.bench == "quant":
+        results["quant"] = bench_quant(args.size, args.probes)
+    elif args.bench == "shards":
+        results["shards"] = bench_shards(args.size, args.shards, port=args.port)
+    elif args.bench == "faces":
+        results["faces"] = bench_faces(args.model)
+    elif args.bench == "align":
+        results["align"] = bench_align(args.source)
+    elif args.bench == "detect":
+        results["detect"] = bench_detect(args.source, args.model, args.frames)
+    elif args.bench == "yunet":
+        results["yunet"] = bench_yunet(args.model, args.source)
+    elif args.bench == "match":
+        results["match"] = bench_match(sizes=[n for n in (10, 100, 1000, 10000, 100000, 1000000) if n <= args.max_size])
+    elif args.bench == "e2e":
+        results["e2e"] = bench_e2e(args.source, FD_MODEL_PATH, FR_MODEL_PATH, args.frames)
+    elif args.bench == "all":
+        results["yunet"] = bench_yunet(FD_MODEL_PATH, args.source)
+        results["faces"] = bench_faces(FR_MODEL_PATH)
+        results["align"] = bench_align(args.source)
+        results["match"] = bench_match()
+        results["e2e"] = bench_e2e(args.source, FD_MODEL_PATH, FR_MODEL_PATH)
+
+    if args.output:
+        write_results(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,17 +9,32 @@ from threading import Event
 
 from database import Database
 from yunet import YuNet
+from alignment import FaceAligner
+from detection import AdaptiveDetector
+from motion import MotionGate
 from sface import SFace
+from ann_index import make_index
+from pipeline import CameraPipeline
+from tracker import FaceTracker
+from identity_cache import IdentityCache
+import metrics
+import snapshot
+from change_feed import GalleryFeed
 
 from dotenv import load_dotenv
 
 
 class Camera():
-    def __init__(self, fd_model_path: str, fr_model_path: str, camera=0) -> None:        
+    def __init__(self, fd_model_path: str, fr_model_path: str, camera=0, index="exact", snapshot_path=snapshot.SNAPSHOT_PATH,
+                 detect_scale=0.5, full_frame_every=10, fd_target=(0, 0), fr_target=(0, 0), motion_gating=True) -> None:        
 
         # load in detection and recognition models
-        self.fdetect_model = YuNet(modelPath=fd_model_path, confThreshold=0.8)
-        self.frecogi_model = SFace(modelPath=fr_model_path, disType=1)
+        # fd_target/fr_target are (backendId, targetId) pairs; see runtime_config.py
+        self.fdetect_model = YuNet(modelPath=fd_model_path, confThreshold=0.8, backendId=fd_target[0], targetId=fd_target[1])
+        self.frecogi_model = SFace(modelPath=fr_model_path, disType=1, backendId=fr_target[0], targetId=fr_target[1])
+        self.gallery = make_index(index, disType=1)  # "exact", "ivf" for very large galleries, or "float16"/"int8" to save memory
+        self.snapshot_path = snapshot_path
+        self.camera = camera
 
         load_dotenv()
 
@@ -27,7 +42,18 @@ class Camera():
             os.getenv("USER_NAME"), os.getenv("PASSWORD"), 
             os.getenv("DATABASE_NAME"), os.getenv("PORT_NUMBER")
         )
+        self.identities = IdentityCache(self.myDB)  # names for labelling, so the loop never queries Faces
         self.loadKnownFaces()
+        self.myDB.attach_index(self.gallery)
+        self.myDB.attach_cache(self.identities)
+
+        # applies enrolments made elsewhere (e.g. AdminWindow) while the camera runs; a remote gallery is
+        # kept current by its owner, and identities it returns that aren't cached are fetched on lookup
+        self.feed = None
+        if not self.gallery.is_remote:
+            self.feed = GalleryFeed(self.gallery, self.myDB, self.watermark)
+            self.feed.listeners.append(self.identities.refresh)
+            self.feed.start()
 
         self.vid_stream = cv2.VideoCapture(camera)
         self.width = int(self.vid_stream.get(cv2.CAP_PROP_FRAME_WIDTH))
@@ -36,17 +62,38 @@ class Camera():
         self.is_on = Event()
         self.is_on.clear()
 
-        self.fdetect_model.setInputSize([self.width, self.height])
+        # YuNet runs on frames shrunk by detect_scale, and between full-frame passes only around known faces
+        self.detector = AdaptiveDetector(self.fdetect_model, scale=detect_scale, full_frame_every=full_frame_every)
 
         self.tm = cv2.TickMeter()
 
-    def camera_loop(self):
-        
+        # tracks faces across frames so a known face is not re-embedded every frame
+        self.tracker = FaceTracker()
+
+        # aligned 112x112 crops for SFace, warped into one buffer reused every frame
+        self.aligner = FaceAligner()
+
+        # skips detection and recognition while the scene is still; None runs them on every frame
+        self.motion = MotionGate() if motion_gating else None
+
+    def camera_loop(self, threaded=True):
+
+        if threaded:
+            # capture, detection and recognition each get a thread; see pipeline.py
+            self.pipeline = CameraPipeline(self)
+            self.pipeline.run()
+            self.stop_feed()
+            self.myDB.close_conn()
+            return
+
         self.is_on.set()
 
+        faces = []
+
         while self.is_on.is_set():
 
-            hasFrame, frame = self.vid_stream.read()
+            with metrics.timer("capture"):
+                hasFrame, frame = self.vid_stream.read()
 
             if not hasFrame:
                 print("no frame :(")
@@ -57,78 +104,203 @@ class Camera():
                 break
 
             self.tm.start()
-            fdetect_results = self.fdetect_model.infer(frame)
+            if self.should_infer(frame):
+                faces = self.recognise(frame, self.detector.detect(frame))
             self.tm.stop()
 
-            frame = self.visualize(frame, fdetect_results, fps=self.tm.getFPS())
+            frame = self.draw(frame, faces, fps=self.tm.getFPS())
 
             cv2.imshow("camera", frame)
 
             self.tm.reset()
-    
+
+        self.stop_feed()
+        self.myDB.close_conn()
+
+    @metrics.timed("verify")
     def verify(self, img) -> tuple:
         name_tag = "?unknown?"
 
-        this_emb = self.frecogi_model.infer(img)
-        
+        with metrics.timer("embed"):
+            this_emb = self.frecogi_model.infer(img)
 
-        for name in self.KnownEmbs:
-        
-            trg_emb = self.KnownEmbs[name]
-            dist, is_recognised = self.frecogi_model.dist(trg_emb, this_emb)
+        with metrics.timer("match"):
+            faceID, dist, is_recognised = self.gallery.match(this_emb)[0]
+
+        if is_recognised:
+            name_tag = self.identities.name(faceID)
 
-            if is_recognised:
-                name_tag = self.myDB.fetchName(name)
-        
         return name_tag, dist, is_recognised
 
+    # identifies every detection; only faces whose track has no trustworthy cached identity
+    # are aligned (straight from the frame, by their landmarks) and embedded, all in one
+    # batched pass. returns [(bbox, name, dist, is_recognised)]
+    def recognise(self, img, results) -> list:
+        tracks = self.tracker.update(results)
+        _, stale = self.tracker.split(tracks)
+
+        metrics.observe("faces_per_frame", len(tracks))
+
+        if stale:
+            with metrics.timer("embed"):
+                embs = self.frecogi_model.infer_aligned(self.aligner.align(img, [track.det for track in stale]))
+
+            with metrics.timer("match"):
+                matches = self.gallery.match(embs)
+
+            for track, (faceID, dist, is_recognised) in zip(stale, matches):
+
+                name = self.identities.name(faceID) if is_recognised else "?unknown?"
+                track.set_identity(name, dist, is_recognised)
+
+                metrics.inc("matches" if is_recognised else "unknown_faces")
+
+                if is_recognised:
+                    # queued, not written here; repeats within the logger's dedupe window are dropped
+                    self.myDB.log_event(faceID, "Seen on camera {}.".format(self.camera), dedupe=True)
+
+        return [
+            (crop_face_box(track.det), track.name, track.dist, track.is_recognised)
+            for track in tracks
+        ]
+
+    def should_infer(self, frame) -> bool:
+        return self.motion is None or self.motion.update(frame)
+
+    def draw(self, output, faces, fps=None) -> np.ndarray:
+        return draw_faces(output, faces, fps=fps)
+
+    # draws onto img itself
     def visualize(self, img, results, fps=None) -> np.ndarray:
-        # adds fps counter and time 
-        # adds bounding boxes and name tags
+        return self.draw(img, self.recognise(img, results), fps=fps)
 
-        output = img.copy()
+    # no window: one record per inferred frame goes to record_sink (sinks.py), and frames are only
+    # drawn on, in place, while one of frame_sinks has a consumer. stops at the end of the stream or on Ctrl+C
+    def headless_loop(self, record_sink, frame_sinks=()) -> None:
+        self.is_on.set()
 
-        for i, det in enumerate(results):
-            
-            bbox = det[0:4].astype(np.int32)
-            x1, y1 = bbox[0], bbox[1]
-            x2, y2 = bbox[0]+bbox[2], bbox[1]+bbox[3]
+        faces = []
+        frame_no = 0
+
+        try:
+            while self.is_on.is_set():
+                with metrics.timer("capture"):
+                    hasFrame, frame = self.vid_stream.read()
 
-            face_img = img[y1:y2, x1:x2]
-            face_img = cv2.resize(face_img, (160,160))
+                if not hasFrame:
+                    print("no frame :(")
+                    break
 
-            name, dist, is_recognised = self.verify(face_img)
+                frame_no += 1
 
-            if is_recognised:
+                self.tm.start()
+                inferred = self.should_infer(frame)
+                if inferred:
+                    faces = self.recognise(frame, self.detector.detect(frame))
+                self.tm.stop()
+
+                if inferred:
+                    record_sink.emit(face_record(self.camera, frame_no, faces))
+
+                consumers = [sink for sink in frame_sinks if sink.active]
+                if consumers:
+                    draw_faces(frame, faces, fps=self.tm.getFPS())
+                    for sink in consumers:
+                        sink.write(frame)
+
+                self.tm.reset()
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            self.vid_stream.release()
+
+            for sink in (record_sink, *frame_sinks):
+                sink.close()
+
+            self.stop_feed()
+            self.myDB.close_conn()
+
+    # maps the local gallery snapshot if there is one and only fetches rows changed since it was exported
+    # stops the gallery feed, if any, and waits for a refresh in progress to finish with the pool
+    def stop_feed(self):
+        if self.feed is not None:
+            self.feed.stop()
+            self.feed.join()
+
+    def loadKnownFaces(self):
+
+        self.watermark = snapshot.load_gallery(self.gallery, self.myDB, self.snapshot_path)
+        self.identities.load()
+
+        print("{} face(s) loaded...".format(len(self.gallery)))
+
+        return self.gallery
+
+
+# adds fps counter and time
+# adds bounding boxes and name tags
+@metrics.timed("draw")
+def draw_faces(output, faces, fps=None) -> np.ndarray:
+
+    for (x1, y1, x2, y2), name, dist, is_recognised in faces:
+
+        if is_recognised:
+
+            cv2.rectangle(output, (x1, y1), (x2, y2), (0,255,0), 2)
+            cv2.putText(output, f"{name} dist: {dist:.2f}", (x1+5,y1-15), 1, 1, (0,255,0))
+
+        else:
+
+            cv2.rectangle(output, (x1, y1), (x2, y2), (0,0,255), 2)
+            cv2.putText(output, f"{name} dist: {dist:.2f}", (x1+5,y1-15), 1, 1, (0,255,255))
+
+    # add time and fps counter
+    curr_time = datetime.now()
+
+    cv2.putText(output, curr_time.strftime("%Y-%m-%d %H:%M:%S"), (5,15), fontFace=1, fontScale=1, color=(0,255,0))
+    cv2.putText(output, f"{fps:.2f} frames/sec", (5,30), fontFace=1, fontScale=1, color=(0,255,0))
+
+    return output
 
-                cv2.rectangle(output, (x1, y1), (x2, y2), (0,255,0), 2)
-                cv2.putText(output, f"{name} dist: {dist:.2f}", (x1+5,y1-15), 1, 1, (0,255,0))
 
-            else:
+# JSON-ready summary of one frame's faces, as written by headless mode
+def face_record(camera, frame_no: int, faces: list) -> dict:
+    return {
+        "camera": camera,
+        "frame": frame_no,
+        "time": datetime.now().isoformat(),
+        "faces": [
+            {
+                "box": [int(x1), int(y1), int(x2), int(y2)],
+                "name": name if is_recognised else None,
+                "dist": None if np.isnan(dist) else round(float(dist), 4),
+                "recognised": bool(is_recognised),
+            }
+            for (x1, y1, x2, y2), name, dist, is_recognised in faces
+        ],
+    }
 
-                cv2.rectangle(output, (x1, y1), (x2, y2), (0,0,255), 2)
-                cv2.putText(output, f"{name} dist: {dist:.2f}", (x1+5,y1-15), 1, 1, (0,255,255))
-                    
-        # add time and fps counter
-        curr_time = datetime.now()
 
-        cv2.putText(output, f"{curr_time.strftime("%Y-%m-%d %H:%M:%S")}", (5,15), fontFace=1, fontScale=1, color=(0,255,0))
-        cv2.putText(output, f"{fps:.2f} frames/sec", (5,30), fontFace=1, fontScale=1, color=(0,255,0))
+# pixel corners (x1, y1, x2, y2) of one YuNet detection
+def crop_face_box(det) -> tuple:
+    bbox = det[0:4].astype(np.int32)
+    x1, y1 = bbox[0], bbox[1]
+    x2, y2 = bbox[0]+bbox[2], bbox[1]+bbox[3]
 
-        return output
+    return x1, y1, x2, y2
 
-    def loadKnownFaces(self) -> dict:
 
-        self.KnownEmbs = dict()
+# cuts one YuNet detection out of the frame; returns ((x1, y1, x2, y2), 160x160 crop)
+def crop_face(img, det) -> tuple:
+    x1, y1, x2, y2 = crop_face_box(det)
 
-        self.KnownEmbs = self.myDB.fetchEncodings()
-        numOfFaces = self.myDB.numOfFaces()
+    face_img = img[y1:y2, x1:x2]
+    face_img = cv2.resize(face_img, (160,160))
 
-        print("{} face(s) loaded...".format(numOfFaces))
-        
-        #print(self.KnownEmbs)
+    return (x1, y1, x2, y2), face_img
 
-        return self.KnownEmbs
 
 def get_avail_cameras() -> list:
 
@@ -0,0 +1,91 @@
+# keeps an in-memory gallery up to date with the Encoding table while the camera keeps running
+#
+# Database.add_new_face/update_mean_encoding send a NOTIFY on CHANGES_CHANNEL; the feed thread
+# LISTENs on its own connection and, on a notification (or every poll_interval seconds, which also
+# covers writers that don't notify), fetches only the rows written since its watermark and upserts them
+
+import select
+import socket
+import threading
+
+import psycopg2
+
+from database import CHANGES_CHANNEL
+
+
+class GalleryFeed(threading.Thread):
+    def __init__(self, gallery, myDB, watermark, poll_interval=5.0, listen=True) -> None:
+        super().__init__(name="gallery-feed", daemon=True)
+
+        self.gallery = gallery
+        self.myDB = myDB
+        self.watermark = watermark
+        self.poll_interval = poll_interval
+        self.listen = listen
+
+        self.listeners = []  # callables taking the list of changed face IDs
+        self.applied = 0
+
+        self._stopped = threading.Event()
+        self._wake, self._waker = socket.socketpair()  # lets stop() interrupt the select below
+
+    # join() afterwards before closing the Database: a refresh may still be using its pool
+    def stop(self) -> None:
+        self._stopped.set()
+
+        try:
+            self._waker.send(b"x")
+        except OSError:
+            pass  # already stopped
+
+    # fetches and applies everything written since the watermark; returns the changed IDs
+    def refresh(self) -> list:
+        ids, encodings, self.watermark = self.myDB.fetch_encodings_since(self.watermark)
+
+        if ids:
+            # the matcher's lock is held for the whole batch, so a search sees all of it or none of it
+            with self.gallery.lock:
+                for faceID, encoding in zip(ids, encodings):
+                    self.gallery.upsert(faceID, encoding)
+
+            self.applied += len(ids)
+
+            for listener in self.listeners:
+                listener(ids)
+
+        return ids
+
+    def run(self) -> None:
+        conn = None
+
+        if self.listen:
+            try:
+                conn = self.myDB.connect()
+                conn.cursor().execute("LISTEN {}".format(CHANGES_CHANNEL))
+            except psycopg2.Error as e:
+                print("gallery feed: LISTEN unavailable, polling every {}s ({})".format(self.poll_interval, e))
+                conn = None
+
+        # rows written between the initial load and LISTEN taking effect
+        self.refresh()
+
+        while not self._stopped.is_set():
+            if conn is None:
+                self._stopped.wait(self.poll_interval)
+            else:
+                select.select([conn, self._wake], [], [], self.poll_interval)
+                conn.poll()
+                conn.notifies.clear()  # one fetch covers any number of notifications
+
+            if self._stopped.is_set():
+                break
+
+            try:
+                self.refresh()
+            except psycopg2.Error as e:
+                print("gallery feed: refresh failed ({})".format(e))
+
+        if conn is not None:
+            conn.close()
+        self._wake.close()
+        self._waker.close()
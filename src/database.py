@@ -4,127 +4,274 @@
 import psycopg2  # make sure to install postgreSQL on your machine
 
 # also make sure your postgreSQL server is running if running locally
-from psycopg2 import sql
-import pickle
+from psycopg2 import extensions, sql
+from psycopg2.extras import execute_batch, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import numpy as np
+import pickle
+import threading
+
+import embedding_format
+from event_logger import EventLogger
+import metrics
+
+
+# NOTIFY channel carrying the face ID of every Encoding row written; see change_feed.py
+CHANGES_CHANNEL = "gallery_changes"
+
+# hot-path queries, PREPAREd once per pooled connection and then run with EXECUTE
+STATEMENTS = {
+    "fetch_name": "SELECT firstName FROM Faces WHERE ID = $1",
+    "fetch_mean_encoding": "SELECT encoding, timesAdded FROM Encoding WHERE ID = $1",
+    "update_mean_encoding": (
+        "UPDATE Encoding SET encoding = $1, timesAdded = timesAdded + 1, timestamp = NOW(), txid = txid_current() WHERE ID = $2"
+    ),
+    "insert_face": "INSERT INTO Faces (ID, firstName, lastName) VALUES ($1, $2, $3)",
+    "insert_encoding": "INSERT INTO Encoding (ID, encoding, timesAdded) VALUES ($1, $2, 1)",
+    "notify_change": "SELECT pg_notify($1, $2)",
+    "fetch_encodings": "SELECT ID, encoding FROM Encoding",
+    "fetch_encodings_since": "SELECT ID, encoding FROM Encoding WHERE txid >= $1",
+    "fetch_watermark": "SELECT txid_snapshot_xmin(txid_current_snapshot())",
+    "fetch_encoding_by_id": "SELECT encoding FROM Encoding WHERE ID = $1",
+    "fetch_identities": "SELECT ID, firstName, lastName, thumbnail FROM Faces WHERE ID = ANY($1)",
+}
+
+
+# pooled connection; remembers which STATEMENTS are prepared on its session
+class PooledConnection(extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.prepared = set()
+        self.release = None  # set while checked out; hands the connection back to the pool
+        self.cursor_factory = PooledCursor
+        self.autocommit = True
+
+
+# closing the cursor returns its connection to the pool; use `with self.cursor() as cursor:` (or close() in a
+# finally) so the connection goes back even when a query raises
+class PooledCursor(extensions.cursor):
+    def close(self):
+        if self.closed:
+            return
+
+        super().close()
+
+        release, self.connection.release = self.connection.release, None
+        if release is not None:
+            release()
+
+    # only a warning: garbage collection may run long after the pool has run out of slots
+    def __del__(self):
+        if not self.closed and self.connection.release is not None:
+            print("database: a cursor was garbage-collected without being closed; its connection is not returned to the pool")
+
+
+# ThreadedConnectionPool closes a returned connection once minconn are idle; this one opens connections
+# lazily but keeps up to maxconn of them, so every connection (and what it has PREPAREd) is reused
+class ConnectionPool(ThreadedConnectionPool):
+    def __init__(self, maxconn, *args, **kwargs):
+        super().__init__(1, maxconn, *args, **kwargs)
+
+        self.minconn = maxconn  # only read by _putconn from here on
 
 
 class Database:
 
     # connects to database
-    def __init__(self, user: str, password: str, database: str, host="localhost"):
+    def __init__(self, user: str, password: str, database: str, host="localhost",
+                 embedding_dtype=np.float32, max_connections=8):
         self.user = user
         self.password = password
         self.database = database
         self.host = host
 
-        self.conn = psycopg2.connect(
-            user=self.user, password=self.password, host=self.host
-        )
-        self.conn.set_session(autocommit=True)
+        self.embedding_dtype = embedding_dtype  # float32, or float16 to halve the size of every Encoding row
 
-        cursor = self.conn.cursor()
+        self.indexes = []  # in-memory matchers kept in sync with the Encoding table
+        self.caches = []  # identity_cache.IdentityCache objects kept in sync with the Faces table
 
-        # checks if this database exists; if not create new
-        cursor.execute(
-            sql.SQL("SELECT 1 FROM pg_catalog.pg_database WHERE datname = %s"),
-            [database],
-        )
-
-        exists = cursor.fetchone()
+        # shared by every thread using this object; cursor() blocks once all connections are checked out
+        self.max_connections = max_connections
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self.pool = self.open_pool()
 
-        if not exists:
-            # ensures no duplicate database is created
+        with self.cursor() as cursor:
+            # checks if this database exists; if not create new
             cursor.execute(
-                sql.SQL("CREATE DATABASE {}").format(sql.Identifier(database))
+                sql.SQL("SELECT 1 FROM pg_catalog.pg_database WHERE datname = %s"),
+                [database],
             )
 
+            exists = cursor.fetchone()
+
+            if not exists:
+                # ensures no duplicate database is created
+                cursor.execute(
+                    sql.SQL("CREATE DATABASE {}").format(sql.Identifier(database))
+                )
+
+        # Events rows are written in batches by a background thread; see event_logger.py
+        self.events = EventLogger(self)
+        self.events.start()
+
+    def open_pool(self) -> ConnectionPool:
+        return ConnectionPool(
+            self.max_connections, user=self.user, password=self.password, host=self.host,
+            connection_factory=PooledConnection,
+        )
+
+    # checks a connection out of the pool; closing the cursor (leaving its `with` block) checks it back in
+    def cursor(self):
+        self._slots.acquire()
+
+        try:
+            conn = self.pool.getconn()
+        except psycopg2.Error:
+            self._slots.release()
+            raise
+
+        def release():
+            self.pool.putconn(conn)
+            self._slots.release()
+
+        conn.release = release
+
+        return conn.cursor()
+
+    # runs one of STATEMENTS as a server-side prepared statement
+    def execute(self, cursor, name: str, params=()) -> None:
+        conn = cursor.connection
+
+        if name not in conn.prepared:
+            cursor.execute("PREPARE {} AS {}".format(name, STATEMENTS[name]))
+            conn.prepared.add(name)
+
+        with metrics.timer("db_" + name):
+            if params:
+                cursor.execute("EXECUTE {} ({})".format(name, ", ".join(["%s"] * len(params))), params)
+            else:
+                cursor.execute("EXECUTE {}".format(name))
+
+    # opens another autocommit connection with the same credentials, e.g. for a LISTEN thread
+    def connect(self):
+        conn = psycopg2.connect(
+            user=self.user, password=self.password, host=self.host
+        )
+        conn.set_session(autocommit=True)
+
+        return conn
+
     # used to initialise tables; otherwise could be used to reset the DB
     def create_tables(self):
-        cursor = self.conn.cursor()
-
-        # deletes table if exists
-        cursor.execute("DROP TABLE IF EXISTS Faces CASCADE")
-        cursor.execute("DROP TABLE IF EXISTS Encoding")
-        cursor.execute("DROP TABLE IF EXISTS Events")
-
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS Faces(
-            ID VARCHAR(8) PRIMARY KEY,
-            firstName VARCHAR(255) NOT NULL,
-            lastName VARCHAR(255) NOT NULL,
-            thumbnail BYTEA
-            )
-            """
-        )  # thumbnail is stored as binary data; could be changed to storing image path rather for bigger model
-
-        # stored encoding is a mean encoding which gets calculated everytime you add a new face for each person
-        cursor.execute(
-            """
-            CREATE TABLE Encoding(
-            ID VARCHAR(8) REFERENCES Faces,
-            encoding BYTEA NOT NULL,
-            timestamp TIMESTAMPTZ DEFAULT NOW(),
-            timesAdded INT
-            )
-            """
-        )  # timesAdded to keep track of how many times the encoding of a person were updated
-
-        cursor.execute(
-            """
-            CREATE TABLE Events(
-            eventID SERIAL PRIMARY KEY,
-            ID VARCHAR(8) REFERENCES Faces,
-            description VARCHAR(255),
-            timestamp TIMESTAMPTZ DEFAULT NOW()
+        self.events.flush()
+
+        with self.cursor() as cursor:
+            # deletes table if exists
+            cursor.execute("DROP TABLE IF EXISTS Faces CASCADE")
+            cursor.execute("DROP TABLE IF EXISTS Encoding")
+            cursor.execute("DROP TABLE IF EXISTS Events")
+
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS Faces(
+                ID VARCHAR(8) PRIMARY KEY,
+                firstName VARCHAR(255) NOT NULL,
+                lastName VARCHAR(255) NOT NULL,
+                thumbnail BYTEA
+                )
+                """
+            )  # thumbnail is stored as binary data; could be changed to storing image path rather for bigger model
+
+            # stored encoding is a mean encoding which gets calculated everytime you add a new face for each person
+            cursor.execute(
+                """
+                CREATE TABLE Encoding(
+                ID VARCHAR(8) REFERENCES Faces,
+                encoding BYTEA NOT NULL,
+                timestamp TIMESTAMPTZ DEFAULT NOW(),
+                timesAdded INT,
+                txid BIGINT NOT NULL DEFAULT txid_current()
+                )
+                """
+            )  # timesAdded to keep track of how many times the encoding of a person were updated
+            # txid is the transaction that last wrote the row, the watermark of fetch_encodings_since
+            cursor.execute("CREATE INDEX encoding_txid ON Encoding (txid)")
+
+            cursor.execute(
+                """
+                CREATE TABLE Events(
+                eventID SERIAL PRIMARY KEY,
+                ID VARCHAR(8) REFERENCES Faces,
+                description VARCHAR(255),
+                timestamp TIMESTAMPTZ DEFAULT NOW()
+                )
+                """
             )
-            """
-        )
 
-        cursor.close()
+        # statements prepared against the dropped tables are invalid now
+        self.pool.closeall()
+        self.pool = self.open_pool()
+
+    # registers a matcher (gallery.Gallery, ann_index.IVFIndex) to receive every encoding this object writes
+    def attach_index(self, index) -> None:
+        if index not in self.indexes:
+            self.indexes.append(index)
+
+    def sync_indexes(self, faceID: str, encoding: np) -> None:
+        for index in self.indexes:
+            index.upsert(faceID, encoding)
+
+    # registers an identity_cache.IdentityCache to be refreshed whenever this object writes a face
+    def attach_cache(self, cache) -> None:
+        if cache not in self.caches:
+            self.caches.append(cache)
+
+    # called with no cursor checked out, as the caches query through the pool
+    def sync_caches(self, faceID: str) -> None:
+        for cache in self.caches:
+            cache.refresh([faceID])
+
+    # tells other processes (change_feed.GalleryFeed) that the encoding of faceID changed
+    def notify_change(self, cursor, faceID: str) -> None:
+        self.execute(cursor, "notify_change", (CHANGES_CHANNEL, faceID))
+
+    # queues a row for the Events table; dedupe=True for sightings that repeat every frame
+    def log_event(self, faceID, description: str, dedupe=False) -> None:
+        self.events.log(faceID, description, dedupe)
 
     # add thumbnail img to row in Faces - called when registering new Face
     def add_thumbnail(self, faceID: str, imgPath: str):
-        cursor = self.conn.cursor()
-
-        cursor.execute(
-            "UPDATE Faces SET thumbnail = %s WHERE ID = %s", (imgPath, faceID)
-        )
+        with self.cursor() as cursor:
+            cursor.execute(
+                "UPDATE Faces SET thumbnail = %s WHERE ID = %s", (imgPath, faceID)
+            )
 
-        print("Successfully added thumbnail!")
+            print("Successfully added thumbnail!")
 
-        cursor.close()
+        self.sync_caches(faceID)
 
     # calculate the mean encoding and update Encoding table
     def update_mean_encoding(self, faceID: str, encoding: np, first_name: str):
-        cursor = self.conn.cursor()
+        with self.cursor() as cursor:
+            self.execute(cursor, "fetch_mean_encoding", (faceID,))
+            mean_encoding, timesAdded = cursor.fetchone()
 
-        fetch_query = "SELECT encoding, timesAdded FROM Encoding WHERE id = %s"
-        cursor.execute(fetch_query, (faceID,))
-        mean_encoding, timesAdded = cursor.fetchone()
+            mean_encoding = embedding_format.decode(mean_encoding)  # back to numpy for calculation
+            mean_encoding = (
+                mean_encoding * timesAdded + np.ravel(encoding)
+            ) / (timesAdded + 1)  # this gets the mean encoding
 
-        unpickled_mean_encoding = pickle.loads(
-            mean_encoding
-        )  # back to numpy for calculation
-        unpickled_mean_encoding = unpickled_mean_encoding * timesAdded
-        unpickled_mean_encoding = (
-            np.add(unpickled_mean_encoding, encoding) / timesAdded
-        )  # this gets the mean encoding
+            encoded = embedding_format.encode(mean_encoding, self.embedding_dtype)
 
-        pickled_encoding = pickle.dumps(
-            unpickled_mean_encoding
-        )  # dumps() serialises an object
+            self.execute(cursor, "update_mean_encoding", (encoded, faceID))
+            self.sync_indexes(faceID, mean_encoding)
+            self.notify_change(cursor, faceID)
 
-        update_encoding_query = "UPDATE Encoding SET encoding = %s, timesAdded = timesAdded + 1 WHERE id = %s"
-        cursor.execute(update_encoding_query, (pickled_encoding, faceID))
+        self.sync_caches(faceID)
 
-        log_event = "INSERT INTO Events (ID, description) VALUES (%s, %s)"
         description = "Old face {} was used to update Faces table.".format(first_name)
-        event_query = (faceID, description)
-        cursor.execute(log_event, event_query)
-
-        cursor.close()
+        self.log_event(faceID, description)
 
     # id is created uniquely using 5 letters of full name & 3 digits number (000); e.g. Min Kim would be KmMin001
     def assign_face_ID(self, first_name: str, last_name: str) -> str:
@@ -137,59 +284,60 @@ class Database:
 
         return faceID
 
-    # add new face to Faces table & update the mean encoding in Encoding table
-    def add_new_face(
-        self, faceID: str, first_name: str, last_name: str, encoding: np, count=1
-    ) -> None:
-        cursor = self.conn.cursor()
-
-        add_face = "INSERT INTO Faces (ID, firstName, lastName) VALUES (%s, %s, %s)"
-
-        # count represents the number proceeding the faceID
+    # count represents the number proceeding the faceID
+    def numbered_face_ID(self, faceID: str, count: int) -> str:
         if (
             count < 10
         ):  # we assume that there won't be more than 999 people with same id
-            faceID += "00" + str(count)
+            return faceID + "00" + str(count)
         elif count < 100:
-            faceID += "0" + str(count)
+            return faceID + "0" + str(count)
         else:
-            faceID += str(count)
+            return faceID + str(count)
 
-        cursor.execute(add_face, (faceID, first_name, last_name))
+    # add new face to Faces table & update the mean encoding in Encoding table
+    def add_new_face(
+        self, faceID: str, first_name: str, last_name: str, encoding: np, count=1
+    ) -> None:
+        with self.cursor() as cursor:
+            faceID = self.numbered_face_ID(faceID, count)
 
-        pickled_encoding = pickle.dumps(encoding)  # dumps() serialises an object
+            self.execute(cursor, "insert_face", (faceID, first_name, last_name))
 
-        add_encoding = "INSERT INTO Encoding (ID, encoding, timesAdded) VALUES (%s, %s, 1)"  # new face thus first time being added; timesAdded = 1
-        encoding_query = (faceID, pickled_encoding)
-        cursor.execute(add_encoding, encoding_query)
+            encoded = embedding_format.encode(encoding, self.embedding_dtype)
 
-        log_event = "INSERT INTO Events (ID, description) VALUES (%s, %s)"
-        description = "New face {} added to Encoding table.".format(first_name)
-        event_query = (faceID, description)
-        cursor.execute(log_event, event_query)
+            # new face thus first time being added; timesAdded = 1
+            self.execute(cursor, "insert_encoding", (faceID, encoded))
+            self.sync_indexes(faceID, encoding)
+            self.notify_change(cursor, faceID)
 
-        cursor.close()
+        self.sync_caches(faceID)
+
+        description = "New face {} added to Encoding table.".format(first_name)
+        self.log_event(faceID, description)
 
     # adds/updates encoding to/of Faces table
     def add_faces(
         self, first_name: str, last_name: str, encoding: np
     ) -> tuple:  # returns is_new_face : bool and id : str
-        cursor = self.conn.cursor()
-
         faceID = self.assign_face_ID(first_name, last_name)
+        matching_rows = []
+
+        # the connection goes back before the writes below check out their own
+        with self.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM Faces WHERE ID LIKE %s", (faceID + "%",))
+            count = cursor.fetchone()[0]
+
+            # if there are people with same id, check if it's the same person
+            # for now, we assume if their full names match, it's the same person
+            if count > 0:
+                cursor.execute(
+                    "SELECT ID FROM Faces WHERE ID LIKE %s AND firstName = %s AND lastName = %s",
+                    (faceID + "%", first_name, last_name),
+                )
+                matching_rows = cursor.fetchall()
 
-        cursor.execute("SELECT COUNT(*) FROM Faces WHERE ID LIKE %s", (faceID + "%",))
-        count = cursor.fetchone()[0]
-
-        # if there are people with same id, check if it's the same person
-        # for now, we assume if their full names match, it's the same person
         if count > 0:
-            cursor.execute(
-                "SELECT ID FROM Faces WHERE ID LIKE %s AND firstName = %s AND lastName = %s",
-                (faceID + "%", first_name, last_name),
-            )
-            matching_rows = cursor.fetchall()
-
             if matching_rows:
                 # if it is registered face, just update the mean encoding
                 for row in matching_rows:
@@ -197,128 +345,261 @@ class Database:
 
                 self.update_mean_encoding(faceID, encoding, first_name)
 
-                cursor.close()
-
                 return False, ""
             else:
                 # there are people with same ID, but with different names
                 self.add_new_face(faceID, first_name, last_name, encoding, (count + 1))
 
-                cursor.close()
-
                 return True, faceID  # then add thumbnail
         else:
             # there is no one with same ID
             self.add_new_face(faceID, first_name, last_name, encoding)
 
-            cursor.close()
-
             return True, faceID
 
+    # add_faces for many people in one transaction; people is a list of
+    # (first_name, last_name, mean_encoding, times_added, thumbnail) and the face IDs are returned in the same order.
+    # a person already registered under the same full name has their mean encoding weighted by times_added
+    def add_faces_bulk(self, people: list) -> list:
+        if not people:
+            return []
+
+        with self.cursor() as cursor:
+            firsts = [person[0] for person in people]
+            lasts = [person[1] for person in people]
+            prefixes = sorted({self.assign_face_ID(first, last) for first, last in zip(firsts, lasts)})
+
+            cursor.execute("BEGIN")
+            try:
+                cursor.execute(
+                    """
+                    SELECT f.ID, f.firstName, f.lastName, e.encoding, e.timesAdded
+                    FROM Faces f JOIN Encoding e ON e.ID = f.ID
+                    WHERE (f.firstName, f.lastName) IN (SELECT * FROM unnest(%s::text[], %s::text[]))
+                    """,
+                    (firsts, lasts),
+                )
+                registered = {
+                    (first, last): (faceID, embedding_format.decode(encoding), times)
+                    for faceID, first, last, encoding, times in cursor.fetchall()
+                }
+
+                cursor.execute(
+                    "SELECT p, COUNT(f.ID) FROM unnest(%s::text[]) AS p LEFT JOIN Faces f ON f.ID LIKE p || '%%' GROUP BY p",
+                    (prefixes,),
+                )
+                taken = dict(cursor.fetchall())
+
+                faceIDs, new_faces, new_encodings, updates, events = [], [], [], [], []
+
+                for first_name, last_name, encoding, times_added, thumbnail in people:
+                    encoding = np.ravel(encoding)
+
+                    if (first_name, last_name) in registered:
+                        faceID, old, old_times = registered[(first_name, last_name)]
+                        encoding = (old * old_times + encoding * times_added) / (old_times + times_added)
+                        times_added += old_times
+
+                        registered[(first_name, last_name)] = (faceID, encoding, times_added)
+                        updates.append((faceID, embedding_format.encode(encoding, self.embedding_dtype), times_added))
+                        events.append((faceID, "Old face {} was used to update Faces table.".format(first_name)))
+                    else:
+                        prefix = self.assign_face_ID(first_name, last_name)
+                        taken[prefix] += 1
+                        faceID = self.numbered_face_ID(prefix, taken[prefix])
+
+                        registered[(first_name, last_name)] = (faceID, encoding, times_added)
+                        new_faces.append((faceID, first_name, last_name, thumbnail))
+                        new_encodings.append((faceID, embedding_format.encode(encoding, self.embedding_dtype), times_added))
+                        events.append((faceID, "New face {} added to Encoding table.".format(first_name)))
+
+                    faceIDs.append(faceID)
+
+                if new_faces:
+                    execute_values(cursor, "INSERT INTO Faces (ID, firstName, lastName, thumbnail) VALUES %s", new_faces)
+                    execute_values(cursor, "INSERT INTO Encoding (ID, encoding, timesAdded) VALUES %s", new_encodings)
+                if updates:
+                    execute_values(
+                        cursor,
+                        """
+                        UPDATE Encoding AS e SET encoding = v.encoding, timesAdded = v.timesAdded, timestamp = NOW(),
+                        txid = txid_current()
+                        FROM (VALUES %s) AS v(ID, encoding, timesAdded) WHERE e.ID = v.ID
+                        """,
+                        updates,
+                    )
+                execute_values(cursor, "INSERT INTO Events (ID, description) VALUES %s", events)
+
+                # delivered on COMMIT; one notification makes every GalleryFeed fetch the whole batch
+                self.notify_change(cursor, faceIDs[-1])
+
+                cursor.execute("COMMIT")
+            except psycopg2.Error:
+                cursor.execute("ROLLBACK")
+                raise
+
+        # a name listed twice was merged into one row; its final mean is the one in registered
+        written = set(faceIDs)
+        for faceID, encoding, _ in registered.values():
+            if faceID in written:
+                self.sync_indexes(faceID, encoding)
+
+        for cache in self.caches:
+            cache.refresh(faceIDs)
+
+        return faceIDs
+
     # prints/returns the number of registered faces
     def num_of_faces(self) -> int:
-        cursor = self.conn.cursor()
+        with self.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM Faces")
+            count = cursor.fetchone()[0]
 
-        cursor.execute("SELECT COUNT(*) FROM Faces")
-        count = cursor.fetchone()[0]
+        return count
 
-        cursor.close()
+    # returns every registered face as (ids, encodings) where encodings is one (N, 128) float32 matrix
+    def fetch_encoding_matrix(self) -> tuple:
+        ids, encodings, _ = self.fetch_encodings_since(None)
 
-        return count
+        return ids, encodings
 
-    # returns dictionary of encodings for all the registered faces {id:encoding}
-    def fetch_encodings(self) -> tuple:
-        cursor = self.conn.cursor()
+    # returns (ids, encodings, watermark) for rows written by transactions at or after watermark (all rows
+    # for None), and the watermark to pass back in on the next call.
+    # timestamps can't be the watermark: NOW() is when a transaction started, so one that commits after a
+    # fetch can still stamp its rows below that fetch's newest timestamp and would never be fetched.
+    # instead every row records the ID of the transaction that wrote it, and the watermark is the oldest
+    # transaction still running when the fetch began: everything older has committed (or rolled back) and
+    # is in this fetch, anything newer is fetched again next time (a re-read row is upserted once more)
+    def fetch_encodings_since(self, watermark) -> tuple:
+        with self.cursor() as cursor:
+            try:
+                self.execute(cursor, "fetch_watermark")
+                newest = cursor.fetchone()[0]
 
-        try:
-            cursor.execute("SELECT ID, encoding FROM Encoding")
+                if watermark is None:
+                    self.execute(cursor, "fetch_encodings")
+                else:
+                    self.execute(cursor, "fetch_encodings_since", (watermark,))
 
-            results = cursor.fetchall()
+                results = cursor.fetchall()
 
-            result = {}
-            for row in results:
-                faceID, encoding = row
-                unpickled_encoding = pickle.loads(encoding)  # back to numpy
-                result[faceID] = unpickled_encoding
+                ids = [row[0] for row in results]
+                encodings = embedding_format.decode_many([row[1] for row in results])
 
-            return result
+                return ids, encodings, newest
+
+            except psycopg2.Error as e:
+                cursor.connection.rollback()
+
+                return [], embedding_format.decode_many([]), watermark
+
+    # the watermark fetch_encodings_since would return now, without fetching any rows
+    def fetch_watermark(self):
+        with self.cursor() as cursor:
+            self.execute(cursor, "fetch_watermark")
+            watermark = cursor.fetchone()[0]
+
+        return watermark
 
-        except psycopg2.Error as e:
-            self.conn.rollback()
+    # returns dictionary of encodings for all the registered faces {id:encoding}
+    def fetch_encodings(self) -> dict:
+        ids, encodings = self.fetch_encoding_matrix()
 
-        cursor.close()
+        return dict(zip(ids, encodings))  # rows are views into one matrix
 
     # returns dictionary of encodings for specified person {id:encoding}
     def fetch_encoding_of(self, identity: str) -> tuple:
-        cursor = self.conn.cursor()
-
         full_name = identity.split()
         first_name = full_name[0]
         last_name = full_name[1]
 
-        cursor.execute(
-            "SELECT ID FROM Faces WHERE firstName=%s AND lastName=%s",
-            (first_name, last_name),
-        )
-        results = cursor.fetchone()
-        try:
-            if results:
-                # if person exists on db, get their id
-                faceID = results[0]
-                print("{} found with id: {}".format(first_name, faceID))
+        with self.cursor() as cursor:
+            try:
+                cursor.execute(
+                    "SELECT ID FROM Faces WHERE firstName=%s AND lastName=%s",
+                    (first_name, last_name),
+                )
+                results = cursor.fetchone()
+
+                if results:
+                    # if person exists on db, get their id
+                    faceID = results[0]
+                    print("{} found with id: {}".format(first_name, faceID))
+
+                    self.execute(cursor, "fetch_encoding_by_id", (faceID,))
+
+                    encoding = cursor.fetchone()[0]
 
-                query = "SELECT encoding FROM Encoding WHERE ID='{}'".format(faceID)
-                cursor.execute(query)
+                    result = {}
+                    result[faceID] = embedding_format.decode(encoding)  # back to numpy
 
-                encoding = cursor.fetchone()[0]
-                unpickled_encoding = pickle.loads(encoding)  # back to numpy
+                    return result
 
-                result = {}
-                result[faceID] = unpickled_encoding
+            except psycopg2.Error as e:
+                cursor.connection.rollback()
 
-                return result
+    # rewrites every Encoding row that is still a pickled array (or uses another dtype) in the binary format,
+    # and adds the txid column (see fetch_encodings_since) to tables created by older versions
+    def migrate_encodings(self) -> int:
+        with self.cursor() as cursor:
+            cursor.execute("ALTER TABLE Encoding ADD COLUMN IF NOT EXISTS txid BIGINT NOT NULL DEFAULT txid_current()")
+            cursor.execute("CREATE INDEX IF NOT EXISTS encoding_txid ON Encoding (txid)")
 
-        except psycopg2.Error as e:
-            self.conn.rollback()
+            cursor.execute("SELECT ID, encoding FROM Encoding")
+            target = bytes(embedding_format.encode(np.zeros(1), self.embedding_dtype)[:embedding_format.HEADER_SIZE])
+
+            updates = []
+            for faceID, encoding in cursor.fetchall():
+                if bytes(encoding[:embedding_format.HEADER_SIZE]) == target:
+                    continue
+
+                # the only place pickled rows are read: our own rows, written by older versions
+                if embedding_format.is_legacy(encoding):
+                    emb = np.ravel(pickle.loads(bytes(encoding))).astype(np.float32)
+                else:
+                    emb = embedding_format.decode(encoding)
+
+                updates.append((embedding_format.encode(emb, self.embedding_dtype), faceID))
 
-        cursor.close()
+            # one transaction, so a failed migration leaves every row as it was
+            cursor.execute("BEGIN")
+            try:
+                execute_batch(cursor, "UPDATE Encoding SET encoding = %s WHERE ID = %s", updates)
+                cursor.execute("COMMIT")
+            except psycopg2.Error:
+                cursor.execute("ROLLBACK")
+                raise
+
+        print("Migrated {} encoding(s)".format(len(updates)))
+
+        return len(updates)
 
     # adds verification log onto Events table; verification happens in admin_window.onVerify()
     def verification(self, faceID) -> str:
-        cursor = self.conn.cursor()
-        log_event = "INSERT INTO Events (ID, description) VALUES (%s, %s)"
-
         if faceID == "stranger":
             description = "Unregistered face tried to verify on the system."
-            event_query = "INSERT INTO Events (description) VALUES (%s)"
-            cursor.execute(event_query, (description,))
-
-            cursor.close()
+            self.log_event(None, description)
 
             return faceID
 
         else:
-            cursor.execute("SELECT (firstName) FROM Faces WHERE ID = '{}'".format(id))
-            first_name = cursor.fetchone()[0]
+            first_name = self.fetch_name(faceID)
 
             description = "{} was verified on the system.".format(first_name)
-            event_query = (faceID, description)
-            cursor.execute(log_event, event_query)
-
-            cursor.close()
+            self.log_event(faceID, description)
 
             return first_name
 
     def fetch_event_logs(self) -> str:
-        cursor = self.conn.cursor()
+        self.events.flush()  # include events still waiting in the logger
 
-        cursor.execute("SELECT (description, timestamp) FROM Events")
-        event_logs = cursor.fetchall()
+        with self.cursor() as cursor:
+            cursor.execute("SELECT (description, timestamp) FROM Events")
+            event_logs = cursor.fetchall()
 
         result = ""
 
         if not event_logs:
-            cursor.close()
             return "The system is new! No event was logged."
 
         else:
@@ -327,19 +608,29 @@ class Database:
                     result += str(tup) + " "
                 result += "\n"
 
-            cursor.close()
             return result
 
     def fetch_name(self, faceID: str):
-        cursor = self.conn.cursor()
+        with self.cursor() as cursor:
+            self.execute(cursor, "fetch_name", (faceID,))
+            first_name = cursor.fetchone()[0]
 
-        cursor.execute("SELECT (firstName) FROM Faces WHERE id = '{}'".format(faceID))
-        first_name = cursor.fetchone()[0]
+        return first_name
 
-        cursor.close()
+    # {id: (first name, last name, thumbnail path)} for the given IDs, or for up to limit faces when ids is None
+    def fetch_identities(self, ids=None, limit=None) -> dict:
+        with self.cursor() as cursor:
+            if ids is None:
+                cursor.execute("SELECT ID, firstName, lastName, thumbnail FROM Faces LIMIT %s", (limit,))
+            else:
+                self.execute(cursor, "fetch_identities", (list(ids),))
 
-        return first_name
+            return {
+                faceID: (first_name, last_name, bytes(thumbnail).decode() if thumbnail is not None else None)
+                for faceID, first_name, last_name, thumbnail in cursor.fetchall()
+            }
 
     def close_conn(self):
-        self.conn.close()
+        self.events.close()  # writes out whatever is still queued
+        self.pool.closeall()
         print("Successfully disconnected from db!")
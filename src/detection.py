@@ -0,0 +1,125 @@
+# adaptive-resolution face detection in front of YuNet
+#
+# YuNet's cost grows with the number of input pixels, while the faces in front of a camera are
+# usually large. every full_frame_every-th frame is detected on a copy shrunk by scale and the
+# boxes are mapped back to full resolution; the frames in between are only searched inside a
+# margin around the faces found on the previous frame, shrunk the same way. a region that loses
+# its face, or a frame with no faces to follow, forces a full pass on the next frame.
+# new faces therefore appear within full_frame_every frames; scale=1, full_frame_every=1 is plain YuNet
+
+import cv2 as cv
+import numpy as np
+
+import metrics
+
+
+# YuNet row: x, y, w, h, 5 landmarks (x, y), score; columns 0..13 alternate x-like and y-like values
+X_COLS = np.array([0, 2, 4, 6, 8, 10, 12])
+Y_COLS = X_COLS + 1
+POINT_COLS = np.array([0, 1, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13])  # shifted by a region's offset; w, h are not
+
+
+def empty_detections() -> np.ndarray:
+    return np.empty((0, 15), dtype=np.float32)
+
+
+class AdaptiveDetector:
+    def __init__(self, detector, scale=0.5, full_frame_every=10, roi_margin=0.5, nms_threshold=0.3) -> None:
+        self.detector = detector  # yunet.YuNet; its input size is managed from here
+        self.scale = scale
+        self.full_frame_every = full_frame_every
+        self.roi_margin = roi_margin  # a region is the box grown by this fraction of its size on every side
+        self.nms_threshold = nms_threshold  # merges faces found twice by overlapping regions
+
+        self.last = empty_detections()  # detections of the previous frame, in frame coordinates
+
+        self.counters = {"full_passes": 0, "roi_passes": 0, "pixels": 0}
+
+        self._since_full = full_frame_every
+        self._input_size = None
+        self._small = None  # reused buffer for the shrunk full frame
+
+    def _set_input_size(self, size: tuple) -> None:
+        if self._input_size != size:
+            self.detector.setInputSize(list(size))
+            self._input_size = size
+
+    def _shrunk_size(self, w: int, h: int) -> tuple:
+        return max(int(round(w * self.scale)), 1), max(int(round(h * self.scale)), 1)
+
+    # YuNet on image shrunk by scale; rows come back in the coordinates of image shifted by offset
+    def _detect(self, image: np.ndarray, offset=(0, 0), dst=None) -> np.ndarray:
+        h, w = image.shape[:2]
+        size = self._shrunk_size(w, h)
+
+        if size != (w, h):
+            image = cv.resize(image, size, dst=dst, interpolation=cv.INTER_AREA)
+
+        self._set_input_size(size)
+        self.counters["pixels"] += size[0] * size[1]
+
+        dets = self.detector.infer(image)
+        if len(dets) == 0:
+            return empty_detections()
+
+        dets = np.array(dets, dtype=np.float32).reshape(-1, 15)
+        dets[:, X_COLS] *= w / size[0]
+        dets[:, Y_COLS] *= h / size[1]
+        dets[:, POINT_COLS] += np.tile(np.asarray(offset, dtype=np.float32), 6)
+
+        return dets
+
+    def _full_pass(self, frame: np.ndarray) -> np.ndarray:
+        self.counters["full_passes"] += 1
+        self._since_full = 0
+
+        w, h = self._shrunk_size(frame.shape[1], frame.shape[0])
+        shape = (h, w) + frame.shape[2:]
+        if self._small is None or self._small.shape != shape:
+            self._small = np.empty(shape, dtype=frame.dtype)
+
+        return self._detect(frame, dst=self._small)
+
+    # detection restricted to regions around self.last; None when a face was lost and the frame needs a full pass
+    def _roi_pass(self, frame: np.ndarray):
+        self.counters["roi_passes"] += 1
+        self._since_full += 1
+
+        fh, fw = frame.shape[:2]
+        found = []
+
+        for x, y, w, h in self.last[:, 0:4]:
+            x0 = int(max(x - self.roi_margin * w, 0))
+            y0 = int(max(y - self.roi_margin * h, 0))
+            x1 = int(min(x + w + self.roi_margin * w, fw))
+            y1 = int(min(y + h + self.roi_margin * h, fh))
+
+            if x1 - x0 < 2 or y1 - y0 < 2:
+                return None
+
+            dets = self._detect(frame[y0:y1, x0:x1], offset=(x0, y0))
+            if len(dets) == 0:
+                return None
+
+            found.append(dets)
+
+        dets = np.vstack(found)
+
+        keep = cv.dnn.NMSBoxes(dets[:, 0:4].tolist(), dets[:, 14].tolist(), 0.0, self.nms_threshold)
+
+        return dets[np.ravel(keep)] if len(keep) else empty_detections()
+
+    # YuNet rows for frame, in full-resolution coordinates
+    @metrics.timed("detect")
+    def detect(self, frame: np.ndarray) -> np.ndarray:
+        dets = None
+
+        if len(self.last) and self._since_full < self.full_frame_every - 1:
+            dets = self._roi_pass(frame)
+
+        if dets is None:
+            dets = self._full_pass(frame)
+
+        self.last = dets
+
+        return dets
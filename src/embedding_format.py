@@ -0,0 +1,73 @@
+# binary layout of embeddings stored in Encoding.encoding
+#
+#   byte 0      format version (VERSION)
+#   byte 1      dtype code (see DTYPES)
+#   bytes 2..   the embedding as raw little-endian floats
+#
+# rows written before this format are pickled numpy arrays; they start with the pickle
+# protocol marker 0x80, which is never a valid version byte. decode() refuses them: only
+# Database.migrate_encodings (main.py m) unpickles them, once, to rewrite them in this format
+
+import numpy as np
+
+
+VERSION = 1
+HEADER_SIZE = 2
+
+DTYPES = {0: np.dtype("<f4"), 1: np.dtype("<f2")}
+DTYPE_CODES = {dtype: code for code, dtype in DTYPES.items()}
+
+PICKLE_MARKER = 0x80
+
+
+class LegacyEncodingError(ValueError):
+    pass
+
+
+def encode(emb: np.ndarray, dtype=np.float32) -> bytes:
+    dtype = np.dtype(dtype).newbyteorder("<")
+    if dtype not in DTYPE_CODES:
+        raise ValueError("unsupported embedding dtype: {}".format(dtype))
+
+    header = bytes((VERSION, DTYPE_CODES[dtype]))
+
+    return header + np.ascontiguousarray(np.ravel(emb), dtype=dtype).tobytes()
+
+
+def is_legacy(buf) -> bool:
+    return len(buf) > 0 and bytes(buf[:1])[0] == PICKLE_MARKER
+
+
+# one stored embedding back to a flat float32 array
+def decode(buf) -> np.ndarray:
+    buf = bytes(buf)
+
+    if is_legacy(buf):
+        raise LegacyEncodingError("pickled encoding from an older version; run `python3 src/main.py m` first")
+
+    version, code = buf[0], buf[1]
+    if version != VERSION or code not in DTYPES:
+        raise ValueError("unknown embedding format: version {}, dtype {}".format(version, code))
+
+    return np.frombuffer(buf, dtype=DTYPES[code], offset=HEADER_SIZE).astype(np.float32)
+
+
+# a whole result set of stored embeddings as one (N, dim) float32 matrix
+def decode_many(bufs: list) -> np.ndarray:
+    if len(bufs) == 0:
+        return np.empty((0, 128), dtype=np.float32)
+
+    length = len(bufs[0])
+    header = bytes(bufs[0][:HEADER_SIZE])
+
+    # rows of mixed layouts (float16 next to float32) fall back to one decode per row, which also
+    # raises on legacy rows
+    if not all(len(b) == length and bytes(b[:HEADER_SIZE]) == header for b in bufs) or is_legacy(header):
+        return np.vstack([decode(b) for b in bufs])
+
+    if header[0] != VERSION or header[1] not in DTYPES:
+        raise ValueError("unknown embedding format: version {}, dtype {}".format(header[0], header[1]))
+
+    raw = np.frombuffer(b"".join(bufs), dtype=np.uint8).reshape(len(bufs), length)
+
+    return np.ascontiguousarray(raw[:, HEADER_SIZE:]).view(DTYPES[header[1]]).astype(np.float32, copy=False)
@@ -0,0 +1,199 @@
+# offline bulk enrolment from a directory of labelled photos
+#
+#   <root>/<First Last>/*.jpg   (or First_Last; one directory per person, any depth of nesting inside it)
+#
+# photos are read, detected with YuNet, aligned and embedded with SFace in a pool of worker processes;
+# each person's embeddings are averaged with NumPy and written with Database.add_faces_bulk,
+# a batch of people per transaction. people already written are listed in the progress file, so an
+# interrupted run picks up where it stopped. run e.g. `python src/enrol.py staff_photos --workers 8`
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+
+import cv2
+import numpy as np
+
+import runtime_config
+from database import Database
+from detection import AdaptiveDetector
+from sface import SFace
+from yunet import YuNet
+
+from dotenv import load_dotenv
+
+
+PROGRESS_PATH = "enrol_progress.json"
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+MAX_DETECT_SIDE = 640  # photos are shrunk to at most this for detection; alignment uses the full image
+
+
+# per-process state of a pool worker, set by _init_worker
+_worker = {}
+
+
+def _init_worker(fd_model_path: str, fr_model_path: str, fd_target=(0, 0), fr_target=(0, 0)) -> None:
+    _worker["detector"] = AdaptiveDetector(
+        YuNet(modelPath=fd_model_path, confThreshold=0.8, backendId=fd_target[0], targetId=fd_target[1]),
+        full_frame_every=1,
+    )
+    _worker["frecogi_model"] = SFace(modelPath=fr_model_path, disType=1, backendId=fr_target[0], targetId=fr_target[1])
+
+
+# (label, path, embedding or None) for one photo; the most confident face is the one enrolled
+def _embed_photo(job: tuple) -> tuple:
+    label, path = job
+
+    img = cv2.imread(path)
+    if img is None:
+        return label, path, None
+
+    detector = _worker["detector"]
+    detector.scale = min(1.0, MAX_DETECT_SIDE / max(img.shape[:2]))
+
+    faces = detector.detect(img)
+    if len(faces) == 0:
+        return label, path, None
+
+    face = faces[np.argmax(faces[:, 14])]
+
+    # alignCrop warps the face onto SFace's landmark template before embedding
+    return label, path, np.ravel(_worker["frecogi_model"].infer(img, face)).astype(np.float32)
+
+
+# {label: [photo paths]} for every person directory under root
+def find_people(root: str) -> dict:
+    people = {}
+
+    for entry in sorted(os.scandir(root), key=lambda e: e.name):
+        if not entry.is_dir():
+            continue
+
+        photos = [
+            os.path.join(dirpath, name)
+            for dirpath, _, names in os.walk(entry.path)
+            for name in sorted(names)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        ]
+        if photos:
+            people[entry.name] = photos
+
+    return people
+
+
+# "First Last" or "First_Last" -> (first, last); None for labels the Faces table can't hold
+def split_label(label: str):
+    parts = label.replace("_", " ").split()
+
+    if len(parts) < 2:
+        return None
+
+    return parts[0], " ".join(parts[1:])
+
+
+def load_progress(path: str) -> set:
+    try:
+        with open(path) as f:
+            return set(json.load(f)["done"])
+    except (OSError, ValueError, KeyError):
+        return set()
+
+
+def save_progress(path: str, done: set) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"done": sorted(done)}, f)
+    os.replace(tmp, path)
+
+
+# runtime is a runtime_config.RuntimeConfig (model files and backends); chosen from .env when None
+def enrol(root: str, myDB, workers=None, batch_size=200, progress_path=PROGRESS_PATH, runtime=None) -> dict:
+    runtime = runtime or runtime_config.select()
+    people = find_people(root)
+    done = load_progress(progress_path)
+
+    todo = []
+    for label in people:
+        if label in done:
+            continue
+        if split_label(label) is None:
+            print("skipping {!r}: directory names must be 'First Last'".format(label))
+            continue
+        todo.append(label)
+
+    print("{} people found, {} already enrolled, {} to go".format(len(people), len(people) - len(todo), len(todo)))
+
+    counts = {"people": 0, "photos": 0, "no_face": 0}
+
+    pool = mp.get_context("spawn").Pool(
+        workers or os.cpu_count() or 1, initializer=_init_worker,
+        initargs=(runtime.fd_model_path, runtime.fr_model_path, runtime.fd_target, runtime.fr_target),
+    )
+
+    try:
+        for start in range(0, len(todo), batch_size):
+            labels = todo[start:start + batch_size]
+            jobs = [(label, path) for label in labels for path in people[label]]
+
+            embeddings = {label: [] for label in labels}
+            for label, path, emb in pool.imap_unordered(_embed_photo, jobs, chunksize=8):
+                if emb is None:
+                    counts["no_face"] += 1
+                    print("no face in {}".format(path))
+                else:
+                    embeddings[label].append(emb)
+                    counts["photos"] += 1
+
+            batch = []
+            for label in labels:
+                if not embeddings[label]:
+                    continue
+
+                first_name, last_name = split_label(label)
+                mean_encoding = np.mean(np.vstack(embeddings[label]), axis=0)
+                # the file name only, as add_thumbnail stores it
+                thumbnail = os.path.basename(people[label][0])
+                batch.append((first_name, last_name, mean_encoding, len(embeddings[label]), thumbnail))
+
+            myDB.add_faces_bulk(batch)
+
+            # people without a usable photo are marked done too; add photos and delete the progress file to retry them
+            done.update(labels)
+            save_progress(progress_path, done)
+
+            counts["people"] += len(batch)
+            print("{}/{} people enrolled".format(start + len(labels), len(todo)))
+
+    finally:
+        pool.terminate()
+        pool.join()
+
+    print("Enrolled {people} people from {photos} photo(s); {no_face} photo(s) without a usable face".format(**counts))
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk enrolment from a directory of labelled photos")
+    parser.add_argument("root", help="directory with one sub-directory per person, named 'First Last'")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--batch-size", type=int, default=200, help="people written per transaction")
+    parser.add_argument("--progress", default=PROGRESS_PATH, help="file listing the people already enrolled")
+    args = parser.parse_args()
+
+    load_dotenv()
+    myDB = Database(
+        os.getenv("USER_NAME"), os.getenv("PASSWORD"),
+        os.getenv("DATABASE_NAME"), os.getenv("PORT_NUMBER")
+    )
+
+    try:
+        enrol(args.root, myDB, args.workers, args.batch_size, args.progress)
+    finally:
+        myDB.close_conn()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# background writer for the Events table
+#
+# log() only appends to an in-memory queue; a thread writes the queue out with one multi-row
+# INSERT whenever max_batch events are waiting or flush_interval seconds have passed.
+# a full queue makes log() wait up to block_timeout (backpressure) and then drop the event,
+# so a stalled database can slow the camera loop down but never wedge it
+
+import queue
+import threading
+import time
+
+from datetime import datetime, timezone
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+import metrics
+
+
+class EventLogger(threading.Thread):
+    def __init__(self, myDB, max_batch=500, flush_interval=1.0, max_pending=10000,
+                 dedupe_window=30.0, block_timeout=0.5) -> None:
+        super().__init__(name="event-logger", daemon=True)
+
+        self.myDB = myDB
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.dedupe_window = dedupe_window  # seconds a repeated sighting of the same ID is ignored for
+        self.block_timeout = block_timeout
+
+        self.counters = {"logged": 0, "written": 0, "deduped": 0, "dropped": 0, "failed": 0}
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._last_seen = {}  # dedupe key -> monotonic time it was last logged
+        self._seen_lock = threading.Lock()
+        self._flush_now = threading.Event()
+        self._flushed = threading.Condition()
+        self._stopped = threading.Event()
+
+    # queues one event; dedupe=True collapses repeats (e.g. the same face seen on consecutive frames)
+    def log(self, faceID, description: str, dedupe=False) -> bool:
+        if dedupe:
+            key = (faceID, description)
+            now = time.monotonic()
+
+            with self._seen_lock:
+                if now - self._last_seen.get(key, -self.dedupe_window) < self.dedupe_window:
+                    self.counters["deduped"] += 1
+                    return False
+
+                self._last_seen[key] = now
+
+        try:
+            self._queue.put((faceID, description, datetime.now(timezone.utc)), timeout=self.block_timeout)
+        except queue.Full:
+            self.counters["dropped"] += 1
+            return False
+
+        self.counters["logged"] += 1
+
+        if self._queue.qsize() >= self.max_batch:
+            self._flush_now.set()
+
+        return True
+
+    # blocks until everything queued so far is written
+    def flush(self, timeout=5.0) -> None:
+        with self._flushed:
+            self._flush_now.set()
+            self._flushed.wait_for(lambda: self._queue.unfinished_tasks == 0, timeout)
+
+    # flushes what is left and stops the thread; called from Database.close_conn
+    def close(self) -> None:
+        self._stopped.set()
+        self._flush_now.set()
+
+        if self.is_alive():
+            self.join()
+
+    def _take_batch(self) -> list:
+        batch = []
+
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _write(self, batch: list) -> None:
+        cursor = self.myDB.cursor()
+
+        try:
+            with metrics.timer("db_insert_events"):
+                execute_values(
+                    cursor, "INSERT INTO Events (ID, description, timestamp) VALUES %s", batch,
+                    page_size=len(batch),
+                )
+            self.counters["written"] += len(batch)
+        except psycopg2.Error as e:
+            self.counters["failed"] += len(batch)
+            print("event logger: dropped {} event(s) ({})".format(len(batch), e))
+        finally:
+            cursor.close()
+
+            for _ in batch:
+                self._queue.task_done()
+
+    def run(self) -> None:
+        while True:
+            self._flush_now.wait(self.flush_interval)
+            self._flush_now.clear()
+
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    break
+                self._write(batch)
+
+            with self._flushed:
+                self._flushed.notify_all()
+
+            # forget sightings older than the dedupe window so the table doesn't grow with every ID ever seen
+            now = time.monotonic()
+            with self._seen_lock:
+                self._last_seen = {
+                    key: seen for key, seen in self._last_seen.items() if now - seen < self.dedupe_window
+                }
+
+            if self._stopped.is_set() and self._queue.empty():
+                break
@@ -0,0 +1,283 @@
+# in-memory gallery of enrolled SFace embeddings for vectorised matching
+
+import functools
+import threading
+
+import numpy as np
+
+
+COSINE = 0
+NORM_L2 = 1
+
+# same thresholds SFace uses for FaceRecognizerSF.match
+THRESHOLD_COSINE = 0.363
+THRESHOLD_NORML2 = 1.128
+
+
+# normalises each row to unit length; FaceRecognizerSF.match does the same before comparing
+def normalize(embs: np.ndarray) -> np.ndarray:
+    embs = np.asarray(embs, dtype=np.float32).reshape(-1, np.shape(embs)[-1])
+    norms = np.linalg.norm(embs, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+
+    return np.ascontiguousarray(embs / norms, dtype=np.float32)
+
+
+# converts cosine scores of unit vectors into the distance used by disType
+def to_distance(scores: np.ndarray, disType: int) -> np.ndarray:
+    if disType == COSINE:
+        return scores
+
+    # |a - b|^2 = 2 - 2 a.b for unit vectors
+    return np.sqrt(np.maximum(2.0 - 2.0 * scores, 0.0))
+
+
+# indices of the k best scores for each row, best first
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, scores.shape[1])
+
+    if k == scores.shape[1]:
+        idx = np.argsort(-scores, axis=1)
+    else:
+        idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, idx, axis=1), axis=1)
+        idx = np.take_along_axis(idx, order, axis=1)
+
+    return idx
+
+
+# runs a matcher method under the matcher's lock, so a feed thread can upsert while another thread searches
+def locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+# shared interface of every matcher over the gallery (exact Gallery, ann_index.IVFIndex, ...)
+# subclasses provide load, upsert, remove, search, __len__ and a self.lock for @locked methods
+class Matcher:
+    disType = NORM_L2
+    threshold = THRESHOLD_NORML2
+    is_remote = False  # True when the rows live in another process that keeps them current (see shards.py)
+
+    # True where dist passes the threshold for this distance type
+    def is_match(self, dists: np.ndarray) -> np.ndarray:
+        if self.disType == COSINE:
+            return dists >= self.threshold
+
+        return dists <= self.threshold
+
+    # best match for each probe: list of (id, dist, is_recognised); id is None for an empty gallery
+    def match(self, probes: np.ndarray) -> list:
+        ids, dists = self.search(probes, k=1)
+
+        if ids.shape[1] == 0:
+            return [(None, float("nan"), False) for _ in range(len(ids))]
+
+        matched = self.is_match(dists[:, 0])
+
+        return [
+            (ids[i, 0], float(dists[i, 0]), bool(matched[i]))
+            for i in range(len(ids))
+        ]
+
+
+# rows live in two parts: an optional read-only base matrix (e.g. a memory-mapped snapshot shared
+# between processes, see snapshot.py) and an owned tail that takes every insert and update.
+# updating or removing a base identity only masks its base row, so the base is never copied
+class Gallery(Matcher):
+    def __init__(self, disType=NORM_L2, threshold=None, dim=128) -> None:
+        assert disType in [COSINE, NORM_L2], "0: Cosine similarity, 1: norm-L2 distance, others: invalid"
+        self.disType = disType
+
+        if threshold is None:
+            threshold = THRESHOLD_COSINE if disType == COSINE else THRESHOLD_NORML2
+        self.threshold = threshold
+
+        self.lock = threading.RLock()
+
+        self._base = np.empty((0, dim), dtype=np.float32)
+        self._base_ids = []
+        self._dead = np.zeros(0, dtype=bool)  # base rows superseded by the tail or removed
+        self._num_dead = 0
+
+        self._tail_ids = []
+        self._buf = np.empty((0, dim), dtype=np.float32)  # tail rows, with spare capacity
+
+        self._rows = {}  # id -> row; rows past len(self._base) index the tail
+
+    def __len__(self) -> int:
+        return len(self._base_ids) - self._num_dead + len(self._tail_ids)
+
+    def __contains__(self, faceID) -> bool:
+        return faceID in self._rows
+
+    @property
+    def dim(self) -> int:
+        return self._buf.shape[1]
+
+    @property
+    def ids(self) -> list:
+        if len(self._base_ids) == 0:
+            return list(self._tail_ids)
+
+        live = [faceID for faceID, dead in zip(self._base_ids, self._dead) if not dead]
+
+        return live + self._tail_ids
+
+    # id behind column col of the scores computed by search_scores
+    def id_at(self, col: int):
+        nbase = len(self._base_ids)
+
+        return self._base_ids[col] if col < nbase else self._tail_ids[col - nbase]
+
+    # (N, dim) matrix of the live rows in the order of ids; a view unless a base is loaded
+    @property
+    def embs(self) -> np.ndarray:
+        tail = self._buf[: len(self._tail_ids)]
+
+        if len(self._base_ids) == 0:
+            return tail
+
+        return np.vstack([self._base[~self._dead], tail])
+
+    # bytes of rows held in this process's own memory; a memory-mapped base is shared page cache, not counted
+    @property
+    def resident_bytes(self) -> int:
+        return self._buf.nbytes + (0 if isinstance(self._base, np.memmap) else self._base.nbytes)
+
+    # replaces the gallery with the encodings returned by Database.fetch_encodings() {id:encoding}
+    def load(self, encodings: dict) -> "Gallery":
+        if not encodings:
+            return self.load_matrix([], np.empty((0, self.dim), dtype=np.float32))
+
+        ids = list(encodings.keys())
+
+        return self.load_matrix(ids, np.vstack([np.ravel(encodings[i]) for i in ids]))
+
+    # replaces the gallery with Database.fetch_encoding_matrix() output: ids and one (N, dim) matrix
+    @locked
+    def load_matrix(self, ids: list, embs: np.ndarray) -> "Gallery":
+        self._reset()
+
+        self._tail_ids = list(ids)
+        self._buf = normalize(embs) if len(ids) else np.empty((0, self.dim), dtype=np.float32)
+        self._rows = {faceID: row for row, faceID in enumerate(self._tail_ids)}
+
+        return self
+
+    # replaces the gallery with rows that are already unit-length float32, without copying them
+    @locked
+    def load_base(self, ids: list, embs: np.ndarray) -> "Gallery":
+        self._reset()
+
+        self._base = embs
+        self._base_ids = list(ids)
+        self._dead = np.zeros(len(ids), dtype=bool)
+        self._rows = {faceID: row for row, faceID in enumerate(self._base_ids)}
+
+        return self
+
+    def _reset(self) -> None:
+        dim = self.dim
+
+        self._base = np.empty((0, dim), dtype=np.float32)
+        self._base_ids = []
+        self._dead = np.zeros(0, dtype=bool)
+        self._num_dead = 0
+
+        self._tail_ids = []
+        self._buf = np.empty((0, dim), dtype=np.float32)
+        self._rows = {}
+
+    # adds a new identity or replaces the embedding of an existing one
+    @locked
+    def upsert(self, faceID, encoding: np.ndarray) -> None:
+        emb = normalize(encoding)[0]
+        nbase = len(self._base_ids)
+
+        row = self._rows.get(faceID)
+        if row is not None and row >= nbase:
+            self._buf[row - nbase] = emb
+            return
+
+        if row is not None:
+            self._kill_base_row(row)
+
+        n = len(self._tail_ids)
+        if n == len(self._buf):
+            # grow geometrically so repeated inserts stay amortised O(dim)
+            grown = np.empty((max(2 * n, 16), self.dim), dtype=np.float32)
+            grown[:n] = self._buf[:n]
+            self._buf = grown
+
+        self._buf[n] = emb
+        self._rows[faceID] = nbase + n
+        self._tail_ids.append(faceID)
+
+    # drops an identity; a tail row is replaced by the last tail row to keep the tail dense
+    @locked
+    def remove(self, faceID) -> bool:
+        row = self._rows.pop(faceID, None)
+        if row is None:
+            return False
+
+        nbase = len(self._base_ids)
+        if row < nbase:
+            self._kill_base_row(row)
+            return True
+
+        row -= nbase
+        last = len(self._tail_ids) - 1
+        if row != last:
+            moved = self._tail_ids[last]
+            self._buf[row] = self._buf[last]
+            self._tail_ids[row] = moved
+            self._rows[moved] = nbase + row
+
+        self._tail_ids.pop()
+
+        return True
+
+    def _kill_base_row(self, row: int) -> None:
+        if not self._dead[row]:
+            self._dead[row] = True
+            self._num_dead += 1
+
+    # scores a batch of probe embeddings against every gallery row with a single matmul
+    # returns (ids, dists) each of shape (num_probes, k), best match first
+    def search(self, probes: np.ndarray, k=1) -> tuple:
+        ids, scores = self.search_scores(normalize(probes), k)
+
+        return ids, to_distance(scores, self.disType)
+
+    # same as search but takes unit-length probes and returns raw cosine scores
+    @locked
+    def search_scores(self, probes: np.ndarray, k=1) -> tuple:
+        if len(self) == 0:
+            return (
+                np.empty((len(probes), 0), dtype=object),
+                np.empty((len(probes), 0), dtype=np.float32),
+            )
+
+        nbase = len(self._base_ids)
+        tail = self._buf[: len(self._tail_ids)]
+
+        if nbase == 0:
+            scores = probes @ tail.T
+        else:
+            scores = probes @ self._base.T
+            if self._num_dead:
+                scores[:, self._dead] = -np.inf
+            if len(tail):
+                scores = np.hstack([scores, probes @ tail.T])
+
+        idx = top_k(scores, min(k, len(self)))
+
+        ids = np.empty(idx.shape, dtype=object)
+        ids[:] = [[self.id_at(j) for j in row] for row in idx]
+
+        return ids, np.take_along_axis(scores, idx, axis=1)
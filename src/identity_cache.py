@@ -0,0 +1,86 @@
+# face ID -> display metadata (name, thumbnail path), so labelling a recognised face needs no query
+#
+# bulk-loaded next to the gallery and kept in least-recently-used order; beyond capacity the
+# coldest identities are evicted and fetched again on their next sighting. entries are refreshed
+# from the database wherever encodings change: Database write paths (attach_cache) and the
+# GalleryFeed listeners for writes made by other processes
+
+
+import threading
+
+from collections import OrderedDict, namedtuple
+
+
+Identity = namedtuple("Identity", ["first_name", "last_name", "thumbnail"])
+
+
+class IdentityCache:
+    def __init__(self, myDB, capacity=100000) -> None:
+        self.myDB = myDB
+        self.capacity = capacity
+
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, faceID) -> bool:
+        return faceID in self._entries
+
+    def _put(self, faceID: str, identity: Identity) -> None:
+        self._entries[faceID] = identity
+        self._entries.move_to_end(faceID)
+
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    # fills the cache with up to capacity identities in one query
+    def load(self) -> None:
+        identities = self.myDB.fetch_identities(limit=self.capacity)
+
+        with self._lock:
+            self._entries.clear()
+            for faceID, identity in identities.items():
+                self._put(faceID, Identity(*identity))
+
+    # metadata of faceID; a miss (evicted or enrolled since load) costs one query
+    def get(self, faceID: str) -> Identity:
+        with self._lock:
+            identity = self._entries.get(faceID)
+
+            if identity is not None:
+                self._entries.move_to_end(faceID)
+                self.counters["hits"] += 1
+                return identity
+
+            self.counters["misses"] += 1
+
+        fetched = self.myDB.fetch_identities([faceID]).get(faceID)
+        if fetched is None:
+            return None
+
+        identity = Identity(*fetched)
+
+        with self._lock:
+            self._put(faceID, identity)
+
+        return identity
+
+    def name(self, faceID: str) -> str:
+        identity = self.get(faceID)
+
+        return identity.first_name if identity is not None else "?unknown?"
+
+    # re-reads the given IDs; reloading (rather than dropping) keeps the fetch out of the camera loop
+    def refresh(self, ids: list) -> None:
+        identities = self.myDB.fetch_identities(list(ids))
+
+        with self._lock:
+            for faceID in ids:
+                self._entries.pop(faceID, None)
+            for faceID, identity in identities.items():
+                self._put(faceID, Identity(*identity))
@@ -7,22 +7,24 @@ from sface import SFace
 from yunet import YuNet
 
 
-# returns a cropped image using YuNet
+# returns the first face YuNet finds as a 160x160 thumbnail (with a margin of buffer/2 pixels) and
+# its YuNet row, which SFace.infer uses to align the face; (img, None) if there is no face
 def extract_face(img: np.ndarray, model: YuNet, buffer=20):
     results = model.infer(img)
     buffer_hlf = buffer//2
 
-    if len(results) > 0: 
-        face = results[0]
-        bbox = face[0:4].astype(np.int32)
- 
-        x1, y1 = bbox[0]-buffer_hlf, bbox[1]-buffer_hlf
-        x2, y2 = bbox[0] + bbox[2] + buffer_hlf, bbox[1] + bbox[3] + buffer_hlf
+    if len(results) == 0:
+        return img, None
 
-        output = img[y1:y2, x1:x2]
-        cv2.resize(output, (160, 160))
+    face = results[0]
+    bbox = face[0:4].astype(np.int32)
 
-    return output, len(results)
+    x1, y1 = max(bbox[0]-buffer_hlf, 0), max(bbox[1]-buffer_hlf, 0)
+    x2, y2 = bbox[0] + bbox[2] + buffer_hlf, bbox[1] + bbox[3] + buffer_hlf
+
+    output = cv2.resize(img[y1:y2, x1:x2], (160, 160))
+
+    return output, face
 
 
 # checks if the image is too bright/dark
@@ -1,33 +1,118 @@
 
+import batch_video
 import camera
+import cv2
+import metrics
+import recognition_server
+import os
+import runtime_config
+import snapshot
 import sys
 
 from camera import Camera
 from admin_window import AdminWindow
+from supervisor import Supervisor
+from database import Database
+import sinks
 
+from dotenv import load_dotenv
 
-FD_MODEL_PATH = "model/face_detection_yunet_2023mar.onnx"
-FR_MODEL_PATH = "model/face_recognition_sface_2021dec.onnx"
+
+# model files and DNN backends come from .env, or from a quick benchmark at startup (runtime_config.py);
+# .env can also turn on the metrics endpoint/dump (metrics.py)
+def select_runtime() -> runtime_config.RuntimeConfig:
+    load_dotenv()
+    metrics.start_from_env()
+
+    return runtime_config.select()
 
 def main(args: list[str]): 
 
     if len(args) == 1:
-        camera_obj0 = Camera(FD_MODEL_PATH, FR_MODEL_PATH, camera=0)
+        runtime = select_runtime()
+        camera_obj0 = Camera(runtime.fd_model_path, runtime.fr_model_path, camera=0,
+                             fd_target=runtime.fd_target, fr_target=runtime.fr_target)
         camera_obj0.camera_loop()
 
+    elif args[1] == "s":
+        # one supervisor for every camera index / video file that follows
+        runtime = select_runtime()
+        supervisor = Supervisor(runtime.fd_model_path, runtime.fr_model_path, sources=args[2:],
+                                fd_target=runtime.fd_target, fr_target=runtime.fr_target)
+        supervisor.run()
+
+    elif args[1] == "x":
+        # headless: x [camera index or video file] [socket=PATH] [video=PATH] [mjpeg=PORT]
+        options = dict(arg.split("=", 1) for arg in args[2:] if "=" in arg)
+        sources = [arg for arg in args[2:] if "=" not in arg]
+        source = sources[0] if sources else "0"
+
+        if "socket" in options:
+            record_sink = sinks.UnixSocketSink(options["socket"])
+        else:
+            # records own stdout; everything else printed goes to stderr
+            record_sink = sinks.JsonLinesSink(sys.stdout)
+            sys.stdout = sys.stderr
+
+        runtime = select_runtime()
+        camera_obj0 = Camera(runtime.fd_model_path, runtime.fr_model_path,
+                             camera=int(source) if source.isnumeric() else source,
+                             fd_target=runtime.fd_target, fr_target=runtime.fr_target)
+
+        frame_sinks = []
+        if "video" in options:
+            fps = camera_obj0.vid_stream.get(cv2.CAP_PROP_FPS) or 25.0
+            frame_sinks.append(sinks.VideoFileSink(options["video"], fps, (camera_obj0.width, camera_obj0.height)))
+        if "mjpeg" in options:
+            frame_sinks.append(sinks.MJPEGSink(int(options["mjpeg"])))
+
+        camera_obj0.headless_loop(record_sink, frame_sinks)
+
+    elif args[1] == "v":
+        # offline: v <video files> [--workers N] [--chunk-seconds S] [--stride N] [--timeline tracks|frames] [-o PATH]
+        batch_video.main(args[2:])
+
+    elif args[1] == "r":
+        # recognition server: r [--address PATH|HOST:PORT] [--max-batch N] [--max-wait-ms MS]
+        recognition_server.main(args[2:])
+
     elif len(args) == 2:
 
         if args[1] == "a":
             # run admin
-            admin_obj = AdminWindow(FD_MODEL_PATH, FR_MODEL_PATH)
+            runtime = select_runtime()
+            admin_obj = AdminWindow(runtime.fd_model_path, runtime.fr_model_path,
+                                    fd_target=runtime.fd_target, fr_target=runtime.fr_target)
         
+        elif args[1] == "m":
+            # rewrite pickled encodings in the binary format (embedding_format.py)
+            load_dotenv()
+            myDB = Database(
+                os.getenv("USER_NAME"), os.getenv("PASSWORD"),
+                os.getenv("DATABASE_NAME"), os.getenv("PORT_NUMBER")
+            )
+            myDB.migrate_encodings()
+            myDB.close_conn()
+
+        elif args[1] == "e":
+            # export the gallery snapshot cameras memory-map at startup (snapshot.py)
+            load_dotenv()
+            myDB = Database(
+                os.getenv("USER_NAME"), os.getenv("PASSWORD"),
+                os.getenv("DATABASE_NAME"), os.getenv("PORT_NUMBER")
+            )
+            snapshot.export_snapshot(myDB)
+            myDB.close_conn()
+
         elif args[1] == "h":
             cameras = camera.get_avail_cameras()
             print(cameras)
 
-        elif args[1].isnumeric:
+        elif args[1].isnumeric():
             camera_id = int(args[1])
-            camera_obj0 = Camera(FD_MODEL_PATH, FR_MODEL_PATH, camera=camera_id)
+            runtime = select_runtime()
+            camera_obj0 = Camera(runtime.fd_model_path, runtime.fr_model_path, camera=camera_id,
+                                 fd_target=runtime.fd_target, fr_target=runtime.fr_target)
             camera_obj0.camera_loop()
 
     print("good bye ;)")
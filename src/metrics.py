@@ -0,0 +1,196 @@
+# process-wide latency histograms and counters for live cameras
+#
+#   with metrics.timer("detect"): ...      rolling latency of a stage (seconds)
+#   metrics.observe("faces_per_frame", n)  rolling distribution of a value
+#   metrics.inc("unknown_faces")           monotonic counter
+#
+# everything is a no-op until enable() is called (main.py does when METRICS_PORT or
+# METRICS_DUMP_INTERVAL is set), so instrumented code costs one flag check when metrics are off.
+# serve() exposes the Prometheus text format at /metrics; dump_every() prints the same periodically
+
+import os
+import sys
+import threading
+import time
+
+from collections import deque
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+PREFIX = "panopticon_"
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+# the last `window` values of one series plus all-time count and sum
+class Histogram:
+    def __init__(self, window=1024) -> None:
+        self.values = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.values.append(value)
+        self.count += 1
+        self.sum += value
+
+    def quantiles(self) -> dict:
+        if not self.values:
+            return {q: 0.0 for q in QUANTILES}
+
+        return dict(zip(QUANTILES, np.quantile(np.fromiter(self.values, dtype=np.float64), QUANTILES).tolist()))
+
+
+class _Timer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+_enabled = False
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+
+
+def enable() -> None:
+    global _enabled
+    _enabled = True
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def observe(name: str, value: float) -> None:
+    if not _enabled:
+        return
+
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.observe(value)
+
+
+def inc(name: str, amount=1) -> None:
+    if not _enabled:
+        return
+
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+# times the with-block into the "<stage>_seconds" histogram
+def timer(stage: str):
+    return _Timer(stage + "_seconds") if _enabled else _NO_TIMER
+
+
+# decorator form of timer for whole functions/methods
+def timed(stage: str):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+
+            with _Timer(stage + "_seconds"):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# Prometheus text exposition format; histograms are reported as summaries
+def render() -> str:
+    with _lock:
+        histograms = {name: (h.quantiles(), h.count, h.sum) for name, h in _histograms.items()}
+        counters = dict(_counters)
+
+    lines = []
+
+    for name, (quantiles, count, total) in sorted(histograms.items()):
+        lines.append("# TYPE {}{} summary".format(PREFIX, name))
+        for q, value in quantiles.items():
+            lines.append('{}{}{{quantile="{}"}} {:.6g}'.format(PREFIX, name, q, value))
+        lines.append("{}{}_count {}".format(PREFIX, name, count))
+        lines.append("{}{}_sum {:.6g}".format(PREFIX, name, total))
+
+    for name, value in sorted(counters.items()):
+        lines.append("# TYPE {}{}_total counter".format(PREFIX, name))
+        lines.append("{}{}_total {}".format(PREFIX, name, value))
+
+    return "\n".join(lines) + "\n"
+
+
+# serves render() at http://host:port/metrics from a daemon thread
+def serve(port: int, host="0.0.0.0") -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+    print("Metrics at http://{}:{}/metrics".format(host, port))
+
+    return server
+
+
+# writes render() to stream every interval seconds from a daemon thread
+def dump_every(interval: float, stream=sys.stderr) -> None:
+    def run():
+        while True:
+            time.sleep(interval)
+            stream.write(render())
+            stream.flush()
+
+    threading.Thread(target=run, name="metrics-dump", daemon=True).start()
+
+
+# METRICS_PORT serves /metrics, METRICS_DUMP_INTERVAL (seconds) dumps to stderr; with neither, metrics stay off
+def start_from_env() -> None:
+    port = os.getenv("METRICS_PORT")
+    interval = os.getenv("METRICS_DUMP_INTERVAL")
+
+    if port or interval:
+        enable()
+    if port:
+        serve(int(port))
+    if interval:
+        dump_every(float(interval))
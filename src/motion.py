@@ -0,0 +1,71 @@
+# motion gating for the camera loop
+#
+# every frame is shrunk to a small grey thumbnail and compared with the thumbnail of the last
+# frame inference ran on. while the scene changes, every frame is inferred; once nothing has moved
+# for cooldown frames the camera goes idle and only infers every idle_interval seconds (so a face
+# that walked in very slowly is still picked up). the first moving frame ends the idle state
+# immediately; skipped frames are drawn with the overlays of the last inferred frame
+
+import time
+
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    def __init__(self, size=(64, 48), pixel_threshold=12, motion_threshold=0.01, cooldown=15, idle_interval=1.0) -> None:
+        self.size = size  # thumbnail (w, h) the difference is computed on
+        self.pixel_threshold = pixel_threshold  # grey-level change that counts a thumbnail pixel as moved
+        self.motion_threshold = motion_threshold  # share of moved pixels that counts as motion
+        self.cooldown = cooldown  # still frames before going idle
+        self.idle_interval = idle_interval  # seconds between inferences while idle
+
+        self.counters = {"frames": 0, "inferred": 0, "skipped": 0}
+
+        self._small = np.empty((size[1], size[0], 3), dtype=np.uint8)
+        self._grey = np.empty((size[1], size[0]), dtype=np.uint8)
+        self._diff = np.empty_like(self._grey)
+        self._reference = None  # thumbnail of the last inferred frame
+
+        self._still = 0
+        self._last_inferred = 0.0
+
+    @property
+    def idle(self) -> bool:
+        return self._still >= self.cooldown
+
+    # share of thumbnail pixels that changed since the last inferred frame
+    def motion(self, frame: np.ndarray) -> float:
+        cv2.resize(frame, self.size, dst=self._small, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self._small, cv2.COLOR_BGR2GRAY, dst=self._grey)
+
+        if self._reference is None:
+            return 1.0
+
+        cv2.absdiff(self._grey, self._reference, dst=self._diff)
+
+        return cv2.countNonZero(cv2.threshold(self._diff, self.pixel_threshold, 255, cv2.THRESH_BINARY)[1]) / self._diff.size
+
+    # True when detection and recognition should run on frame
+    def update(self, frame: np.ndarray) -> bool:
+        self.counters["frames"] += 1
+        now = time.perf_counter()
+
+        if self.motion(frame) > self.motion_threshold:
+            self._still = 0
+        else:
+            self._still += 1
+
+        infer = not self.idle or now - self._last_inferred >= self.idle_interval
+
+        if infer:
+            if self._reference is None:
+                self._reference = self._grey.copy()
+            else:
+                np.copyto(self._reference, self._grey)
+            self._last_inferred = now
+            self.counters["inferred"] += 1
+        else:
+            self.counters["skipped"] += 1
+
+        return infer
@@ -0,0 +1,212 @@
+# multi-threaded capture -> detect -> recognise -> render pipeline for Camera
+#
+# every stage runs on its own thread and hands frames on through a small bounded queue;
+# a full queue drops its oldest frame instead of blocking, so a slow stage costs frames, not latency
+
+import threading
+import time
+
+from collections import deque
+
+import cv2
+import numpy as np
+
+import metrics
+
+
+class DropOldestQueue:
+    def __init__(self, maxsize=2) -> None:
+        self.maxsize = maxsize
+        self.dropped = 0
+
+        self._items = deque()
+        self._cond = threading.Condition()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    # never blocks; evicts the oldest item when full
+    def put(self, item) -> None:
+        with self._cond:
+            if len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.dropped += 1
+
+            self._items.append(item)
+            self._cond.notify()
+
+    # returns None if nothing arrived within timeout
+    def get(self, timeout=0.1):
+        with self._cond:
+            if not self._items:
+                self._cond.wait(timeout)
+
+            return self._items.popleft() if self._items else None
+
+
+# rolling latency window of one stage
+class StageStats:
+    def __init__(self, window=120) -> None:
+        self.latencies = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, seconds: float) -> None:
+        self.latencies.append(seconds)
+        self.count += 1
+
+    def summary(self) -> dict:
+        if not self.latencies:
+            return {"count": self.count, "p50_ms": 0.0, "p95_ms": 0.0, "max_ms": 0.0}
+
+        lat = np.asarray(self.latencies) * 1e3
+
+        return {
+            "count": self.count,
+            "p50_ms": float(np.percentile(lat, 50)),
+            "p95_ms": float(np.percentile(lat, 95)),
+            "max_ms": float(lat.max()),
+        }
+
+
+class Stage(threading.Thread):
+    # fn takes a packet dict and returns it (or None to drop the frame)
+    def __init__(self, name: str, fn, is_on: threading.Event, in_q=None, out_q=None) -> None:
+        super().__init__(name=name, daemon=True)
+
+        self.fn = fn
+        self.is_on = is_on
+        self.in_q = in_q
+        self.out_q = out_q
+        self.stats = StageStats()
+
+    def run(self) -> None:
+        while self.is_on.is_set():
+            if self.in_q is None:
+                packet = {}
+            else:
+                packet = self.in_q.get()
+                if packet is None:
+                    continue
+
+            start = time.perf_counter()
+            packet = self.fn(packet)
+            self.stats.add(time.perf_counter() - start)
+
+            if packet is not None and self.out_q is not None:
+                self.out_q.put(packet)
+
+
+class CameraPipeline:
+    def __init__(self, camera, queue_size=2) -> None:
+        self.camera = camera
+        self.is_on = camera.is_on  # shared with Camera so one clear() stops every stage
+
+        self.detect_q = DropOldestQueue(queue_size)
+        self.recognise_q = DropOldestQueue(queue_size)
+        self.render_q = DropOldestQueue(queue_size)
+
+        self.stages = [
+            Stage("capture", self.capture, self.is_on, out_q=self.detect_q),
+            Stage("detect", self.detect, self.is_on, self.detect_q, self.recognise_q),
+            Stage("recognise", self.recognise, self.is_on, self.recognise_q, self.render_q),
+        ]
+        self.render_stats = StageStats()
+        self.end_to_end = StageStats()  # capture -> on screen
+
+        self._frame_id = 0
+        self._render_times = deque(maxlen=60)
+        self._faces = []  # overlays of the last inferred frame, drawn on skipped ones
+
+    def capture(self, packet: dict) -> dict:
+        with metrics.timer("capture"):
+            hasFrame, frame = self.camera.vid_stream.read()
+
+        if not hasFrame:
+            print("no frame :(")
+            self.is_on.clear()
+            return None
+
+        self._frame_id += 1
+        packet["id"] = self._frame_id
+        packet["t_capture"] = time.perf_counter()
+        packet["frame"] = frame
+
+        # frames without motion still flow through every stage (keeping them in order) but skip the work
+        packet["infer"] = self.camera.should_infer(frame)
+
+        return packet
+
+    def detect(self, packet: dict) -> dict:
+        if packet["infer"]:
+            packet["detections"] = self.camera.detector.detect(packet["frame"])
+
+        return packet
+
+    def recognise(self, packet: dict) -> dict:
+        if packet["infer"]:
+            packet["faces"] = self.camera.recognise(packet["frame"], packet["detections"])
+
+        return packet
+
+    # frames/sec actually reaching the screen
+    def fps(self) -> float:
+        times = self._render_times
+        if len(times) < 2:
+            return 0.0
+
+        return (len(times) - 1) / max(times[-1] - times[0], 1e-9)
+
+    # per-stage latency percentiles and queue depths
+    def stats(self) -> dict:
+        stats = {stage.name: stage.stats.summary() for stage in self.stages}
+        stats["render"] = self.render_stats.summary()
+        stats["end_to_end"] = self.end_to_end.summary()
+        stats["fps"] = self.fps()
+
+        tracker = getattr(self.camera, "tracker", None)
+        if tracker is not None:
+            stats["tracker"] = dict(tracker.counters, hit_rate=tracker.hit_rate())
+
+        motion = getattr(self.camera, "motion", None)
+        if motion is not None:
+            stats["motion"] = dict(motion.counters, idle=motion.idle)
+
+        for name, q in (("detect", self.detect_q), ("recognise", self.recognise_q), ("render", self.render_q)):
+            stats[name]["queue_depth"] = len(q)
+            stats[name]["dropped"] = q.dropped
+
+        return stats
+
+    # runs the worker stages in the background and renders on the calling (GUI) thread
+    def run(self) -> None:
+        self.is_on.set()
+
+        for stage in self.stages:
+            stage.start()
+
+        while self.is_on.is_set():
+            packet = self.render_q.get()
+
+            if packet is not None:
+                start = time.perf_counter()
+                self._render_times.append(start)
+
+                self._faces = packet.get("faces", self._faces)
+
+                frame = self.camera.draw(packet["frame"], self._faces, fps=self.fps())
+                cv2.imshow("camera", frame)
+
+                now = time.perf_counter()
+                self.render_stats.add(now - start)
+                self.end_to_end.add(now - packet["t_capture"])
+
+            if cv2.waitKey(1) & 0xFF == ord("q"):
+                self.is_on.clear()
+
+        for stage in self.stages:
+            stage.join(timeout=1.0)
+
+        self.camera.vid_stream.release()
+
+        for name, summary in self.stats().items():
+            print("{}: {}".format(name, summary))
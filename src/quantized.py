@@ -0,0 +1,205 @@
+# compressed gallery: float16 or int8 (one float32 scale per row) codes for the scan, float32 for re-ranking
+#
+# every search scores the probes against the codes, keeps the `rerank` best candidates per probe and
+# re-scores only those against the float32 rows, so distances and the threshold decision stay exact.
+# the float32 rows are Gallery's own: with a memory-mapped snapshot (load_base) they stay on disk and
+# only candidate rows are ever paged in, leaving the codes as the only per-process copy (128 or 256
+# bytes per identity instead of 512). loaded from the database (load_matrix) the float32 rows are
+# held too, so the memory saving needs a snapshot (main.py e)
+
+import numpy as np
+
+from gallery import Gallery, NORM_L2, locked, top_k
+
+
+PRECISIONS = ("float16", "int8")
+BLOCK_ROWS = 16384  # rows decoded to float32 at a time while scanning or quantizing
+
+
+# (codes, scales) of unit-length float32 rows; scales is None for float16
+def quantize(embs: np.ndarray, precision: str) -> tuple:
+    if precision == "float16":
+        return embs.astype(np.float16), None
+
+    # symmetric per-row scale: the largest component maps to +-127
+    scales = np.abs(embs).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.rint(embs / scales[:, None]).astype(np.int8)
+
+    return codes, scales.astype(np.float32)
+
+
+class QuantizedGallery(Gallery):
+    def __init__(self, disType=NORM_L2, threshold=None, dim=128, precision="int8", rerank=16) -> None:
+        assert precision in PRECISIONS, "precision must be one of {}".format(PRECISIONS)
+        self.precision = precision
+        self.rerank = rerank  # candidates per probe re-scored in float32; 0 returns the approximate scores
+
+        super().__init__(disType, threshold, dim)
+
+        self._base_codes, self._base_scales = self._empty_codes(0)
+        self._tail_codes, self._tail_scales = self._empty_codes(0)
+
+    def _reset(self) -> None:
+        super()._reset()
+
+        self._base_codes, self._base_scales = self._empty_codes(0)
+        self._tail_codes, self._tail_scales = self._empty_codes(0)
+
+    def _empty_codes(self, n: int) -> tuple:
+        if self.precision == "float16":
+            return np.empty((n, self.dim), dtype=np.float16), None
+
+        return np.empty((n, self.dim), dtype=np.int8), np.empty(n, dtype=np.float32)
+
+    # quantizes in blocks so a memory-mapped base is read once and never held in memory as float32
+    def _quantize_rows(self, embs: np.ndarray) -> tuple:
+        codes, scales = self._empty_codes(len(embs))
+
+        for start in range(0, len(embs), BLOCK_ROWS):
+            block_codes, block_scales = quantize(np.asarray(embs[start:start + BLOCK_ROWS], dtype=np.float32), self.precision)
+            codes[start:start + len(block_codes)] = block_codes
+            if scales is not None:
+                scales[start:start + len(block_codes)] = block_scales
+
+        return codes, scales
+
+    # code bytes per identity, the memory this gallery holds on top of the float32 rows it re-ranks from
+    @property
+    def bytes_per_identity(self) -> int:
+        return self.dim * (2 if self.precision == "float16" else 1) + (0 if self.precision == "float16" else 4)
+
+    # bytes of the codes alone
+    @property
+    def nbytes(self) -> int:
+        total = self._base_codes.nbytes + self._tail_codes.nbytes
+
+        if self._base_scales is not None:
+            total += self._base_scales.nbytes + self._tail_scales.nbytes
+
+        return total
+
+    # codes plus the float32 rows held in this process (all of them after load_matrix, only the tail after load_base)
+    @property
+    def resident_bytes(self) -> int:
+        return super().resident_bytes + self.nbytes
+
+    @locked
+    def load_matrix(self, ids: list, embs: np.ndarray) -> "QuantizedGallery":
+        super().load_matrix(ids, embs)
+
+        self._tail_codes, self._tail_scales = self._quantize_rows(self._buf)
+
+        return self
+
+    @locked
+    def load_base(self, ids: list, embs: np.ndarray) -> "QuantizedGallery":
+        super().load_base(ids, embs)
+
+        self._base_codes, self._base_scales = self._quantize_rows(embs)
+
+        return self
+
+    @locked
+    def upsert(self, faceID, encoding: np.ndarray) -> None:
+        super().upsert(faceID, encoding)
+
+        # the tail codes grow with Gallery's tail buffer
+        if len(self._tail_codes) < len(self._buf):
+            codes, scales = self._empty_codes(len(self._buf))
+            n = len(self._tail_ids) - 1
+            codes[:n] = self._tail_codes[:n]
+            if scales is not None:
+                scales[:n] = self._tail_scales[:n]
+            self._tail_codes, self._tail_scales = codes, scales
+
+        row = self._rows[faceID] - len(self._base_ids)
+        codes, scales = quantize(self._buf[row:row + 1], self.precision)
+        self._tail_codes[row] = codes[0]
+        if scales is not None:
+            self._tail_scales[row] = scales[0]
+
+    @locked
+    def remove(self, faceID) -> bool:
+        row = self._rows.get(faceID)
+        last = len(self._base_ids) + len(self._tail_ids) - 1
+
+        if not super().remove(faceID):
+            return False
+
+        # Gallery moved the last tail row into the freed one; move its code the same way
+        if row >= len(self._base_ids) and row != last:
+            row -= len(self._base_ids)
+            last -= len(self._base_ids)
+            self._tail_codes[row] = self._tail_codes[last]
+            if self._tail_scales is not None:
+                self._tail_scales[row] = self._tail_scales[last]
+
+        return True
+
+    # approximate cosine scores of unit-length probes against every column (base rows, then tail rows)
+    def _coarse_scores(self, probes: np.ndarray) -> np.ndarray:
+        nbase = len(self._base_ids)
+        ntail = len(self._tail_ids)
+
+        scores = np.empty((len(probes), nbase + ntail), dtype=np.float32)
+        block = np.empty((min(BLOCK_ROWS, max(nbase, ntail)), self.dim), dtype=np.float32)
+
+        for codes, scales, offset, n in ((self._base_codes, self._base_scales, 0, nbase),
+                                         (self._tail_codes, self._tail_scales, nbase, ntail)):
+            for start in range(0, n, BLOCK_ROWS):
+                m = min(BLOCK_ROWS, n - start)
+                np.copyto(block[:m], codes[start:start + m])
+
+                out = scores[:, offset + start:offset + start + m]
+                np.matmul(probes, block[:m].T, out=out)
+                if scales is not None:
+                    out *= scales[start:start + m]
+
+        if self._num_dead:
+            scores[:, :nbase][:, self._dead] = -np.inf
+
+        return scores
+
+    # float32 rows behind the given columns
+    def _exact_rows(self, cols: np.ndarray) -> np.ndarray:
+        nbase = len(self._base_ids)
+        rows = np.empty((len(cols), self.dim), dtype=np.float32)
+
+        in_base = cols < nbase
+        rows[in_base] = self._base[cols[in_base]]
+        rows[~in_base] = self._buf[cols[~in_base] - nbase]
+
+        return rows
+
+    @locked
+    def search_scores(self, probes: np.ndarray, k=1) -> tuple:
+        if len(self) == 0:
+            return (
+                np.empty((len(probes), 0), dtype=object),
+                np.empty((len(probes), 0), dtype=np.float32),
+            )
+
+        k = min(k, len(self))
+
+        scores = self._coarse_scores(probes)
+        idx = top_k(scores, max(k, self.rerank))
+
+        if self.rerank:
+            cand = np.empty(idx.shape, dtype=np.float32)
+            for i in range(len(probes)):
+                cand[i] = self._exact_rows(idx[i]) @ probes[i]
+
+            # dead base rows can only be candidates when fewer live rows than rerank slots exist
+            cand[np.isneginf(np.take_along_axis(scores, idx, axis=1))] = -np.inf
+
+            best = top_k(cand, k)
+            idx = np.take_along_axis(idx, best, axis=1)
+            best_scores = np.take_along_axis(cand, best, axis=1)
+        else:
+            best_scores = np.take_along_axis(scores, idx, axis=1)
+
+        ids = np.empty(idx.shape, dtype=object)
+        ids[:] = [[self.id_at(j) for j in row] for row in idx]
+
+        return ids, best_scores
@@ -0,0 +1,470 @@
+# local recognition server: one copy of YuNet, SFace and the gallery shared by many clients
+#
+# clients connect over a Unix socket (or TCP, "host:port") and send frames, or face crops they
+# aligned themselves (alignment.FaceAligner). requests arriving together are collected into one
+# micro-batch: a batch closes when it holds --max-batch requests or when its oldest request has
+# waited --max-wait-ms, and while a batch runs the next one fills up, so batches grow with load.
+# YuNet has no batched forward pass, so frames are still detected one by one on the model thread;
+# what is batched is the rest: all faces of all requests are embedded in one SFace pass and matched
+# with one gallery call. at most --max-queue requests wait at a time (a client whose request finds
+# the queue full is not read from until there is room) and messages over --max-message-mb are
+# refused, so overload pushes back on clients instead of growing memory. batch sizes, queue wait and throughput come back from a "stats" request
+# (and go to metrics.py when it is on). run `python src/recognition_server.py`, use RecognitionClient
+#
+# wire format (wire.py), both ways: 8-byte header (JSON length, payload length, big-endian), JSON, payload
+#   {"id": 1, "kind": "frame", "shape": [h, w, 3]}       payload: raw BGR bytes
+#   {"id": 2, "kind": "frame", "jpeg": true}              payload: JPEG bytes
+#   {"id": 3, "kind": "crops", "count": n}                payload: n aligned 112x112 BGR crops
+#   {"id": 4, "kind": "stats"}
+# replies: {"id": ..., "faces": [{"box", "id", "name", "dist", "recognised"}], "batch_size", "queue_ms"}
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import metrics
+import runtime_config
+import snapshot
+from alignment import CROP_SIZE, FaceAligner
+from ann_index import make_index
+from camera import crop_face_box
+from change_feed import GalleryFeed
+from database import Database
+from detection import AdaptiveDetector
+from identity_cache import IdentityCache
+from sface import SFace
+from wire import HEADER, encode_message, parse_address
+from yunet import YuNet
+
+from dotenv import load_dotenv
+
+
+DEFAULT_ADDRESS = "/tmp/panopticon-recognition.sock"
+
+MAX_HEADER = 64 * 1024  # bytes of JSON per message
+MAX_MESSAGE = 32 * 1024 * 1024  # bytes of payload per message: a raw 4K frame fits
+
+
+class MessageTooLarge(ValueError):
+    pass
+
+
+# checks the lengths before reading, so an oversized message is never buffered
+async def read_message(reader: asyncio.StreamReader, max_payload=MAX_MESSAGE) -> tuple:
+    body_len, payload_len = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if body_len > MAX_HEADER or payload_len > max_payload:
+        raise MessageTooLarge("message of {} + {} bytes is over the limit of {} + {}".format(
+            body_len, payload_len, MAX_HEADER, max_payload))
+
+    header = json.loads(await reader.readexactly(body_len))
+    payload = await reader.readexactly(payload_len) if payload_len else b""
+
+    return header, payload
+
+
+class Request:
+    __slots__ = ("header", "payload", "future", "arrived")
+
+    def __init__(self, header: dict, payload: bytes, future) -> None:
+        self.header = header
+        self.payload = payload
+        self.future = future
+        self.arrived = time.perf_counter()
+
+
+class RecognitionServer:
+    def __init__(self, detector, recognizer, gallery, identities, myDB=None, max_batch=32, max_wait=0.005,
+                 max_queue=256, max_message=MAX_MESSAGE) -> None:
+        self.detector = detector
+        self.recognizer = recognizer
+        self.gallery = gallery
+        self.identities = identities
+        self.myDB = myDB
+
+        self.max_batch = max_batch
+        self.max_wait = max_wait  # seconds the oldest request of a batch may wait for company
+        self.max_queue = max_queue  # requests waiting for a batch, beyond which clients are not read from
+        self.max_message = max_message
+
+        self.aligner = FaceAligner(capacity=4 * max_batch)
+
+        # one thread runs the models, so batches never overlap and the models are never shared
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recognition")
+        self._queue = None
+
+        self.batch_sizes = metrics.Histogram()
+        self.queue_waits = metrics.Histogram()
+        self.batch_times = metrics.Histogram()
+        self.counters = {"requests": 0, "faces": 0, "batches": 0}
+        self._started = time.perf_counter()
+        self._stats_lock = threading.Lock()
+
+    # aligned crops of one request written to the aligner's buffer from row `rows` on; returns (n, boxes or None)
+    def _prepare(self, header: dict, payload: bytes, rows: int) -> tuple:
+        if header["kind"] == "crops":
+            n = header["count"]
+            crops = np.frombuffer(payload, dtype=np.uint8).reshape(n, CROP_SIZE, CROP_SIZE, 3)
+            np.copyto(self.aligner.buffer(rows + n)[rows:], crops)
+            return n, None
+
+        if header.get("jpeg"):
+            frame = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if frame is None:
+                raise ValueError("payload is not a decodable image")
+        else:
+            frame = np.frombuffer(payload, dtype=np.uint8).reshape(header["shape"])
+
+        # YuNet takes one image per forward pass, so frames are detected one by one; only embedding
+        # and matching are batched across requests
+        dets = self.detector.detect(frame)
+        self.aligner.align(frame, dets, offset=rows)
+
+        return len(dets), [[int(v) for v in crop_face_box(det)] for det in dets]
+
+    # runs on the model thread; returns one reply (without id) per request. a request that cannot be
+    # decoded or detected gets its own error reply and takes no rows, the rest of the batch goes on
+    def _run_batch(self, requests: list) -> list:
+        spans = []  # (first crop row, number of crops, boxes or None) per request, or an error reply
+        rows = 0
+
+        for request in requests:
+            try:
+                n, boxes = self._prepare(request.header, request.payload, rows)
+            except Exception as e:
+                spans.append({"error": repr(e)})
+                continue
+
+            spans.append((rows, n, boxes))
+            rows += n
+
+        with metrics.timer("embed"):
+            embs = self.recognizer.infer_aligned(self.aligner.buffer(rows))
+
+        with metrics.timer("match"):
+            matches = self.gallery.match(embs) if rows else []
+
+        replies = []
+        for request, span in zip(requests, spans):
+            if isinstance(span, dict):
+                replies.append(span)
+                continue
+
+            start, n, boxes = span
+            faces = []
+            for i, (faceID, dist, is_recognised) in enumerate(matches[start:start + n]):
+                face = {
+                    "id": faceID if is_recognised else None,
+                    "name": self.identities.name(faceID) if is_recognised else "?unknown?",
+                    "dist": None if np.isnan(dist) else float(dist),
+                    "recognised": is_recognised,
+                }
+                if boxes is not None:
+                    face["box"] = boxes[i]
+                faces.append(face)
+
+                source = request.header.get("source")
+                if is_recognised and source is not None and self.myDB is not None:
+                    self.myDB.log_event(faceID, "Seen on camera {}.".format(source), dedupe=True)
+
+            replies.append({"faces": faces})
+
+        return replies
+
+    # takes the oldest request, then whatever else arrives before its deadline, up to max_batch
+    async def _next_batch(self) -> list:
+        first = await self._queue.get()
+        batch = [first]
+        deadline = first.arrived + self.max_wait
+
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                else:
+                    batch.append(self._queue.get_nowait())  # backlog: take what is already queued
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+
+        return batch
+
+    async def _batcher(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = await self._next_batch()
+            start = time.perf_counter()
+
+            try:
+                replies = await loop.run_in_executor(self._executor, self._run_batch, batch)
+            except Exception as e:
+                replies = [{"error": repr(e)}] * len(batch)
+
+            elapsed = time.perf_counter() - start
+            self._record(batch, replies, start, elapsed)
+
+            for request, reply in zip(batch, replies):
+                reply = dict(reply, batch_size=len(batch), queue_ms=(start - request.arrived) * 1e3)
+                if not request.future.done():
+                    request.future.set_result(reply)
+
+    def _record(self, batch: list, replies: list, start: float, elapsed: float) -> None:
+        faces = sum(len(reply.get("faces", ())) for reply in replies)
+
+        with self._stats_lock:
+            self.batch_sizes.observe(len(batch))
+            self.batch_times.observe(elapsed)
+            for request in batch:
+                self.queue_waits.observe(start - request.arrived)
+
+            self.counters["requests"] += len(batch)
+            self.counters["faces"] += faces
+            self.counters["batches"] += 1
+
+        metrics.observe("server_batch_size", len(batch))
+        metrics.observe("server_batch_seconds", elapsed)
+        for request in batch:
+            metrics.observe("server_queue_wait_seconds", start - request.arrived)
+        metrics.inc("server_requests", len(batch))
+        metrics.inc("server_faces", faces)
+
+    # capacity planning numbers: rolling batch size, queue wait and batch time, all-time throughput
+    def stats(self) -> dict:
+        with self._stats_lock:
+            uptime = time.perf_counter() - self._started
+            sizes = self.batch_sizes.quantiles()
+            waits = self.queue_waits.quantiles()
+            times = self.batch_times.quantiles()
+            counters = dict(self.counters)
+            mean_size = self.batch_sizes.sum / self.batch_sizes.count if self.batch_sizes.count else 0.0
+
+        return dict(
+            counters,
+            uptime_s=uptime,
+            requests_per_s=counters["requests"] / uptime,
+            faces_per_s=counters["faces"] / uptime,
+            queue_depth=self._queue.qsize() if self._queue is not None else 0,
+            batch_size={"mean": mean_size, "p50": sizes[0.5], "p95": sizes[0.95], "p99": sizes[0.99]},
+            queue_wait_ms={"p50": waits[0.5] * 1e3, "p95": waits[0.95] * 1e3, "p99": waits[0.99] * 1e3},
+            batch_ms={"p50": times[0.5] * 1e3, "p95": times[0.95] * 1e3, "p99": times[0.99] * 1e3},
+        )
+
+    # malformed requests are answered straight away; what only shows when decoding (a corrupt JPEG)
+    # fails that request alone inside _run_batch
+    def _check(self, header: dict, payload: bytes):
+        kind = header.get("kind")
+
+        if kind == "crops":
+            count = header.get("count")
+            if not (type(count) is int and count >= 0):
+                return "count must be a non-negative integer"
+            expected = count * CROP_SIZE * CROP_SIZE * 3
+        elif kind == "frame" and header.get("jpeg"):
+            return None if payload else "empty JPEG"
+        elif kind == "frame":
+            shape = header.get("shape")
+            if not (isinstance(shape, list) and len(shape) == 3 and shape[2] == 3
+                    and all(type(d) is int and d > 0 for d in shape)):
+                return "frame shape must be [h, w, 3] with positive integer h and w"
+            expected = shape[0] * shape[1] * 3
+        else:
+            return "unknown kind {!r}".format(kind)
+
+        return None if len(payload) == expected else "payload is {} bytes, expected {}".format(len(payload), expected)
+
+    # a future for the reply; waits for room in the queue, and with it the reading of the client's next message
+    async def _submit(self, header: dict, payload: bytes):
+        future = asyncio.get_running_loop().create_future()
+
+        if header.get("kind") == "stats":
+            future.set_result(self.stats())
+        elif self._check(header, payload) is not None:
+            future.set_result({"error": self._check(header, payload)})
+        else:
+            await self._queue.put(Request(header, payload, future))
+
+        return future
+
+    async def _answer(self, header: dict, future, writer: asyncio.StreamWriter) -> None:
+        reply = await future
+
+        writer.write(encode_message(dict(reply, id=header.get("id"))))
+        await writer.drain()
+
+    # a client may pipeline requests; replies carry the request's id and can come back out of order
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        tasks = set()
+
+        try:
+            while True:
+                header, payload = await read_message(reader, self.max_message)
+                future = await self._submit(header, payload)
+
+                task = asyncio.create_task(self._answer(header, future, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass  # client went away
+        except ValueError as e:
+            # oversized or unparsable: the stream cannot be followed any further
+            writer.write(encode_message({"id": None, "error": str(e)}))
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def serve(self, address=DEFAULT_ADDRESS) -> None:
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._started = time.perf_counter()
+
+        target = parse_address(address)
+        if isinstance(target, tuple):
+            server = await asyncio.start_server(self._handle_client, *target)
+        else:
+            if os.path.exists(target):
+                os.remove(target)
+            server = await asyncio.start_unix_server(self._handle_client, target)
+
+        print("Recognition server on {} (batches of up to {}, {:.1f} ms wait)".format(
+            address, self.max_batch, self.max_wait * 1e3))
+
+        batcher = asyncio.create_task(self._batcher())
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self._executor.shutdown(wait=False)
+            if not isinstance(target, tuple) and os.path.exists(target):
+                os.remove(target)
+
+
+# blocking client, one request at a time (use one client per thread)
+class RecognitionClient:
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=10.0) -> None:
+        target = parse_address(address)
+        family = socket.AF_INET if isinstance(target, tuple) else socket.AF_UNIX
+
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(target)
+
+        self._next_id = 0
+
+    def _recv_exactly(self, n: int) -> bytes:
+        data = bytearray()
+        while len(data) < n:
+            chunk = self._sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("recognition server closed the connection")
+            data += chunk
+
+        return bytes(data)
+
+    def request(self, header: dict, payload=b"") -> dict:
+        self._next_id += 1
+        self._sock.sendall(encode_message(dict(header, id=self._next_id), payload))
+
+        body_len, _ = HEADER.unpack(self._recv_exactly(HEADER.size))
+        reply = json.loads(self._recv_exactly(body_len))
+
+        if "error" in reply:
+            raise RuntimeError("recognition server: {}".format(reply["error"]))
+
+        return reply
+
+    # faces in a BGR frame: [{"box", "id", "name", "dist", "recognised"}]; jpeg=True sends it compressed
+    def recognise_frame(self, frame: np.ndarray, source=None, jpeg=False) -> list:
+        header = {"kind": "frame"}
+        if source is not None:
+            header["source"] = source  # logs sightings as "Seen on camera <source>."
+
+        if jpeg:
+            header["jpeg"] = True
+            payload = cv2.imencode(".jpg", frame)[1].tobytes()
+        else:
+            header["shape"] = list(frame.shape)
+            payload = np.ascontiguousarray(frame).tobytes()
+
+        return self.request(header, payload)["faces"]
+
+    # identities of (n, 112, 112, 3) crops aligned with alignment.FaceAligner
+    def recognise_crops(self, crops: np.ndarray) -> list:
+        crops = np.ascontiguousarray(crops, dtype=np.uint8).reshape(-1, CROP_SIZE, CROP_SIZE, 3)
+
+        return self.request({"kind": "crops", "count": len(crops)}, crops.tobytes())["faces"]
+
+    def stats(self) -> dict:
+        return self.request({"kind": "stats"})
+
+    def close(self) -> None:
+        self._sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recognition server with dynamic micro-batching")
+    parser.add_argument("--address", default=DEFAULT_ADDRESS, help="Unix socket path or host:port")
+    parser.add_argument("--max-batch", type=int, default=32, help="most requests per batch")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0, help="longest a request waits for a batch to fill")
+    parser.add_argument("--max-queue", type=int, default=256, help="most requests waiting for a batch")
+    parser.add_argument("--max-message-mb", type=float, default=MAX_MESSAGE / 2 ** 20, help="largest payload accepted")
+    parser.add_argument("--index", default="exact", help="gallery kind, see ann_index.make_index")
+    parser.add_argument("--detect-scale", type=float, default=0.5)
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    metrics.start_from_env()
+    runtime = runtime_config.select()
+
+    myDB = Database(
+        os.getenv("USER_NAME"), os.getenv("PASSWORD"),
+        os.getenv("DATABASE_NAME"), os.getenv("PORT_NUMBER")
+    )
+
+    gallery = make_index(args.index, disType=1)
+    watermark = snapshot.load_gallery(gallery, myDB)
+    identities = IdentityCache(myDB)
+    identities.load()
+    myDB.attach_index(gallery)
+    myDB.attach_cache(identities)
+
+    # a remote gallery (--index sharded) is kept current by the shard service itself
+    feed = None
+    if not gallery.is_remote:
+        feed = GalleryFeed(gallery, myDB, watermark)
+        feed.listeners.append(identities.refresh)
+        feed.start()
+
+    # frames come from unrelated clients, so faces are never followed between them (full_frame_every=1)
+    detector = AdaptiveDetector(
+        YuNet(modelPath=runtime.fd_model_path, confThreshold=0.8, backendId=runtime.fd_target[0], targetId=runtime.fd_target[1]),
+        scale=args.detect_scale, full_frame_every=1,
+    )
+    recognizer = SFace(modelPath=runtime.fr_model_path, disType=1, backendId=runtime.fr_target[0], targetId=runtime.fr_target[1])
+
+    server = RecognitionServer(detector, recognizer, gallery, identities, myDB, args.max_batch, args.max_wait_ms / 1e3,
+                               args.max_queue, int(args.max_message_mb * 2 ** 20))
+
+    try:
+        asyncio.run(server.serve(args.address))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if feed is not None:
+            feed.stop()
+            feed.join()
+        myDB.close_conn()
+
+
+if __name__ == "__main__":
+    main()
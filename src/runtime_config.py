@@ -0,0 +1,174 @@
+# which model file (fp32 or int8) and which OpenCV DNN backend/target YuNet and SFace run with
+#
+# read from the environment (.env), one value per model:
+#   DETECTOR_MODEL, RECOGNIZER_MODEL       fp32 | int8 | auto
+#   DETECTOR_BACKEND, RECOGNIZER_BACKEND   a key of BACKENDS | auto
+# "auto" (the default) times every combination that loads on this host at startup and keeps the fastest
+
+import os
+import time
+
+import cv2 as cv
+import numpy as np
+
+from yunet import YuNet
+from sface import SFace
+
+
+DETECTOR_MODELS = {
+    "fp32": "model/face_detection_yunet_2023mar.onnx",
+    "int8": "model/face_detection_yunet_2023mar_int8.onnx",
+}
+RECOGNIZER_MODELS = {
+    "fp32": "model/face_recognition_sface_2021dec.onnx",
+    "int8": "model/face_recognition_sface_2021dec_int8.onnx",
+}
+
+BACKENDS = {
+    "opencv-cpu": (cv.dnn.DNN_BACKEND_OPENCV, cv.dnn.DNN_TARGET_CPU),
+    "openvino-cpu": (cv.dnn.DNN_BACKEND_INFERENCE_ENGINE, cv.dnn.DNN_TARGET_CPU),
+    "cuda": (cv.dnn.DNN_BACKEND_CUDA, cv.dnn.DNN_TARGET_CUDA),
+    "cuda-fp16": (cv.dnn.DNN_BACKEND_CUDA, cv.dnn.DNN_TARGET_CUDA_FP16),
+}
+DEFAULT_BACKEND = "opencv-cpu"
+
+# input the detector is timed on; about what Camera feeds it with detect_scale=0.5
+BENCH_INPUT_SIZE = (640, 360)
+BENCH_FACES = 8
+
+
+class RuntimeConfig:
+    def __init__(self, fd_model="fp32", fd_backend=DEFAULT_BACKEND, fr_model="fp32", fr_backend=DEFAULT_BACKEND) -> None:
+        self.fd_model = fd_model
+        self.fd_backend = fd_backend
+        self.fr_model = fr_model
+        self.fr_backend = fr_backend
+
+    @property
+    def fd_model_path(self) -> str:
+        return DETECTOR_MODELS[self.fd_model]
+
+    @property
+    def fr_model_path(self) -> str:
+        return RECOGNIZER_MODELS[self.fr_model]
+
+    # (backendId, targetId) pairs, as taken by YuNet/SFace and Camera/AdminWindow/Supervisor
+    @property
+    def fd_target(self) -> tuple:
+        return BACKENDS[self.fd_backend]
+
+    @property
+    def fr_target(self) -> tuple:
+        return BACKENDS[self.fr_backend]
+
+    def __str__(self) -> str:
+        return "detector {} on {}, recognizer {} on {}".format(self.fd_model, self.fd_backend, self.fr_model, self.fr_backend)
+
+
+# backends this OpenCV build can run
+def available_backends() -> list:
+    return [
+        name for name, (backend, target) in BACKENDS.items()
+        if target in cv.dnn.getAvailableTargets(backend)
+    ]
+
+
+# the one option value names, or all of them for "auto"
+def candidates(value: str, options) -> list:
+    if value != "auto":
+        if value not in options:
+            raise ValueError("unknown setting {!r}; expected auto or one of {}".format(value, ", ".join(options)))
+        return [value]
+
+    return list(options)
+
+
+# mean seconds per call of fn after a warm-up call; None if the model doesn't run on that backend
+def time_call(fn, repeats=5):
+    try:
+        fn()
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+
+        return (time.perf_counter() - start) / repeats
+
+    except cv.error:
+        return None
+
+
+def time_detector(model_path: str, target: tuple):
+    frame = np.random.default_rng(0).integers(0, 256, BENCH_INPUT_SIZE[::-1] + (3,), dtype=np.uint8)
+
+    try:
+        model = YuNet(modelPath=model_path, inputSize=list(BENCH_INPUT_SIZE), backendId=target[0], targetId=target[1])
+    except cv.error:
+        return None
+
+    return time_call(lambda: model.infer(frame))
+
+
+def time_recognizer(model_path: str, target: tuple):
+    rng = np.random.default_rng(0)
+    crops = [(rng.integers(0, 256, (112, 112, 3), dtype=np.uint8), None) for _ in range(BENCH_FACES)]
+
+    try:
+        model = SFace(modelPath=model_path, backendId=target[0], targetId=target[1])
+    except cv.error:
+        return None
+
+    return time_call(lambda: model.infer_batch(crops))
+
+
+# fastest (model, backend) of the candidates; falls back to the first candidate when none could be timed
+def fastest(models: list, backends: list, paths: dict, timer) -> tuple:
+    timings = {}
+
+    for model in models:
+        if not os.path.exists(paths[model]):
+            continue
+
+        for backend in backends:
+            seconds = timer(paths[model], BACKENDS[backend])
+            if seconds is not None:
+                timings[(model, backend)] = seconds
+                print("  {} on {}: {:.2f} ms".format(paths[model], backend, seconds * 1e3))
+
+    if not timings:
+        return models[0], backends[0]
+
+    return min(timings, key=timings.get)
+
+
+# builds the configuration from the environment, benchmarking wherever it says "auto"
+def select() -> RuntimeConfig:
+    backends = available_backends() or [DEFAULT_BACKEND]
+
+    fd_models = candidates(os.getenv("DETECTOR_MODEL", "auto"), DETECTOR_MODELS)
+    fd_backends = candidates(os.getenv("DETECTOR_BACKEND", "auto"), BACKENDS)
+    fr_models = candidates(os.getenv("RECOGNIZER_MODEL", "auto"), RECOGNIZER_MODELS)
+    fr_backends = candidates(os.getenv("RECOGNIZER_BACKEND", "auto"), BACKENDS)
+
+    # only "auto" is narrowed to what this build supports; an explicit backend is taken at its word
+    if len(fd_backends) > 1:
+        fd_backends = backends
+    if len(fr_backends) > 1:
+        fr_backends = backends
+
+    if len(fd_models) * len(fd_backends) > 1 or len(fr_models) * len(fr_backends) > 1:
+        print("Benchmarking models on this host...")
+
+    fd_model, fd_backend = (
+        fastest(fd_models, fd_backends, DETECTOR_MODELS, time_detector)
+        if len(fd_models) * len(fd_backends) > 1 else (fd_models[0], fd_backends[0])
+    )
+    fr_model, fr_backend = (
+        fastest(fr_models, fr_backends, RECOGNIZER_MODELS, time_recognizer)
+        if len(fr_models) * len(fr_backends) > 1 else (fr_models[0], fr_backends[0])
+    )
+
+    config = RuntimeConfig(fd_model, fd_backend, fr_model, fr_backend)
+    print("Runtime config: {}".format(config))
+
+    return config
@@ -7,6 +7,16 @@
 import numpy as np
 import cv2 as cv
 
+
+def aligned_blob(crops, out=None):
+    # crops: (N, 112, 112, 3) BGR uint8 -> (N, 3, 112, 112) RGB float32, the blob blobFromImages(swapRB=True)
+    # would build (without its per-image conversions), written into out when given
+    if out is None:
+        out = np.empty((len(crops), 3, 112, 112), dtype=np.float32)
+
+    np.copyto(out, crops[..., ::-1].transpose(0, 3, 1, 2))
+    return out
+
 class SFace:
     def __init__(self, modelPath, disType=0, backendId=0, targetId=0):
         self._modelPath = modelPath
@@ -17,6 +27,8 @@ class SFace:
             config="",
             backend_id=self._backendId,
             target_id=self._targetId)
+        self._net = None  # raw dnn net for batched forward passes, loaded on first infer_batch
+        self._blob = None  # input buffer of infer_aligned, reused between calls
 
         self._disType = disType # 0: cosine similarity, 1: Norm-L2 distance
         assert self._disType in [0, 1], "0: Cosine similarity, 1: norm-L2 distance, others: invalid"
@@ -36,6 +48,7 @@ class SFace:
             config="",
             backend_id=self._backendId,
             target_id=self._targetId)
+        self._net = None
 
     def _preprocess(self, image, bbox):
         if bbox is None:
@@ -51,6 +64,56 @@ class SFace:
         features = self._model.feature(inputBlob)
         return features
 
+    def _load_net(self):
+        self._net = cv.dnn.readNet(self._modelPath)
+        self._net.setPreferableBackend(self._backendId)
+        self._net.setPreferableTarget(self._targetId)
+        self._batchable = True
+
+    def infer_batch(self, faces):
+        # faces: list of (image, bbox) pairs; bbox=None means image is already a face crop
+        # returns (len(faces), 128) features from a single forward pass
+        if len(faces) == 0:
+            return np.empty((0, 128), dtype=np.float32)
+
+        if self._net is None:
+            self._load_net()
+
+        crops = [self._preprocess(image, bbox) for image, bbox in faces]
+
+        # same preprocessing as FaceRecognizerSF::feature: 112x112, RGB, no scaling or mean
+        return self._forward(cv.dnn.blobFromImages(crops, 1.0, (112, 112), (0, 0, 0), swapRB=True, crop=False))
+
+    def infer_aligned(self, crops):
+        # crops: (N, 112, 112, 3) BGR faces already aligned to the SFace template (alignment.FaceAligner)
+        # returns (N, 128) features from a single forward pass
+        if len(crops) == 0:
+            return np.empty((0, 128), dtype=np.float32)
+
+        if self._net is None:
+            self._load_net()
+
+        if self._blob is None or len(self._blob) < len(crops):
+            self._blob = np.empty((max(len(crops), 16), 3, 112, 112), dtype=np.float32)
+
+        return self._forward(aligned_blob(crops, self._blob[:len(crops)]))
+
+    def _forward(self, blob):
+        if self._batchable:
+            try:
+                self._net.setInput(blob)
+                return self._net.forward().reshape(len(blob), -1)
+            except cv.error:
+                # model graph pinned to batch size 1 on this OpenCV build
+                self._batchable = False
+
+        features = []
+        for i in range(len(blob)):
+            self._net.setInput(blob[i:i + 1])
+            features.append(self._net.forward().reshape(1, -1))
+
+        return np.vstack(features)
+
     def match(self, image1, face1, image2, face2):
         feature1 = self.infer(image1, face1)
         feature2 = self.infer(image2, face2)
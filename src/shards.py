@@ -0,0 +1,471 @@
+# sharded gallery service: the gallery split across shard processes, searched scatter-gather
+#
+# every shard is a process holding one part of the gallery behind a multiprocessing.connection
+# Listener ("host:port", or a path for a Unix socket), so shards can run on this host or on others.
+# connections are authenticated with GALLERY_AUTHKEY (nothing starts without it) and messages are
+# wire.py's JSON + raw bytes, sent with send_bytes/recv_bytes: nothing a client sends is unpickled.
+# identities are placed by rendezvous hashing of (shard address, face ID): placement needs no shared
+# state, spreads identities evenly, and adding a shard only moves the ~1/n of them that now hash to it.
+#
+# the service process (`python src/shards.py --count 4`) starts local shards, loads them from the
+# snapshot or the database and keeps them current with a GalleryFeed, so enrolments made anywhere
+# through Database.add_faces reach the owning shard. cameras use Camera(index="sharded"), which
+# connects to GALLERY_SHARDS (from .env) and only searches: every probe batch goes to all shards at
+# once and the per-shard top-k are merged
+
+import argparse
+import hashlib
+import multiprocessing as mp
+import os
+import signal
+import threading
+import time
+
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+import snapshot
+import wire
+from change_feed import GalleryFeed
+from database import Database
+from gallery import Gallery, Matcher, NORM_L2, locked, normalize, to_distance, top_k
+from quantized import PRECISIONS, QuantizedGallery
+
+from dotenv import load_dotenv
+
+
+LOAD_CHUNK = 50000  # rows per message while loading a shard
+
+
+parse_address = wire.parse_address
+
+
+class ShardError(Exception):
+    pass
+
+
+# there is no default key: anyone who can reach a shard and knows the key can change its gallery
+def authkey_from_env() -> bytes:
+    authkey = os.getenv("GALLERY_AUTHKEY")
+    if not authkey:
+        raise ShardError("GALLERY_AUTHKEY is not set; shards only accept authenticated connections")
+
+    return authkey.encode()
+
+
+# messages both ways are lists: [command, *args] requests, ["ok", value] or ["error", text] replies
+def send_message(conn, message) -> None:
+    header, payload = wire.pack(message)
+    conn.send_bytes(wire.encode_message({"message": header}, payload))
+
+
+def recv_message(conn):
+    header, payload = wire.decode_message(conn.recv_bytes())
+
+    return wire.unpack(header["message"], payload)
+
+
+def _weight(address: str, faceID) -> int:
+    digest = hashlib.blake2b("{}/{}".format(address, faceID).encode(), digest_size=8).digest()
+
+    return int.from_bytes(digest, "big")
+
+
+# index of the shard owning faceID among addresses (rendezvous / highest-random-weight hashing)
+def shard_of(faceID, addresses: list) -> int:
+    return max(range(len(addresses)), key=lambda i: _weight(addresses[i], faceID))
+
+
+class Shard:
+    def __init__(self, address: str, index="exact", disType=NORM_L2) -> None:
+        self.address = address
+        self.gallery = Gallery(disType) if index == "exact" else QuantizedGallery(disType, precision=index)
+
+        self.topology = []  # every shard's address, set by the service
+        self.epoch = 0  # bumped by the service whenever the topology changes
+
+        self._loading = []
+
+    def _owned(self, ids, addresses: list) -> np.ndarray:
+        return np.array([addresses[shard_of(faceID, addresses)] == self.address for faceID in ids], dtype=bool)
+
+    # one request -> one reply; requests are [command, *args] lists
+    def handle(self, request: tuple):
+        command, args = request[0], request[1:]
+
+        if command == "search":
+            probes, k = args
+            ids, scores = self.gallery.search_scores(probes, k)
+            return self.epoch, ids, scores
+
+        if command == "upsert":
+            ids, embs = args
+            with self.gallery.lock:
+                for faceID, emb in zip(ids, embs):
+                    self.gallery.upsert(faceID, emb)
+            return len(self.gallery)
+
+        if command == "remove":
+            (ids,) = args
+            with self.gallery.lock:
+                return sum(self.gallery.remove(faceID) for faceID in ids)
+
+        if command == "load_chunk":
+            self._loading.append(args)
+            return None
+
+        if command == "load_end":
+            ids = [faceID for chunk_ids, _ in self._loading for faceID in chunk_ids]
+            embs = np.vstack([embs for _, embs in self._loading]) if self._loading else np.empty((0, self.gallery.dim), np.float32)
+            self._loading = []
+            self.gallery.load_matrix(ids, embs)
+            return len(self.gallery)
+
+        # copies of the identities that belong to another shard under the given topology (kept here)
+        if command == "moving":
+            (addresses,) = args
+            with self.gallery.lock:
+                ids = self.gallery.ids
+                keep = self._owned(ids, addresses)
+                return [faceID for faceID, kept in zip(ids, keep) if not kept], self.gallery.embs[~keep]
+
+        # drops the identities that belong to another shard under the given topology
+        if command == "drop":
+            (addresses,) = args
+            with self.gallery.lock:
+                ids = self.gallery.ids
+                keep = self._owned(ids, addresses)
+                return sum(self.gallery.remove(faceID) for faceID, kept in zip(ids, keep) if not kept)
+
+        if command == "topology":
+            self.topology, self.epoch = args
+            return None
+
+        if command == "info":
+            return {"address": self.address, "size": len(self.gallery), "topology": self.topology, "epoch": self.epoch}
+
+        raise ValueError("unknown shard command: {}".format(command))
+
+    def serve_connection(self, conn) -> None:
+        try:
+            while True:
+                try:
+                    reply = ["ok", self.handle(recv_message(conn))]
+                except (EOFError, OSError):
+                    raise
+                except Exception as e:
+                    reply = ["error", repr(e)]
+                send_message(conn, reply)
+        except (EOFError, OSError):
+            pass  # client went away
+        finally:
+            conn.close()
+
+
+# entry point of a shard process; serves every client on its own thread until killed
+def run_shard(address: str, index="exact", authkey=None, disType=NORM_L2) -> None:
+    if not authkey:
+        raise ShardError("a shard needs an authkey")
+
+    shard = Shard(address, index, disType)
+    listener = Listener(parse_address(address), authkey=authkey)
+
+    print("Shard listening on {}".format(address))
+
+    while True:
+        try:
+            conn = listener.accept()
+        except (OSError, EOFError, mp.AuthenticationError):
+            continue  # failed handshake, e.g. a wrong authkey
+
+        threading.Thread(target=shard.serve_connection, args=(conn,), name="shard-client", daemon=True).start()
+
+
+def start_local_shards(addresses: list, index="exact", authkey=None) -> list:
+    context = mp.get_context("spawn")
+    processes = [
+        context.Process(target=run_shard, args=(address, index, authkey), name="shard-{}".format(address), daemon=True)
+        for address in addresses
+    ]
+    for process in processes:
+        process.start()
+
+    return processes
+
+
+class ShardedGallery(Matcher):
+    # owner=True is the service, which loads and updates the shards and decides the topology; every
+    # other client only searches, and ignores loads and upserts (the service's feed applies them)
+    def __init__(self, addresses=None, disType=NORM_L2, threshold=None, authkey=None, owner=False,
+                 connect_timeout=10.0) -> None:
+        self._exact = Gallery(disType, threshold)  # only for the thresholds
+
+        self.disType = self._exact.disType
+        self.threshold = self._exact.threshold
+        self.owner = owner
+        self.lock = threading.RLock()
+
+        if addresses is None:
+            addresses = [a for a in os.getenv("GALLERY_SHARDS", "").split(",") if a]
+        assert addresses, "no shard addresses (set GALLERY_SHARDS)"
+
+        self.authkey = authkey if authkey is not None else authkey_from_env()
+        self.connect_timeout = connect_timeout
+
+        self.addresses = []
+        self.epoch = 0
+        self._conns = []
+
+        if owner:
+            self._connect_all(list(addresses))
+            self._set_topology(self.epoch + 1)
+        else:
+            self._join(list(addresses))
+
+    # a searching client holds no rows, so loading it or following the database would be wasted work
+    @property
+    def is_remote(self) -> bool:
+        return not self.owner
+
+    def _connect(self, address: str):
+        deadline = time.monotonic() + self.connect_timeout
+
+        while True:
+            try:
+                return Client(parse_address(address), authkey=self.authkey)
+            except (ConnectionRefusedError, FileNotFoundError):
+                if time.monotonic() > deadline:
+                    raise ShardError("shard {} not reachable".format(address))
+                time.sleep(0.1)
+
+    def _connect_all(self, addresses: list) -> None:
+        for conn in self._conns:
+            conn.close()
+
+        self._conns = [self._connect(address) for address in addresses]
+        self.addresses = addresses
+
+    # a searching client takes the topology from the shards themselves, so it follows shards the service adds
+    def _join(self, seeds: list) -> None:
+        conn = self._connect(seeds[0])
+        send_message(conn, ("info",))
+        info = self._reply(conn)
+        conn.close()
+
+        self._connect_all(info["topology"] or seeds)
+        self.epoch = info["epoch"]
+
+    def _reply(self, conn):
+        status, value = recv_message(conn)
+        if status != "ok":
+            raise ShardError(value)
+
+        return value
+
+    # sends one request per shard before reading any reply, so the shards work in parallel
+    def _scatter(self, requests: list) -> list:
+        for conn, request in zip(self._conns, requests):
+            send_message(conn, request)
+
+        return [self._reply(conn) for conn in self._conns]
+
+    def _broadcast(self, request: tuple) -> list:
+        return self._scatter([request] * len(self._conns))
+
+    def _set_topology(self, epoch: int) -> None:
+        self._broadcast(("topology", self.addresses, epoch))
+        self.epoch = epoch
+
+    @locked
+    def sizes(self) -> list:
+        return [info["size"] for info in self._broadcast(("info",))]
+
+    def __len__(self) -> int:
+        return sum(self.sizes())
+
+    # groups ids (and rows of embs) by owning shard
+    def _partition(self, ids: list, embs=None) -> list:
+        owners = np.fromiter((shard_of(faceID, self.addresses) for faceID in ids), dtype=np.int64, count=len(ids))
+
+        parts = []
+        for shard in range(len(self.addresses)):
+            rows = np.flatnonzero(owners == shard)
+            parts.append(([ids[r] for r in rows], None if embs is None else embs[rows]))
+
+        return parts
+
+    def load(self, encodings: dict) -> "ShardedGallery":
+        ids = list(encodings.keys()) if encodings else []
+        embs = np.vstack([np.ravel(encodings[i]) for i in ids]) if ids else np.empty((0, 128), np.float32)
+
+        return self.load_matrix(ids, embs)
+
+    @locked
+    def load_matrix(self, ids: list, embs: np.ndarray) -> "ShardedGallery":
+        if not self.owner:
+            return self
+
+        ids = list(ids)
+        for start in range(0, len(ids), LOAD_CHUNK):
+            chunk = normalize(embs[start:start + LOAD_CHUNK])
+            self._scatter([("load_chunk", part_ids, part_embs) for part_ids, part_embs in
+                           self._partition(ids[start:start + LOAD_CHUNK], chunk)])
+
+        self._broadcast(("load_end",))
+
+        return self
+
+    # snapshot rows are partitioned and sent chunk by chunk, so the full matrix is never copied at once
+    def load_base(self, ids: list, embs: np.ndarray) -> "ShardedGallery":
+        return self.load_matrix(ids, embs)
+
+    @locked
+    def upsert(self, faceID, encoding: np.ndarray) -> None:
+        if not self.owner:
+            return
+
+        conn = self._conns[shard_of(faceID, self.addresses)]
+        send_message(conn, ("upsert", [faceID], normalize(encoding)))
+        self._reply(conn)
+
+    @locked
+    def remove(self, faceID) -> bool:
+        if not self.owner:
+            return False
+
+        conn = self._conns[shard_of(faceID, self.addresses)]
+        send_message(conn, ("remove", [faceID]))
+
+        return self._reply(conn) > 0
+
+    # rebalancing: connects a new shard and moves to it the identities that now hash to it. other
+    # processes search with the old topology until they see the new epoch, so the old shards keep every
+    # identity until then: the moving ones are copied to the new shard, the topology is published, and
+    # only then are they dropped from the old shards (until then a search may briefly see them twice)
+    @locked
+    def add_shard(self, address: str) -> int:
+        assert self.owner, "only the service changes the topology"
+
+        new_conn = self._connect(address)
+        send_message(new_conn, ("load_end",))  # starts the new shard empty
+        self._reply(new_conn)
+
+        addresses = self.addresses + [address]
+
+        moved = 0
+        for ids, embs in self._broadcast(("moving", addresses)):
+            if ids:
+                send_message(new_conn, ("upsert", ids, embs))
+                self._reply(new_conn)
+                moved += len(ids)
+
+        self._conns.append(new_conn)
+        self.addresses = addresses
+        self._set_topology(self.epoch + 1)
+
+        self._broadcast(("drop", addresses))
+
+        print("Shard {} added, {} identities moved to it".format(address, moved))
+
+        return moved
+
+    def search(self, probes: np.ndarray, k=1) -> tuple:
+        ids, scores = self.search_scores(normalize(probes), k)
+
+        return ids, to_distance(scores, self.disType)
+
+    @locked
+    def search_scores(self, probes: np.ndarray, k=1) -> tuple:
+        replies = self._broadcast(("search", probes, k))
+
+        # the service changed the topology since we joined: reconnect and ask again
+        if not self.owner and any(epoch != self.epoch for epoch, _, _ in replies):
+            self._join(self.addresses)
+            replies = self._broadcast(("search", probes, k))
+
+        ids = np.hstack([shard_ids for _, shard_ids, _ in replies])
+        scores = np.hstack([shard_scores for _, _, shard_scores in replies])
+
+        if scores.shape[1] == 0:
+            return ids, scores
+
+        best = top_k(scores, min(k, scores.shape[1]))
+
+        return np.take_along_axis(ids, best, axis=1), np.take_along_axis(scores, best, axis=1)
+
+    @locked
+    def close(self) -> None:
+        for conn in self._conns:
+            conn.close()
+        self._conns = []
+
+
+def serve(count: int, host="127.0.0.1", port=7100, index="exact", snapshot_path=snapshot.SNAPSHOT_PATH) -> None:
+    addresses = ["{}:{}".format(host, port + i) for i in range(count)]
+    authkey = authkey_from_env()
+
+    processes = start_local_shards(addresses, index, authkey)
+
+    myDB = Database(
+        os.getenv("USER_NAME"), os.getenv("PASSWORD"),
+        os.getenv("DATABASE_NAME"), os.getenv("PORT_NUMBER")
+    )
+
+    gallery = ShardedGallery(addresses, disType=1, authkey=authkey, owner=True)
+
+    start = time.perf_counter()
+    watermark = snapshot.load_gallery(gallery, myDB, snapshot_path)
+    print("{} face(s) loaded into {} shard(s) in {:.1f}s: {}".format(
+        len(gallery), count, time.perf_counter() - start, gallery.sizes()))
+
+    feed = GalleryFeed(gallery, myDB, watermark)
+    feed.start()
+
+    print("GALLERY_SHARDS={}".format(",".join(addresses)))
+
+    # `kill -USR1 <pid>` scales out: one more local shard on the next port, rebalanced while serving
+    grow = threading.Event()
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: grow.set())
+        print("Send SIGUSR1 to process {} to add a shard".format(os.getpid()))
+
+    try:
+        while all(process.is_alive() for process in processes):
+            if grow.wait(1.0):
+                grow.clear()
+
+                address = "{}:{}".format(host, port + len(processes))
+                processes += start_local_shards([address], index, authkey)
+                gallery.add_shard(address)
+
+                print("{} shard(s): {}".format(len(processes), gallery.sizes()))
+        print("a shard process died; stopping")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        feed.stop()
+        feed.join()
+        gallery.close()
+        myDB.close_conn()
+        for process in processes:
+            process.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded gallery service")
+    parser.add_argument("--count", type=int, default=os.cpu_count() or 1, help="shard processes to start")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7100, help="first shard's port; the others follow")
+    parser.add_argument("--index", choices=("exact",) + PRECISIONS, default="exact", help="gallery kind of every shard")
+    args = parser.parse_args()
+
+    load_dotenv()
+    if not os.getenv("GALLERY_AUTHKEY"):
+        parser.error("set GALLERY_AUTHKEY (in .env or the environment) to a secret shared with the cameras")
+
+    serve(args.count, args.host, args.port, args.index)
+
+
+if __name__ == "__main__":
+    main()
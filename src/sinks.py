@@ -0,0 +1,158 @@
+# outputs for headless mode (Camera.headless_loop)
+#
+# record sinks take one dict per inferred frame and write it as a JSON line, to stdout or to every
+# client of a Unix socket. frame sinks take annotated frames; `active` tells the camera whether
+# anyone consumes them, so frames are only drawn on (and encoded) while it is True
+
+import json
+import os
+import socket
+import sys
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+
+
+class JsonLinesSink:
+    def __init__(self, stream=sys.stdout) -> None:
+        self.stream = stream
+
+    def emit(self, record: dict) -> None:
+        self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+
+    def close(self) -> None:
+        pass
+
+
+# JSON lines to every client connected to a Unix socket; a client that can't keep up is disconnected
+class UnixSocketSink:
+    def __init__(self, path: str, send_timeout=0.05) -> None:
+        self.path = path
+        self.send_timeout = send_timeout
+
+        if os.path.exists(path):
+            os.remove(path)
+
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen()
+
+        self._clients = []
+        self._lock = threading.Lock()
+
+        threading.Thread(target=self._accept, name="socket-sink", daemon=True).start()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                client, _ = self._server.accept()
+            except OSError:
+                return  # closed
+
+            client.settimeout(self.send_timeout)
+            with self._lock:
+                self._clients.append(client)
+
+    def emit(self, record: dict) -> None:
+        line = (json.dumps(record) + "\n").encode()
+
+        with self._lock:
+            for client in list(self._clients):
+                try:
+                    client.sendall(line)
+                except OSError:
+                    client.close()
+                    self._clients.remove(client)
+
+    def close(self) -> None:
+        self._server.close()
+
+        with self._lock:
+            for client in self._clients:
+                client.close()
+            self._clients.clear()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class VideoFileSink:
+    def __init__(self, path: str, fps: float, size: tuple, fourcc="mp4v") -> None:
+        self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, size)
+
+    @property
+    def active(self) -> bool:
+        return True
+
+    def write(self, frame) -> None:
+        self.writer.write(frame)
+
+    def close(self) -> None:
+        self.writer.release()
+
+
+# multipart JPEG stream at http://host:port/ for browsers and VLC; idle (no drawing, no encoding) without viewers
+class MJPEGSink:
+    def __init__(self, port=8080, host="0.0.0.0", quality=80) -> None:
+        self.quality = quality
+        self.viewers = 0
+
+        self._jpeg = None
+        self._seq = 0  # bumped for every new frame
+        self._cond = threading.Condition()
+
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+                self.end_headers()
+
+                with sink._cond:
+                    sink.viewers += 1
+
+                seq = sink._seq
+
+                try:
+                    while True:
+                        with sink._cond:
+                            if not sink._cond.wait_for(lambda: sink._seq != seq, timeout=1.0):
+                                continue
+                            seq, jpeg = sink._seq, sink._jpeg
+
+                        self.wfile.write(b"--frame\r\nContent-Type: image/jpeg\r\n\r\n" + jpeg + b"\r\n")
+                except OSError:
+                    pass  # viewer went away
+                finally:
+                    with sink._cond:
+                        sink.viewers -= 1
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+
+        threading.Thread(target=self._server.serve_forever, name="mjpeg-sink", daemon=True).start()
+
+    @property
+    def active(self) -> bool:
+        return self.viewers > 0
+
+    def write(self, frame) -> None:
+        ok, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ok:
+            return
+
+        with self._cond:
+            self._jpeg = jpeg.tobytes()
+            self._seq += 1
+            self._cond.notify_all()
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
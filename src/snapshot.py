@@ -0,0 +1,138 @@
+# on-disk gallery snapshot that camera processes memory-map instead of pulling every encoding from PostgreSQL
+#
+#   <path>/meta.json              format version, watermark (a transaction ID, see Database.fetch_encodings_since),
+#                                 row count and the two file names below
+#   <path>/embeddings-<tag>.npy   (N, 128) unit-length float32 matrix
+#   <path>/ids-<tag>.npy          (N,) face IDs
+#
+# every export writes new data files and then atomically replaces meta.json, so a reader never sees
+# a half-written snapshot; processes opening it with mmap share the same page-cache pages
+
+import json
+import os
+
+from datetime import datetime
+
+import numpy as np
+
+from gallery import normalize
+
+
+SNAPSHOT_PATH = "snapshot"
+VERSION = 2
+
+
+# writes the whole Encoding table to path; returns the new meta data
+def export_snapshot(myDB, path=SNAPSHOT_PATH) -> dict:
+    ids, encodings, watermark = myDB.fetch_encodings_since(None)
+
+    os.makedirs(path, exist_ok=True)
+
+    tag = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    emb_file = "embeddings-{}.npy".format(tag)
+    ids_file = "ids-{}.npy".format(tag)
+
+    np.save(os.path.join(path, emb_file), normalize(encodings))
+    np.save(os.path.join(path, ids_file), np.asarray(ids, dtype=str))
+
+    meta = {
+        "version": VERSION,
+        "watermark": watermark,
+        "count": len(ids),
+        "dim": int(encodings.shape[1]),
+        "embeddings": emb_file,
+        "ids": ids_file,
+    }
+
+    tmp = os.path.join(path, "meta.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(path, "meta.json"))
+
+    # old data files can go; processes that still map them keep their pages until they close
+    for name in os.listdir(path):
+        if name.endswith(".npy") and name not in (emb_file, ids_file):
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+
+    print("Exported {} encoding(s) to {}".format(len(ids), path))
+
+    return meta
+
+
+# returns (ids, embeddings, watermark) with embeddings memory-mapped read-only, or None if there is no usable snapshot
+def open_snapshot(path=SNAPSHOT_PATH):
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if meta.get("version") != VERSION:
+        return None
+
+    embs = np.load(os.path.join(path, meta["embeddings"]), mmap_mode="r")
+    ids = np.load(os.path.join(path, meta["ids"])).tolist()
+
+    if len(ids) != meta["count"] or embs.shape[0] != meta["count"]:
+        return None
+
+    return ids, embs, meta["watermark"]
+
+
+# for process pools: the parent fetches what workers need on top of the snapshot with worker_rows and
+# each worker builds its gallery with load_worker_gallery, so the rows themselves are mapped, not pickled.
+# returns (snapshot path or None when there is no snapshot, ids, encodings, watermark for a GalleryFeed)
+def worker_rows(myDB, path=SNAPSHOT_PATH) -> tuple:
+    snap = open_snapshot(path)
+
+    if snap is None:
+        ids, encodings, watermark = myDB.fetch_encodings_since(None)
+        print("{} face(s) loaded...".format(len(ids)))
+        return None, ids, encodings, watermark
+
+    ids, encodings, watermark = myDB.fetch_encodings_since(snap[2])
+    print("{} face(s) from snapshot, {} changed since".format(len(snap[0]), len(ids)))
+
+    return path, ids, encodings, watermark
+
+
+def load_worker_gallery(gallery, path, ids: list, encodings):
+    snap = open_snapshot(path) if path else None
+
+    if snap is None:
+        gallery.load_matrix(ids, encodings)
+    else:
+        gallery.load_base(snap[0], snap[1])
+        for faceID, encoding in zip(ids, encodings):
+            gallery.upsert(faceID, encoding)
+
+    return gallery
+
+
+# fills gallery from the snapshot plus the rows changed since its watermark, or from the database
+# alone when there is no snapshot; returns the watermark to use for later incremental fetches.
+# a remote gallery (a searching ShardedGallery) loads nothing and gets the database's current watermark
+def load_gallery(gallery, myDB, path=SNAPSHOT_PATH):
+    if gallery.is_remote:
+        return myDB.fetch_watermark()
+
+    snap = open_snapshot(path)
+
+    if snap is None:
+        ids, encodings, watermark = myDB.fetch_encodings_since(None)
+        gallery.load_matrix(ids, encodings)
+        return watermark
+
+    ids, embs, watermark = snap
+    gallery.load_base(ids, embs)
+
+    changed_ids, changed, watermark = myDB.fetch_encodings_since(watermark)
+    for faceID, encoding in zip(changed_ids, changed):
+        gallery.upsert(faceID, encoding)
+
+    print("{} face(s) from snapshot, {} changed since".format(len(ids), len(changed_ids)))
+
+    return watermark
@@ -0,0 +1,316 @@
+# serves many camera streams from one process pool
+#
+# the supervisor owns capture (one thread per stream), the database connection and the display;
+# detection and recognition run in a fixed pool of worker processes, each holding one copy of the
+# models and the gallery, so the host is sized by cores rather than by number of cameras.
+# enrolments made while it runs reach the workers through a GalleryFeed in the supervisor, which
+# appends every changed row to a DeltaLog; a worker applies the rows it has not seen before its next frame
+
+import multiprocessing as mp
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from alignment import FaceAligner
+from camera import crop_face_box, draw_faces
+from change_feed import GalleryFeed
+from database import Database
+from gallery import Gallery
+from identity_cache import IdentityCache
+import metrics
+from yunet import YuNet
+from detection import AdaptiveDetector
+from sface import SFace
+import snapshot
+
+from dotenv import load_dotenv
+
+
+# per-process state of a pool worker, set by _init_worker
+_worker = {}
+
+
+# gallery changes for the pool: an append-only list in a manager process plus a shared version
+# counter, so a worker checking for changes reads one integer. fed by a GalleryFeed (which needs
+# only lock and upsert); kept whole, so a worker the pool respawns replays it from the start
+class DeltaLog:
+    def __init__(self, manager, context) -> None:
+        self.lock = threading.RLock()
+        self.entries = manager.list()
+        self.version = context.Value("q", 0, lock=False)
+
+    def upsert(self, faceID, encoding) -> None:
+        self.entries.append((faceID, np.ravel(encoding).astype(np.float32)))
+        self.version.value += 1  # after the append, so a worker never reads past the list
+
+
+# brings the worker's gallery up to the supervisor's DeltaLog
+def _apply_deltas() -> None:
+    version = _worker["delta_version"].value
+    if version == _worker["applied"]:
+        return
+
+    with _worker["gallery"].lock:
+        for faceID, encoding in _worker["deltas"][_worker["applied"]:version]:
+            _worker["gallery"].upsert(faceID, encoding)
+
+    _worker["applied"] = version
+
+
+# with a snapshot_path, ids/encodings are only the rows changed since the snapshot; every worker maps
+# the same snapshot file, so the bulk of the gallery is held in memory once per host
+def _init_worker(fd_model_path: str, fr_model_path: str, snapshot_path, ids: list, encodings, detect_scale=0.5,
+                 fd_target=(0, 0), fr_target=(0, 0), deltas=None, delta_version=None) -> None:
+    # a worker sees frames of every stream out of order, so it only shrinks frames (full_frame_every=1)
+    # and never follows faces between them
+    _worker["detector"] = AdaptiveDetector(
+        YuNet(modelPath=fd_model_path, confThreshold=0.8, backendId=fd_target[0], targetId=fd_target[1]),
+        scale=detect_scale, full_frame_every=1,
+    )
+    _worker["frecogi_model"] = SFace(modelPath=fr_model_path, disType=1, backendId=fr_target[0], targetId=fr_target[1])
+    _worker["aligner"] = FaceAligner()
+
+    _worker["gallery"] = snapshot.load_worker_gallery(Gallery(disType=1), snapshot_path, ids, encodings)
+
+    _worker["deltas"] = deltas
+    _worker["delta_version"] = delta_version
+    _worker["applied"] = 0
+
+
+# detects and identifies the faces of one frame; returns (stream_id, frame_no, [(bbox, faceID, dist, is_recognised)],
+# {stage: seconds}). workers keep no metrics of their own: the stage times go back with the result and the
+# supervisor records them, so they end up in the one endpoint/dump the supervisor serves
+def _process_frame(stream_id: int, frame_no: int, frame) -> tuple:
+    _apply_deltas()
+
+    start = time.perf_counter()
+    results = _worker["detector"].detect(frame)
+    timings = {"detect": time.perf_counter() - start}
+
+    if len(results) == 0:
+        return stream_id, frame_no, [], timings
+
+    boxes = [crop_face_box(det) for det in results]
+
+    start = time.perf_counter()
+    embs = _worker["frecogi_model"].infer_aligned(_worker["aligner"].align(frame, results))
+    timings["embed"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matches = _worker["gallery"].match(embs)
+    timings["match"] = time.perf_counter() - start
+
+    faces = [
+        (box, faceID, dist, is_recognised)
+        for box, (faceID, dist, is_recognised) in zip(boxes, matches)
+    ]
+
+    return stream_id, frame_no, faces, timings
+
+
+# one camera index or video file; counts what was captured, processed and dropped
+class Stream:
+    def __init__(self, stream_id: int, source) -> None:
+        self.stream_id = stream_id
+        self.source = source
+        self.vid_stream = cv2.VideoCapture(source)
+
+        self.inflight = 0
+        self.captured = 0
+        self.processed = 0
+        self.dropped = 0
+        self.finished = False
+
+        self.frame = None  # last frame that has results
+        self.faces = []
+        self.pending = {}  # frame_no -> frame waiting for a worker
+
+        self.lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return "camera {}".format(self.source)
+
+
+class Supervisor:
+    def __init__(self, fd_model_path: str, fr_model_path: str, sources: list,
+                 workers=None, max_inflight=2, show=True, report_every=5.0,
+                 snapshot_path=snapshot.SNAPSHOT_PATH, detect_scale=0.5, fd_target=(0, 0), fr_target=(0, 0)) -> None:
+
+        self.workers = workers or os.cpu_count() or 1
+        self.max_inflight = max_inflight  # frames per stream queued at the pool before capture starts dropping
+        self.show = show
+        self.report_every = report_every
+
+        load_dotenv()
+
+        self.myDB = Database(
+            os.getenv("USER_NAME"), os.getenv("PASSWORD"),
+            os.getenv("DATABASE_NAME"), os.getenv("PORT_NUMBER")
+        )
+        snapshot_path, ids, encodings, watermark = snapshot.worker_rows(self.myDB, snapshot_path)
+
+        self.identities = IdentityCache(self.myDB)
+        self.identities.load()
+        self.myDB.attach_cache(self.identities)
+
+        # spawn rather than fork: the parent already holds OpenCV and psycopg2 state
+        context = mp.get_context("spawn")
+        self.manager = context.Manager()
+        self.deltas = DeltaLog(self.manager, context)
+
+        self.feed = GalleryFeed(self.deltas, self.myDB, watermark)
+        self.feed.listeners.append(self.identities.refresh)
+        self.feed.start()
+
+        self.pool = context.Pool(
+            self.workers, initializer=_init_worker,
+            initargs=(fd_model_path, fr_model_path, snapshot_path, ids, encodings, detect_scale, fd_target, fr_target,
+                      self.deltas.entries, self.deltas.version),
+        )
+
+        self.streams = [Stream(i, _parse_source(src)) for i, src in enumerate(sources)]
+        self.is_on = threading.Event()
+
+    # reads one stream as fast as it produces frames and hands them to the pool
+    def capture_loop(self, stream: Stream) -> None:
+        frame_no = 0
+
+        while self.is_on.is_set():
+            with metrics.timer("capture"):
+                hasFrame, frame = stream.vid_stream.read()
+
+            if not hasFrame:
+                stream.finished = True
+                break
+
+            frame_no += 1
+
+            with stream.lock:
+                stream.captured += 1
+
+                # workers are busy with this stream already; drop rather than queue up
+                if stream.inflight >= self.max_inflight:
+                    stream.dropped += 1
+                    continue
+
+                stream.inflight += 1
+                stream.pending[frame_no] = frame
+
+            self.pool.apply_async(
+                _process_frame, (stream.stream_id, frame_no, frame),
+                callback=self.on_result, error_callback=self.on_error,
+            )
+
+        stream.vid_stream.release()
+
+    # runs on the pool's result thread; routes the faces back to their stream
+    def on_result(self, result: tuple) -> None:
+        stream_id, frame_no, faces, timings = result
+        stream = self.streams[stream_id]
+
+        for stage, seconds in timings.items():
+            metrics.observe(stage + "_seconds", seconds)
+        metrics.observe("faces_per_frame", len(faces))
+
+        with stream.lock:
+            stream.inflight -= 1
+            stream.processed += 1
+
+            frame = stream.pending.pop(frame_no, None)
+            if frame is not None:
+                stream.frame = frame
+                stream.faces = faces
+
+        for _, faceID, _, is_recognised in faces:
+            metrics.inc("matches" if is_recognised else "unknown_faces")
+
+            if is_recognised:
+                self.myDB.log_event(faceID, "Seen on camera {}.".format(stream.source), dedupe=True)
+
+    def on_error(self, error: BaseException) -> None:
+        print("worker error: {}".format(error))
+        self.is_on.clear()
+
+    # frames/sec processed per stream and in total since the last report
+    def throughput(self, elapsed: float, last: dict) -> dict:
+        report = {}
+
+        for stream in self.streams:
+            done = stream.processed - last.get(stream.stream_id, 0)
+            last[stream.stream_id] = stream.processed
+            report[stream.name] = done / elapsed
+
+        report["total"] = sum(report.values())
+
+        return report
+
+    def run(self) -> None:
+        self.is_on.set()
+
+        threads = [
+            threading.Thread(target=self.capture_loop, args=(stream,), daemon=True)
+            for stream in self.streams
+        ]
+        for thread in threads:
+            thread.start()
+
+        last_counts = {}
+        last_report = time.perf_counter()
+        fps = {}
+
+        while self.is_on.is_set():
+            if all(stream.finished and stream.inflight == 0 for stream in self.streams):
+                break
+
+            now = time.perf_counter()
+            if now - last_report >= self.report_every:
+                fps = self.throughput(now - last_report, last_counts)
+                last_report = now
+
+                print(" | ".join("{}: {:.1f} fps".format(name, rate) for name, rate in fps.items())
+                      + " ({} workers)".format(self.workers))
+
+            if not self.show:
+                time.sleep(0.05)
+                continue
+
+            for stream in self.streams:
+                with stream.lock:
+                    frame, faces = stream.frame, stream.faces
+                    stream.frame = None
+
+                if frame is None:
+                    continue
+
+                faces = [
+                    (box, self.identities.name(faceID) if is_recognised else "?unknown?", dist, is_recognised)
+                    for box, faceID, dist, is_recognised in faces
+                ]
+                cv2.imshow(stream.name, draw_faces(frame, faces, fps=fps.get(stream.name, 0.0)))
+
+            if cv2.waitKey(1) & 0xFF == ord("q"):
+                break
+
+        self.is_on.clear()
+        for thread in threads:
+            thread.join(timeout=1.0)
+
+        self.pool.terminate()
+        self.pool.join()
+        self.feed.stop()
+        self.feed.join()
+        self.manager.shutdown()
+        self.myDB.close_conn()
+
+        for stream in self.streams:
+            print("{}: captured {}, processed {}, dropped {}".format(
+                stream.name, stream.captured, stream.processed, stream.dropped))
+
+
+# "0" -> camera index 0, anything else is treated as a video file path
+def _parse_source(source):
+    return int(source) if str(source).isnumeric() else source
@@ -0,0 +1,131 @@
+# IoU tracker between YuNet.infer and recognition
+#
+# each detection is matched to a track from the previous frame; a track remembers who it was
+# identified as, so a face only gets re-embedded every few frames or when it moved noticeably
+
+import numpy as np
+
+
+# IoU between every box in a (N, 4) and every box in b (M, 4); boxes are x, y, w, h
+def iou_matrix(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    a = np.asarray(a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float32).reshape(-1, 4)
+
+    ax2, ay2 = a[:, 0] + a[:, 2], a[:, 1] + a[:, 3]
+    bx2, by2 = b[:, 0] + b[:, 2], b[:, 1] + b[:, 3]
+
+    iw = np.minimum(ax2[:, None], bx2[None, :]) - np.maximum(a[:, None, 0], b[None, :, 0])
+    ih = np.minimum(ay2[:, None], by2[None, :]) - np.maximum(a[:, None, 1], b[None, :, 1])
+    inter = np.clip(iw, 0, None) * np.clip(ih, 0, None)
+
+    union = (a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None, :] - inter
+
+    return inter / np.maximum(union, 1e-6)
+
+
+class Track:
+    def __init__(self, track_id: int, det: np.ndarray) -> None:
+        self.track_id = track_id
+        self.det = det  # latest YuNet row: bbox, 5 landmarks, score
+
+        self.missed = 0  # frames since this track was last detected
+        self.since_verify = 0  # frames since the identity was last computed
+        self.verified_det = None  # YuNet row at the last verification
+
+        # cached identity
+        self.name = None
+        self.dist = float("nan")
+        self.is_recognised = False
+
+    @property
+    def bbox(self) -> np.ndarray:
+        return self.det[0:4]
+
+    @property
+    def landmarks(self) -> np.ndarray:
+        return self.det[4:14].reshape(5, 2)
+
+    def set_identity(self, name: str, dist: float, is_recognised: bool) -> None:
+        self.name = name
+        self.dist = dist
+        self.is_recognised = is_recognised
+
+        self.since_verify = 0
+        self.verified_det = self.det.copy()
+
+
+class FaceTracker:
+    def __init__(self, iou_threshold=0.3, max_missed=5, reverify_every=15, move_threshold=0.15) -> None:
+        self.iou_threshold = iou_threshold  # minimum IoU to continue a track
+        self.max_missed = max_missed  # frames a track survives without a detection
+        self.reverify_every = reverify_every  # re-embed a tracked face at least this often
+        self.move_threshold = move_threshold  # landmark shift, relative to face width, that forces re-embedding
+
+        self.tracks = []
+        self._next_id = 0
+
+        self.counters = {"cache_hits": 0, "fresh_embeddings": 0}
+
+    # matches this frame's detections to tracks; returns one track per detection, in detection order
+    def update(self, results: np.ndarray) -> list:
+        results = np.asarray(results, dtype=np.float32).reshape(-1, 15) if len(results) else np.empty((0, 15), np.float32)
+
+        assigned = [None] * len(results)
+        free = set(range(len(self.tracks)))
+
+        if len(self.tracks) and len(results):
+            ious = iou_matrix(np.vstack([t.bbox for t in self.tracks]), results[:, 0:4])
+
+            # greedy: best overlaps first
+            for t, d in zip(*np.unravel_index(np.argsort(-ious, axis=None), ious.shape)):
+                if ious[t, d] < self.iou_threshold:
+                    break
+                if t in free and assigned[d] is None:
+                    assigned[d] = self.tracks[t]
+                    free.discard(t)
+
+        for t in free:
+            self.tracks[t].missed += 1
+
+        for d, det in enumerate(results):
+            track = assigned[d]
+
+            if track is None:
+                track = Track(self._next_id, det)
+                self._next_id += 1
+                self.tracks.append(track)
+                assigned[d] = track
+            else:
+                track.det = det
+                track.missed = 0
+                track.since_verify += 1
+
+        self.tracks = [t for t in self.tracks if t.missed <= self.max_missed]
+
+        return assigned
+
+    # True when the cached identity of a track can't be trusted any more
+    def needs_verify(self, track: Track) -> bool:
+        if track.verified_det is None or track.since_verify >= self.reverify_every:
+            return True
+
+        width = max(float(track.verified_det[2]), 1.0)
+        shift = np.linalg.norm(track.landmarks - track.verified_det[4:14].reshape(5, 2), axis=1).mean()
+
+        return shift / width > self.move_threshold
+
+    # splits the tracks of a frame into (cached, stale) and updates the counters
+    def split(self, tracks: list) -> tuple:
+        stale = [t for t in tracks if self.needs_verify(t)]
+        cached = [t for t in tracks if t not in stale]
+
+        self.counters["cache_hits"] += len(cached)
+        self.counters["fresh_embeddings"] += len(stale)
+
+        return cached, stale
+
+    # share of faces served from the track cache
+    def hit_rate(self) -> float:
+        total = self.counters["cache_hits"] + self.counters["fresh_embeddings"]
+
+        return self.counters["cache_hits"] / total if total else 0.0
@@ -0,0 +1,88 @@
+# message framing shared by the recognition server and the gallery shards: no pickle on the wire
+#
+#   8-byte header (JSON length, payload length, big-endian), JSON, payload
+#
+# pack() turns a value made of lists, tuples, dicts, scalars and numpy arrays into JSON plus one
+# payload: numeric arrays travel as raw bytes referenced from the JSON ({"$array": dtype, "shape",
+# "offset"}), arrays of face IDs as JSON lists. unpack() reverses it; tuples come back as lists
+
+import json
+import struct
+
+import numpy as np
+
+
+HEADER = struct.Struct("!II")  # JSON length, payload length
+
+
+# "host:port" -> (host, port) for TCP, anything else is a Unix socket path
+def parse_address(address: str):
+    host, sep, port = address.rpartition(":")
+
+    return (host, int(port)) if sep and port.isdigit() else address
+
+
+def encode_message(header: dict, payload=b"") -> bytes:
+    body = json.dumps(header).encode()
+
+    return HEADER.pack(len(body), len(payload)) + body + payload
+
+
+# (header, payload) of one complete message
+def decode_message(data: bytes) -> tuple:
+    body_len, payload_len = HEADER.unpack_from(data)
+    if len(data) != HEADER.size + body_len + payload_len:
+        raise ValueError("message is {} bytes, header says {}".format(len(data), HEADER.size + body_len + payload_len))
+
+    header = json.loads(bytes(data[HEADER.size:HEADER.size + body_len]))
+
+    return header, memoryview(data)[HEADER.size + body_len:]
+
+
+def pack(value) -> tuple:
+    chunks = []
+    size = [0]
+
+    def walk(value):
+        if isinstance(value, np.ndarray):
+            if value.dtype == object:
+                return {"$objects": [walk(v) for v in value.ravel().tolist()], "shape": list(value.shape)}
+
+            data = np.ascontiguousarray(value).tobytes()
+            chunks.append(data)
+            size[0] += len(data)
+            return {"$array": value.dtype.str, "shape": list(value.shape), "offset": size[0] - len(data)}
+
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, (list, tuple)):
+            return [walk(v) for v in value]
+        if isinstance(value, dict):
+            return {key: walk(v) for key, v in value.items()}
+
+        return value
+
+    return walk(value), b"".join(chunks)
+
+
+def unpack(value, payload: bytes):
+    if isinstance(value, list):
+        return [unpack(v, payload) for v in value]
+
+    if isinstance(value, dict):
+        if "$array" in value:
+            dtype = np.dtype(value["$array"])
+            count = int(np.prod(value["shape"]))
+            if dtype.hasobject or min(value["shape"], default=0) < 0 or value["offset"] + count * dtype.itemsize > len(payload):
+                raise ValueError("array does not fit the payload")
+
+            return np.frombuffer(payload, dtype=dtype, count=count, offset=value["offset"]).reshape(value["shape"])
+
+        if "$objects" in value:
+            objects = np.empty(len(value["$objects"]), dtype=object)
+            objects[:] = value["$objects"]
+            return objects.reshape(value["shape"])
+
+        return {key: unpack(v, payload) for key, v in value.items()}
+
+    return value